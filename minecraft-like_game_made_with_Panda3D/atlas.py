@@ -0,0 +1,162 @@
+""" Атлас текстур блоков: текстуры всех типов блоков в одной картинке, так что весь мир
+рисуется с одной привязанной текстурой, сколько бы типов блоков ни было.
+
+Текстура типа ищется в PATH_BLOCK_TEXTURES по названию типа: <название>_top.png, _side.png
+и _bottom.png для верхней, боковых и нижней граней или <название>.png для всех сразу,
+а если своей текстуры нет - берётся PATH_BASE_TEXTURE. Цвет типа из BLOCK_TYPES умножается
+на текстуру, поэтому без своих текстур блоки выглядят как раньше.
+Каждая текстура занимает в атласе квадрат ATLAS_TILE x ATLAS_TILE с рамкой из повторённых
+краевых пикселей, чтобы фильтрация не подмешивала соседние квадраты.
+Собранный атлас сохраняется в PATH_ATLAS_CACHE под хэшем исходных картинок и при следующем
+запуске только читается.
+Слитая грань или грань грубой сетки покрывает несколько клеток, а текстура из атласа сама
+не повторяется: это делает шейдер atlas_shader по координатам в клетках (столбец tiling сетки).
+Без поддержки шейдеров текстура растягивается на всю грань, поэтому грани тогда не сливаются """
+import hashlib
+import math
+from pathlib import Path
+
+import numpy as np
+from panda3d.core import Filename, PNMImage, RenderAttrib, Shader, ShaderAttrib, Texture, Vec2, Vec4
+
+from blocks import TYPES
+from conf import PATH_BASE_TEXTURE, PATH_BLOCK_TEXTURES, PATH_ATLAS_CACHE, ATLAS_TILE
+
+
+ATLAS_VERSION = 1  # меняется при изменении раскладки атласа, прежние файлы кэша перестают подходить
+GUTTER = 2  # пикселей рамки вокруг квадрата текстуры
+# какую текстуру типа брать для граней в порядке mesher.FACES: +X, -X, +Y, -Y, верх, низ
+FACE_TEXTURES = ('side', 'side', 'side', 'side', 'top', 'bottom')
+
+VERTEX_SHADER = """#version 120
+uniform mat4 p3d_ModelViewProjectionMatrix;
+attribute vec4 p3d_Vertex;
+attribute vec4 p3d_Color;
+attribute vec2 p3d_MultiTexCoord0;
+attribute vec2 tiling;
+varying vec4 color;
+varying vec2 uv;
+varying vec2 cells;
+
+void main() {
+    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+    color = p3d_Color;
+    uv = p3d_MultiTexCoord0;
+    cells = tiling;
+}
+"""
+
+# uv грани лежит внутри её квадрата атласа: по нему находится угол квадрата, а место в квадрате
+# берётся из дробной части координат в клетках. Координаты квадратов считаются от верхнего края атласа
+FRAGMENT_SHADER = """#version 120
+uniform sampler2D p3d_Texture0;
+uniform vec4 p3d_ColorScale;
+uniform vec4 atlas_grid;  // шаг квадратов и ширина рамки, в долях атласа
+uniform vec2 atlas_tile;  // размер текстуры в атласе, в долях атласа
+varying vec4 color;
+varying vec2 uv;
+varying vec2 cells;
+
+void main() {
+    vec2 cell = floor(vec2(uv.x, 1.0 - uv.y) / atlas_grid.xy);
+    vec2 place = cell * atlas_grid.xy + atlas_grid.zw + vec2(fract(cells.x), 1.0 - fract(cells.y)) * atlas_tile;
+    gl_FragColor = texture2D(p3d_Texture0, vec2(place.x, 1.0 - place.y)) * color * p3d_ColorScale;
+}
+"""
+
+
+def _sources(directory: Path, base: Path) -> list[list[Path]]:
+    """ картинка для каждой грани каждого типа блока """
+    result = []
+    for block in TYPES:
+        faces = []
+        for face in FACE_TEXTURES:
+            candidates = (directory / f"{block.name}_{face}.png", directory / f"{block.name}.png")
+            faces.append(next((path for path in candidates if path.exists()), base))
+        result.append(faces)
+    return result
+
+
+def _layout(count: int) -> tuple[int, int, int]:
+    """ сколько квадратов в строке атласа и размеры атласа в пикселях: степени двойки """
+    cell = ATLAS_TILE + 2 * GUTTER
+    columns = math.ceil(math.sqrt(count))
+    rows = math.ceil(count / columns)
+    return columns, 1 << math.ceil(math.log2(columns * cell)), 1 << math.ceil(math.log2(rows * cell))
+
+
+def _build(images: list[Path], path: Path) -> None:
+    """ собирает атлас из картинок images по порядку и записывает его в path """
+    columns, width, height = _layout(len(images))
+    cell = ATLAS_TILE + 2 * GUTTER
+    atlas = PNMImage(width, height, 3)
+    for number, source in enumerate(images):
+        image = PNMImage(Filename.fromOsSpecific(str(source)))
+        image.removeAlpha()
+        tile = PNMImage(ATLAS_TILE, ATLAS_TILE, 3)
+        tile.quickFilterFrom(image)
+        x, y = number % columns * cell + GUTTER, number // columns * cell + GUTTER
+        atlas.copySubImage(tile, x, y)
+        # рамка: крайние строки и столбцы повторяются наружу, углы - угловыми пикселями
+        for offset in range(1, GUTTER + 1):
+            atlas.copySubImage(tile, x, y - offset, 0, 0, ATLAS_TILE, 1)
+            atlas.copySubImage(tile, x, y + ATLAS_TILE - 1 + offset, 0, ATLAS_TILE - 1, ATLAS_TILE, 1)
+            atlas.copySubImage(tile, x - offset, y, 0, 0, 1, ATLAS_TILE)
+            atlas.copySubImage(tile, x + ATLAS_TILE - 1 + offset, y, ATLAS_TILE - 1, 0, 1, ATLAS_TILE)
+        for dx, dy in ((0, 0), (ATLAS_TILE - 1, 0), (0, ATLAS_TILE - 1), (ATLAS_TILE - 1, ATLAS_TILE - 1)):
+            color = tile.getXel(dx, dy)
+            for gx in range(GUTTER):
+                for gy in range(GUTTER):
+                    atlas.setXel(x + (dx + gx + 1 if dx else -gx - 1), y + (dy + gy + 1 if dy else -gy - 1), color)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if not atlas.write(Filename.fromOsSpecific(str(path))):
+        raise OSError(f"Could not write texture atlas {path}")
+
+
+def load_atlas(directory: Path = Path(PATH_BLOCK_TEXTURES), base: Path = Path(PATH_BASE_TEXTURE),
+               cache: Path = Path(PATH_ATLAS_CACHE)) -> tuple[Texture, np.ndarray]:
+    """ текстура атласа и прямоугольники текстур в нём (u0, v0, u1, v1) по типу блока и грани,
+    массив (типы, 6, 4). Атлас собирается, только если его нет в кэше cache """
+    sources = _sources(Path(directory), Path(base))
+    images = list(dict.fromkeys(path for faces in sources for path in faces))
+    digest = hashlib.blake2b(repr((ATLAS_VERSION, ATLAS_TILE, GUTTER)).encode(), digest_size=16)
+    for image in images:
+        digest.update(image.name.encode())
+        digest.update(image.read_bytes())
+    path = Path(cache) / f"atlas-{digest.hexdigest()}.png"
+    if not path.exists():
+        _build(images, path)
+
+    texture = Texture("block atlas")
+    if not texture.read(Filename.fromOsSpecific(str(path))):
+        raise OSError(f"Could not read texture atlas {path}")
+    texture.setWrapU(Texture.WM_clamp)
+    texture.setWrapV(Texture.WM_clamp)
+
+    columns, width, height = _layout(len(images))
+    cell = ATLAS_TILE + 2 * GUTTER
+    rects = []
+    for number in range(len(images)):
+        x, y = number % columns * cell + GUTTER, number // columns * cell + GUTTER
+        # у картинки строки идут сверху вниз, а v текстуры - снизу вверх
+        rects.append((x / width, 1 - (y + ATLAS_TILE) / height, (x + ATLAS_TILE) / width, 1 - y / height))
+    index = {image: number for number, image in enumerate(images)}
+    uvs = np.array([[rects[index[path]] for path in faces] for faces in sources], dtype=np.float32)
+    return texture, uvs
+
+
+def atlas_shader(texture: Texture) -> RenderAttrib:
+    """ шейдер, который повторяет текстуры атласа texture по клеткам граней """
+    width, height = texture.getXSize(), texture.getYSize()
+    cell = ATLAS_TILE + 2 * GUTTER
+    shader = Shader.make(Shader.SL_GLSL, VERTEX_SHADER, FRAGMENT_SHADER)
+    return (ShaderAttrib.make(shader)
+            .setShaderInput('atlas_grid', Vec4(cell / width, cell / height, GUTTER / width, GUTTER / height))
+            .setShaderInput('atlas_tile', Vec2(ATLAS_TILE / width, ATLAS_TILE / height)))
+
+
+def shaders_supported() -> bool:
+    """ умеет ли окно игры шейдеры; без окна (замеры, сервер) считается, что умеет """
+    window = base.win
+    gsg = None if window is None else window.getGsg()
+    return gsg is None or gsg.getSupportsBasicShaders()
@@ -0,0 +1,401 @@
+""" Замеры производительности карты без открытия окна: python benchmark.py """
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from panda3d.core import TextureAttrib, loadPrcFileData
+
+loadPrcFileData('', 'window-type none\naudio-library-name null')
+
+from direct.showbase.ShowBase import ShowBase  # noqa: E402
+
+from blocks import AIR, STONE, SAND  # noqa: E402
+from conf import CHUNK_SIZE, PATH_LAND, VIEW_RADIUS, LOD_RADIUS, PHYSICS_BUDGET, MESH_CACHE_SIZE  # noqa: E402
+from atlas import load_atlas  # noqa: E402
+from mapfile import encode_chunk  # noqa: E402
+from light import LightMap  # noqa: E402
+from physics import BlockPhysics  # noqa: E402
+from mapmanager import Mapmanager  # noqa: E402
+from meshcache import MeshCache  # noqa: E402
+from mesher import build_mesh  # noqa: E402
+from terrain import TerrainGenerator  # noqa: E402
+from type_hints import Position  # noqa: E402
+from voxels import Chunk  # noqa: E402
+
+
+MAP_SIZES = [(20, 44), (128, 128), (512, 512), (1024, 1024)]
+LOOKUPS = 100_000
+LOOKUP_AREA = 64  # сторона участка для поиска клеток рядом друг с другом
+TOWER_HEIGHTS = [4, 64, 1024]
+MESH_SIZE = (256, 256)
+LAND_SIZES = [256, 512, 1024, 2048]
+TERRAIN_SIZE = 512
+BULK_SIZE = 100  # ребро куба в 1 000 000 блоков
+RAYS = 10_000
+VIEW_RADII = [6, 12, 24, 48]
+BLOCK_TYPES_CHUNKS = 8  # сторона участка рельефа в чанках
+LIGHT_CHUNKS = 8
+LIGHT_EDITS = 1000
+MESH_CACHE_CHUNKS = 24  # сторона сохранённого мира в чанках
+PHYSICS_MAPS = [(64, 64), (512, 512)]
+PHYSICS_COLUMNS = [10, 100, 1000]  # столбов песка по 8 блоков, падающих с высоты
+PHYSICS_SPREAD = 512  # на каком расстоянии друг от друга падают два столба песка
+ATLAS_CHUNKS = 8
+
+
+def fill_flat(land: Mapmanager, width: int, depth: int, height: int = 3) -> None:
+    """ заполняет индекс карты ровной землёй в обход создания узлов сцены """
+    land._clear()
+    for cx in range(-(-width // CHUNK_SIZE)):
+        for cy in range(-(-depth // CHUNK_SIZE)):
+            chunk = land.voxels.chunks[cx, cy] = Chunk()
+            chunk.blocks[:, :, :height + 1] = 1
+            chunk.update_heights()
+    land._dirty |= set(land.voxels.chunks)
+
+
+def bench_lookups(land: Mapmanager, repeats: int = 5) -> None:
+    # поиск клетки - словарь чанков и массив, от размера карты не зависит; по всей карте вразброс
+    # дороже только из-за кэша процессора: чанков больше, чем в нём помещается
+    print(f"is_empty lookup cost, best of {repeats}: random cells of the whole map and of a "
+          f"{LOOKUP_AREA}x{LOOKUP_AREA} area")
+    for width, depth in MAP_SIZES:
+        fill_flat(land, width, depth)
+        costs = []
+        for area_width, area_depth in ((width, depth), (min(width, LOOKUP_AREA), min(depth, LOOKUP_AREA))):
+            positions = [Position(random.randrange(area_width), random.randrange(area_depth), random.randrange(8))
+                         for _ in range(LOOKUPS)]
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                for position in positions:
+                    land.is_empty(position)
+                timings.append(time.perf_counter() - start)
+            costs.append(min(timings) / LOOKUPS * 1e9)
+        print(f"  {width:>5}x{depth:<5} {costs[0]:6.0f} ns/lookup over the map, {costs[1]:6.0f} ns/lookup in the area")
+
+
+def bench_towers(land: Mapmanager) -> None:
+    print("find_highest_empty cost next to a tower")
+    for height in TOWER_HEIGHTS:
+        fill_flat(land, CHUNK_SIZE, CHUNK_SIZE, 0)
+        for z in range(height):
+            land.voxels.set(0, 0, z, 1)
+        position = Position(0, 0, 1)
+        start = time.perf_counter()
+        for _ in range(LOOKUPS):
+            land.find_highest_empty(position)
+        elapsed = time.perf_counter() - start
+        print(f"  {height:>5} blocks {elapsed / LOOKUPS * 1e9:8.0f} ns/lookup")
+
+
+def bench_meshing(land: Mapmanager) -> None:
+    width, depth = MESH_SIZE
+    print(f"chunk meshing of {width}x{depth}")
+    for bumps in (False, True):
+        for greedy in (False, True):
+            fill_flat(land, width, depth)
+            if bumps:
+                # неровный разноцветный рельеф, чтобы у столбцов были видны боковые грани
+                for x in range(0, width, 3):
+                    for y in range(0, depth, 5):
+                        land.add_block(Position(x, y, 4))
+            land.greedy = greedy
+            start = time.perf_counter()
+            land.update_chunks()
+            elapsed = time.perf_counter() - start
+            vertices = sum(node.node().getGeom(0).getVertexData().getNumRows()
+                           for node in land.land.getChildren())
+            print(f"  {'bumpy' if bumps else 'flat':5} {'greedy' if greedy else 'culled':6} "
+                  f"{len(land.voxels)} blocks, {land.land.getNumChildren()} nodes, "
+                  f"{vertices:>7} vertices, {elapsed * 1000:4.0f} ms")
+
+
+def bench_startup(land: Mapmanager, repeats: int = 5) -> None:
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        land.load_land(PATH_LAND)
+        land.update_chunks()
+        timings.append(time.perf_counter() - start)
+    print(f"load_land({PATH_LAND}) with meshing: best {min(timings) * 1000:.1f} ms of {repeats}")
+
+
+def bench_land_loading(land: Mapmanager) -> None:
+    print("load_land of generated heightmaps (without meshing)")
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        for size in LAND_SIZES:
+            path = Path(directory) / f"land_{size}.txt"
+            path.write_text('\n'.join(' '.join(map(str, row)) for row in rng.integers(0, 12, (size, size))))
+            start = time.perf_counter()
+            land.load_land(path)
+            elapsed = time.perf_counter() - start
+            print(f"  {size:>5}x{size:<5} {elapsed * 1000:7.0f} ms, {elapsed / size ** 2 * 1e9:5.0f} ns/column")
+    land._clear()
+
+
+def bench_terrain(land: Mapmanager, repeats: int = 5) -> None:
+    size = TERRAIN_SIZE
+    chunks = size // CHUNK_SIZE
+    print(f"terrain generation of {size}x{size} (best of {repeats})")
+    heightmap, voxels = [], []
+    for seed in range(repeats):
+        start = time.perf_counter()
+        TerrainGenerator(seed).heights(0, 0, size, size)
+        heightmap.append(time.perf_counter() - start)
+        # чанки по одному, как при обходе мира героем
+        land.generate_land(seed)
+        start = time.perf_counter()
+        for cx in range(chunks):
+            for cy in range(chunks):
+                land.voxels.chunk((cx, cy))
+        voxels.append(time.perf_counter() - start)
+    print(f"  heightmap {min(heightmap) * 1000:5.0f} ms")
+    print(f"  {chunks * chunks} chunks into voxels {min(voxels) * 1000:5.0f} ms")
+    land._clear()
+
+
+def bench_bulk_edits(land: Mapmanager) -> None:
+    size = BULK_SIZE
+    corner, opposite = Position(0, 0, 0), Position(size - 1, size - 1, size - 1)
+    print(f"bulk edits of a {size}x{size}x{size} region (edit + one rebuild per chunk)")
+    edits = [
+        ("fill_box", lambda: land.fill_box(corner, opposite)),
+        ("clear_box", lambda: land.clear_box(corner, opposite)),
+        ("fill_sphere", lambda: land.fill_sphere(Position(size // 2, size // 2, size // 2), size // 2)),
+        ("copy+paste", lambda: land.paste_box(Position(size, 0, 0), land.copy_box(corner, opposite))),
+    ]
+    fill_flat(land, 2 * size, size)
+    land.update_chunks()
+    for name, edit in edits:
+        start = time.perf_counter()
+        edit()
+        edited = time.perf_counter() - start
+        chunks = len(land._dirty)
+        land.update_chunks()
+        elapsed = time.perf_counter() - start
+        print(f"  {name:11} edit {edited * 1000:4.0f} ms, {chunks} chunks, with meshing {elapsed * 1000:5.0f} ms")
+    land._clear()
+
+
+def bench_raycast(land: Mapmanager, reach: float = 8) -> None:
+    fill_flat(land, 256, 256)
+    rng = np.random.default_rng(0)
+    origins = np.column_stack((rng.uniform(8, 248, (RAYS, 2)), rng.uniform(4, 8, RAYS))).tolist()
+    directions = rng.normal(size=(RAYS, 3)).tolist()
+    start = time.perf_counter()
+    hits = sum(land.raycast(origin, direction, reach) is not None for origin, direction in zip(origins, directions))
+    elapsed = time.perf_counter() - start
+    print(f"raycast, reach {reach}: {elapsed / RAYS * 1e6:.1f} us/query, {hits * 100 // RAYS}% hits")
+    land._clear()
+
+
+def bench_view_distance(land: Mapmanager) -> None:
+    print("scene size by view radius on generated terrain (all meshes built)")
+    focus = render.attachNewNode("focus")
+    land.follow(focus)
+    for radius in VIEW_RADII:
+        for lod in (False, True):
+            land.generate_land(0)
+            land.view_radius = radius
+            land.lod_radius = LOD_RADIUS if lod else radius
+            start = time.perf_counter()
+            land.update_chunks()
+            elapsed = time.perf_counter() - start
+            nodes = land.land.getChildren()
+            vertices = sum(node.node().getGeom(0).getVertexData().getNumRows() for node in nodes)
+            print(f"  radius {radius:>2} {'lod' if lod else 'full':4} {len(nodes):>5} nodes, "
+                  f"{vertices:>8} vertices, meshing {elapsed * 1000:6.0f} ms")
+    land.follow(None)
+    focus.removeNode()
+    land.view_radius, land.lod_radius = VIEW_RADIUS, LOD_RADIUS
+    land._clear()
+
+
+def bench_block_types(land: Mapmanager) -> None:
+    count = BLOCK_TYPES_CHUNKS
+    print(f"generated terrain of {count}x{count} chunks: layered block types against random types per block")
+    land.generate_land(0)
+    keys = [(cx, cy) for cx in range(count) for cy in range(count)]
+    layered = {key: land.voxels.chunk(key).blocks for key in keys}
+    rng = np.random.default_rng(0)
+    shuffled = {}
+    for key, blocks in layered.items():
+        blocks = blocks.copy()
+        solid = blocks != 0
+        blocks[solid] = rng.integers(1, 5, np.count_nonzero(solid), dtype=np.uint8)
+        shuffled[key] = blocks
+    for name, chunks in (("layered", layered), ("random", shuffled)):
+        for key, blocks in chunks.items():
+            land.voxels.chunks[key] = Chunk(blocks=blocks)
+        stored = sum(len(encode_chunk(blocks, True)) for blocks in chunks.values())
+        start = time.perf_counter()
+        vertices = sum(len(build_mesh(land.voxels.padded(key), land._palette, True).vertices) for key in keys)
+        elapsed = time.perf_counter() - start
+        print(f"  {name:7} {stored / len(keys):6.0f} bytes/chunk on disk, greedy meshing "
+              f"{elapsed / len(keys) * 1000:4.1f} ms/chunk, {vertices:>7} vertices")
+    land._clear()
+
+
+def bench_lighting(land: Mapmanager) -> None:
+    count = LIGHT_CHUNKS
+    print(f"light on generated terrain of {count}x{count} chunks")
+    land.generate_land(0)
+    light = LightMap(land.voxels)
+    start = time.perf_counter()
+    for cx in range(count):
+        for cy in range(count):
+            light.chunk((cx, cy))
+    print(f"  whole chunk {(time.perf_counter() - start) / count ** 2 * 1000:5.2f} ms")
+    # копаем и строим на поверхности и под крышей, которую кладём заранее
+    size = count * CHUNK_SIZE
+    land.voxels.write_box(Position(size // 4, size // 4, 40), np.full((size // 2, size // 2, 1), STONE, dtype=np.uint8))
+    light.update(Position(size // 4, size // 4, 40), (size // 2, size // 2, 1))
+    rng = random.Random(0)
+    timings, touched = [], 0
+    for number in range(LIGHT_EDITS):
+        x, y = rng.randrange(CHUNK_SIZE, size - CHUNK_SIZE), rng.randrange(CHUNK_SIZE, size - CHUNK_SIZE)
+        z = land.voxels.column_height(x, y) - (number % 2)
+        land.voxels.set(x, y, z, AIR if number % 2 else STONE)
+        start = time.perf_counter()
+        touched += len(light.update(Position(x, y, z), (1, 1, 1)))
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1000
+    print(f"  one block edit p50 {np.percentile(timings, 50):5.2f} ms, p99 {np.percentile(timings, 99):5.2f} ms, "
+          f"{touched / LIGHT_EDITS:.1f} chunks relit")
+    land._clear()
+
+
+def bench_physics(land: Mapmanager) -> None:
+    print("falling sand: cost of a tick by active cells, whatever the map size")
+    for width, depth in PHYSICS_MAPS:
+        for columns in PHYSICS_COLUMNS:
+            fill_flat(land, width, depth)
+            physics = BlockPhysics(land.voxels)
+            rng = random.Random(0)
+            for _ in range(columns):
+                origin = Position(rng.randrange(width), rng.randrange(depth), 20)
+                land.voxels.write_box(origin, np.full((1, 1, 8), SAND, dtype=np.uint8))
+                physics.wake(origin, (1, 1, 8))
+            ticks = cells = moves = 0
+            start = time.perf_counter()
+            while physics.active:
+                cells += len(physics)
+                moves += len(physics.step()) // 2
+                ticks += 1
+            elapsed = time.perf_counter() - start
+            print(f"  {width}x{depth} map, {columns:4} columns: {ticks} ticks, {cells / ticks:6.0f} active cells/tick, "
+                  f"{elapsed / ticks * 1000:6.2f} ms/tick, {elapsed / cells * 1e6:4.1f} us/cell, {moves} moves")
+    # обвал куба песка с бюджетом такта: растягивается на несколько тактов
+    fill_flat(land, 64, 64)
+    land.update_chunks()
+    land._write_box(Position(16, 16, 20), np.full((32, 32, 8), SAND, dtype=np.uint8))
+    timings = []
+    while land.physics.active or land._unsettled:
+        start = time.perf_counter()
+        land._physics_tick()
+        timings.append(time.perf_counter() - start)
+    timings = np.array(timings) * 1000
+    print(f"  collapse of {32 * 32 * 8} blocks with a {PHYSICS_BUDGET * 1000:.0f} ms budget: {len(timings)} ticks, "
+          f"p50 {np.percentile(timings, 50):5.2f} ms, max {timings.max():5.2f} ms per tick with relighting")
+    land._clear()
+    # два столба песка на разных концах большой карты: свет пересчитывается возле каждого, а не между ними
+    fill_flat(land, PHYSICS_SPREAD, 16)
+    land.update_chunks()
+    for x in (0, PHYSICS_SPREAD - 1):
+        land._write_box(Position(x, 8, 20), np.full((1, 1, 2), SAND, dtype=np.uint8))
+    timings = []
+    while land.physics.active or land._unsettled:
+        start = time.perf_counter()
+        land._physics_tick()
+        timings.append(time.perf_counter() - start)
+    print(f"  two columns {PHYSICS_SPREAD} blocks apart: max {max(timings) * 1000:5.2f} ms per tick with relighting")
+    land._clear()
+
+
+def bench_mesh_cache(land: Mapmanager) -> None:
+    count = MESH_CACHE_CHUNKS
+    print(f"load_map of a saved world of {count}x{count} chunks with meshing, without and with the mesh cache")
+    world = land.world
+    with tempfile.TemporaryDirectory() as directory:
+        land.world = Path(directory) / "world"
+        land.generate_land(0)
+        # все чанки - в файлы регионов, как у карты, по которой долго ходили
+        for cx in range(count):
+            for cy in range(count):
+                land.voxels.chunk((cx, cy))
+        land.voxels.modified |= set(land.voxels.chunks)
+        land.save_map()
+        land._finish_save()
+        meshes = MeshCache(Path(directory) / "meshes", MESH_CACHE_SIZE)
+        for name, cache in (("no cache", MeshCache(None, 0)), ("cold", meshes), ("warm", meshes)):
+            if land.mesh_cache is not cache:
+                land.mesh_cache.close()
+                land.mesh_cache = cache
+            cache.hits = cache.misses = 0
+            start = time.perf_counter()
+            land.load_map()
+            land.update_chunks()
+            elapsed = time.perf_counter() - start
+            cache.flush()
+            print(f"  {name:8} {elapsed * 1000:6.0f} ms, {len(land._chunks)} chunks, "
+                  f"{cache.hits} hits, {cache.misses} misses")
+        # сетки дописываются в каталог до того, как он удалится
+        land.mesh_cache.close()
+        land.mesh_cache = MeshCache(None, 0)
+    land._clear()
+    land.world = world
+
+
+def bench_atlas(land: Mapmanager) -> None:
+    print("texture atlas: building against loading from the cache, meshing with atlas UVs, draw states of the world")
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ("build", "cached"):
+            start = time.perf_counter()
+            load_atlas(cache=Path(directory))
+            print(f"  {name:7} {(time.perf_counter() - start) * 1000:6.1f} ms")
+    count = ATLAS_CHUNKS
+    land.generate_land(0)
+    keys = [(cx, cy) for cx in range(count) for cy in range(count)]
+    for name, uvs in (("tiled", None), ("atlas", land._uvs)):
+        start = time.perf_counter()
+        for key in keys:
+            build_mesh(land.voxels.padded(key), land._palette, False, (0, 0, 0), None, uvs)
+        print(f"  {name:7} meshing {(time.perf_counter() - start) / len(keys) * 1000:4.1f} ms/chunk")
+    focus = render.attachNewNode("focus")
+    land.follow(focus)
+    land.update_chunks()
+    nodes = land.land.getChildren()
+    states = {node.node().getGeomState(0) for node in nodes}
+    textures = {state.getAttrib(TextureAttrib).getTexture() for state in states}
+    print(f"  {len(nodes)} nodes with {len(land._uvs) - 1} block types: "
+          f"{len(states)} render states, {len(textures)} textures")
+    land.follow(None)
+    focus.removeNode()
+    land._clear()
+
+
+if __name__ == '__main__':
+    ShowBase()
+    land = Mapmanager()
+    # замеры построения сеток не должны зависеть от сеток, сохранённых прошлыми запусками
+    land.mesh_cache.close()
+    land.mesh_cache = MeshCache(None, 0)
+    bench_startup(land)
+    bench_land_loading(land)
+    bench_terrain(land)
+    bench_lookups(land)
+    bench_towers(land)
+    bench_raycast(land)
+    bench_meshing(land)
+    bench_bulk_edits(land)
+    bench_block_types(land)
+    bench_lighting(land)
+    bench_physics(land)
+    bench_mesh_cache(land)
+    bench_atlas(land)
+    bench_view_distance(land)
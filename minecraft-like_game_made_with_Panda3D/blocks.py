@@ -0,0 +1,51 @@
+""" Типы блоков. В клетке карты хранится только номер типа (uint8), всё остальное -
+название, цвет, свет, движение - берётся из BLOCK_TYPES по номеру.
+
+Блоки одного типа немного различаются по яркости, но оттенок не хранится, а считается
+из координат блока, поэтому у блока он всегда один и тот же """
+from typing import NamedTuple
+
+import numpy as np
+
+from conf import BLOCK_TYPES, BLOCK_SHADE
+from type_hints import RGBA
+
+
+class BlockType(NamedTuple):
+    name: str
+    color: RGBA
+    light: int  # уровень света, который излучает блок
+    motion: str | None  # None, 'fall' или 'flow', см. physics.py
+
+
+TYPES = [BlockType(name, RGBA(*color), light, motion) for name, color, light, motion in BLOCK_TYPES]
+# номера типов, 0 - воздух; совпадают с номерами цветов в картах прежних версий
+AIR, STONE, GRASS, BRICK, DIRT, LAMP, SAND, WATER = range(8)
+BUILDING = tuple(range(1, len(TYPES)))  # типы, которые можно ставить
+
+DIRT_DEPTH = 3  # сколько слоёв земли под травой, дальше камень
+
+
+def palette() -> np.ndarray:
+    """ цвета RGBA (uint8) по номеру типа """
+    return (np.array([block.color for block in TYPES]) * 255).astype(np.uint8)
+
+
+def shade(x: np.ndarray, y: np.ndarray, z: np.ndarray) -> np.ndarray:
+    """ множитель яркости блоков в клетках (x, y, z): от 1 - BLOCK_SHADE до 1, постоянный для клетки """
+    h = (np.asarray(x, dtype=np.int64) * 73856093 ^ np.asarray(y, dtype=np.int64) * 19349663
+         ^ np.asarray(z, dtype=np.int64) * 83492791) & 0xFFFFFFFF
+    h = (h ^ h >> 15) * 0x2C1B3C6D & 0xFFFFFFFF
+    h = (h ^ h >> 12) * 0x297A2D39 & 0xFFFFFFFF
+    h ^= h >> 15
+    return (1 - BLOCK_SHADE * (h / 2.0 ** 32)).astype(np.float32)
+
+
+def layers(below: np.ndarray) -> np.ndarray:
+    """ типы блоков столбца по глубине под верхним блоком: трава, под ней земля, дальше камень.
+    Отрицательная глубина - воздух над столбцом """
+    blocks = np.full(below.shape, STONE, dtype=np.uint8)
+    blocks[below <= DIRT_DEPTH] = DIRT
+    blocks[below == 0] = GRASS
+    blocks[below < 0] = AIR
+    return blocks
@@ -0,0 +1,256 @@
+""" Клиент сервера мира (server.py) и игроки-боты без окна для проверки сервера под нагрузкой.
+
+    python client.py --bots 8 --edits 2000 127.0.0.1:25570
+
+Соединение с сервером работает в цикле asyncio: у игры - в отдельном потоке, у ботов - в общем
+цикле всех ботов. Пришедшие сообщения складываются в очередь, которую забирает основной поток
+игры (или бот) и применяет к своей копии карты функцией apply_message """
+import argparse
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+from queue import SimpleQueue, Empty
+
+import numpy as np
+
+from conf import SERVER_HOST, SERVER_PORT, CHUNK_SIZE
+from protocol import (CLOSED, HELLO, REQUEST, FORGET, CHUNK, BOX, BLOCKS, FRAME, ProtocolError, read_message,
+                      decode_hello, encode_keys, decode_chunk_message, encode_set, decode_box,
+                      decode_blocks)
+from type_hints import Position
+from voxels import VoxelGrid, Chunk, ChunkKey, ChunkKeys, chunk_key, chunks_touching
+
+
+CONNECT_TIMEOUT = 10  # секунд
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(':')
+    return host or SERVER_HOST, int(port or SERVER_PORT)
+
+
+class WorldClient:
+    """ Соединение с сервером мира. send можно вызывать из любого потока """
+
+    def __init__(self) -> None:
+        self.inbox: SimpleQueue[tuple[int, bytes]] = SimpleQueue()  # пришедшие сообщения (тип, данные)
+        self.spawn: Position | None = None  # где поставить героя, сообщает сервер
+        self.received = self.sent = 0  # байт
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self._writer: asyncio.StreamWriter | None = None
+        self._thread: threading.Thread | None = None
+
+    async def connect(self, host: str, port: int) -> None:
+        self.loop = asyncio.get_running_loop()
+        reader, self._writer = await asyncio.open_connection(host, port)
+        kind, payload = await read_message(reader)
+        if kind != HELLO:
+            raise ProtocolError(f"Expected HELLO, got message type {kind}")
+        self.received += FRAME.size + len(payload)
+        self.spawn = decode_hello(payload)
+        self.loop.create_task(self._receive(reader))
+
+    async def _receive(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                kind, payload = await read_message(reader)
+                self.received += FRAME.size + len(payload)
+                self.inbox.put((kind, payload))
+        except (asyncio.IncompleteReadError, ConnectionError, ProtocolError):
+            pass
+        finally:
+            self.inbox.put((CLOSED, b''))
+
+    def start(self, host: str, port: int) -> None:
+        """ подключается к серверу и ведёт соединение в отдельном потоке """
+        loop = self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=loop.run_forever, name="WorldClient", daemon=True)
+        self._thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self.connect(host, port), loop).result(CONNECT_TIMEOUT)
+        except BaseException:
+            self.close()
+            raise
+
+    def send(self, data: bytes) -> None:
+        self.sent += len(data)
+        self.loop.call_soon_threadsafe(self._writer.write, data)
+
+    def messages(self) -> list[tuple[int, bytes]]:
+        """ все сообщения, пришедшие с прошлого вызова """
+        result = []
+        try:
+            while True:
+                result.append(self.inbox.get_nowait())
+        except Empty:
+            return result
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self.loop.call_soon_threadsafe(self._writer.close)
+            self._writer = None
+        if self._thread is not None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+
+
+class RemoteSource:
+    """ Источник чанков для VoxelGrid клиента: чанка, которого ещё нет, в источнике нет,
+    но обращение к нему ставит чанк в запрос к серверу. Пришедший чанк кладётся прямо в VoxelGrid """
+
+    def __init__(self, client: WorldClient) -> None:
+        self.client = client
+        self.requested: ChunkKeys = set()  # запрошенные и полученные чанки, на изменения которых клиент подписан
+        self._pending: list[ChunkKey] = []
+
+    def __contains__(self, key: ChunkKey) -> bool:
+        if key not in self.requested:
+            self.requested.add(key)
+            self._pending.append(key)
+        return False
+
+    def __iter__(self): return iter(())
+
+    def read_chunk(self, key: ChunkKey) -> np.ndarray: raise KeyError(key)
+
+    def flush(self) -> None:
+        """ отправляет запрос чанков, к которым обращались с прошлого раза """
+        if self._pending:
+            self.client.send(encode_keys(REQUEST, self._pending))
+            self._pending = []
+
+    def forget(self, keys: ChunkKeys) -> None:
+        """ отписывается от чанков, которые выгружены с клиента """
+        keys = keys & self.requested
+        if keys:
+            self.requested -= keys
+            self._pending = [key for key in self._pending if key not in keys]
+            self.client.send(encode_keys(FORGET, keys))
+
+
+def apply_message(voxels: VoxelGrid, source: RemoteSource, kind: int, payload: bytes) -> ChunkKeys:
+    """ применяет сообщение сервера к карте клиента, возвращает чанки, сетку которых нужно перестроить.
+    Изменения чанков, на которые клиент не подписан, пропускаются: свежий чанк придёт по запросу целиком """
+    touched = set()
+    if kind == CHUNK:
+        key, blocks = decode_chunk_message(payload)
+        if key in source.requested and blocks is not None:
+            voxels.chunks[key] = Chunk(blocks=blocks)
+            touched |= chunks_touching(key[0] * CHUNK_SIZE, key[1] * CHUNK_SIZE)
+            touched |= chunks_touching((key[0] + 1) * CHUNK_SIZE - 1, (key[1] + 1) * CHUNK_SIZE - 1)
+    elif kind == BLOCKS:
+        positions, values = decode_blocks(payload)
+        for (x, y, z), value in zip(positions.tolist(), values.tolist()):
+            if chunk_key(x, y) in source.requested:
+                voxels.set(x, y, z, value)
+                touched |= chunks_touching(x, y)
+    elif kind == BOX:
+        origin, values, mask = decode_box(payload)
+        # сервер присылает правки области по частям, каждая - внутри одного чанка
+        if chunk_key(origin[0], origin[1]) in source.requested:
+            touched |= voxels.write_box(origin, values, mask)
+    return touched
+
+
+class Bot:
+    """ Игрок без окна: держит чанки вокруг себя и ставит и удаляет блоки """
+
+    def __init__(self, number: int, radius: int) -> None:
+        self.number = number
+        self.radius = radius
+        self.client = WorldClient()
+        self.voxels = VoxelGrid()
+        self.source = RemoteSource(self.client)
+        self.voxels.attach(self.source)
+        self.latencies: list[float] = []  # от отправки правки до её возвращения от сервера, секунд
+        self._sent: dict[Position, float] = {}
+
+    async def run(self, host: str, port: int, edits: int, period: float) -> None:
+        await self.client.connect(host, port)
+        x, y, _ = self.client.spawn
+        cx, cy = chunk_key(x, y)
+        for key in [(cx + dx, cy + dy) for dx in range(-self.radius, self.radius + 1)
+                    for dy in range(-self.radius, self.radius + 1)]:
+            self.voxels.has_chunk(key)
+        self.source.flush()
+        rng = random.Random(self.number)
+        # все боты строят на одном участке, чтобы их правки пересекались
+        area = (self.radius * 2 + 1) * CHUNK_SIZE
+        left, bottom = (cx - self.radius) * CHUNK_SIZE, (cy - self.radius) * CHUNK_SIZE
+        for _ in range(edits):
+            await asyncio.sleep(period)
+            self.receive()
+            position = Position(left + rng.randrange(area), bottom + rng.randrange(area), rng.randrange(1, 40))
+            value = rng.randrange(0, 5)
+            self._sent[position] = time.perf_counter()
+            self.client.send(encode_set(position, value))
+        # дожидаемся, пока сервер разошлёт все правки
+        while await self._busy():
+            self.receive()
+
+    async def _busy(self) -> bool:
+        """ пришло ли что-нибудь от сервера за секунду """
+        for _ in range(20):
+            await asyncio.sleep(0.05)
+            if not self.client.inbox.empty():
+                return True
+        return False
+
+    def receive(self) -> None:
+        now = time.perf_counter()
+        for kind, payload in self.client.messages():
+            if kind == BLOCKS:
+                positions, _ = decode_blocks(payload)
+                for position in positions.tolist():
+                    sent = self._sent.pop(Position(*position), None)
+                    if sent is not None:
+                        self.latencies.append(now - sent)
+            if kind != CLOSED:
+                apply_message(self.voxels, self.source, kind, payload)
+        self.source.flush()
+
+
+async def run_bots(address: str, count: int, edits: int, rate: float, radius: int) -> dict:
+    host, port = parse_address(address)
+    bots = [Bot(number, radius) for number in range(count)]
+    start = time.perf_counter()
+    await asyncio.gather(*(bot.run(host, port, edits, 1 / rate) for bot in bots))
+    wall = time.perf_counter() - start
+    # у всех ботов одни и те же чанки, после всех правок они должны совпасть
+    reference = bots[0].voxels.chunks
+    consistent = all(set(bot.voxels.chunks) == set(reference) and all(
+        np.array_equal(chunk.blocks[:, :, :reference[key].height], reference[key].blocks[:, :, :chunk.height])
+        for key, chunk in bot.voxels.chunks.items()) for bot in bots[1:])
+    latencies = np.array([value for bot in bots for value in bot.latencies]) * 1000
+    for bot in bots:
+        bot.client.close()
+    return {
+        'bots': count, 'edits_per_bot': edits, 'wall_s': wall, 'consistent': consistent,
+        'chunks_per_bot': len(reference),
+        'received_bytes_per_bot': int(np.mean([bot.client.received for bot in bots])),
+        'sent_bytes_per_bot': int(np.mean([bot.client.sent for bot in bots])),
+        'edit_echo_ms': {f"p{p}": float(np.percentile(latencies, p)) for p in (50, 90, 99)} if len(latencies) else None,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('address', nargs='?', default=f"{SERVER_HOST}:{SERVER_PORT}", help="хост:порт сервера")
+    parser.add_argument('--bots', type=int, default=4, help="сколько ботов подключить")
+    parser.add_argument('--edits', type=int, default=500, help="сколько правок делает каждый бот")
+    parser.add_argument('--rate', type=float, default=100, help="правок в секунду у каждого бота")
+    parser.add_argument('--radius', type=int, default=2, help="сколько чанков вокруг себя держит бот")
+    args = parser.parse_args()
+    try:
+        result = asyncio.run(run_bots(args.address, args.bots, args.edits, args.rate, args.radius))
+    except OSError as err:
+        sys.exit(f"Could not connect to {args.address}: {err}")
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
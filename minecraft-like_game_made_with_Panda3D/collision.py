@@ -0,0 +1,44 @@
+""" Столкновения тела-параллелепипеда (AABB) с блоками карты.
+
+Клетка (x, y, z) занимает куб [x - 0.5, x + 0.5) по каждой оси. Тело сдвигается по одной оси
+за раз, и проверяются только клетки, через которые проходит его передняя грань, поэтому
+работа зависит от размера тела и длины сдвига, а не от размера мира """
+import math
+from typing import Callable
+
+
+EPSILON = 1e-6  # касание грани блока - ещё не столкновение
+
+# занята ли клетка (x, y, z)
+Solid = Callable[[int, int, int], bool]
+
+
+def cells(low: float, high: float) -> range:
+    """ номера клеток, в которые заходит отрезок [low, high] по одной оси """
+    return range(math.floor(low + 0.5 + EPSILON), math.floor(high + 0.5 - EPSILON) + 1)
+
+
+def sweep(solid: Solid, low: list[float], high: list[float], axis: int, delta: float) -> float:
+    """ на сколько тело [low, high] может сдвинуться по оси axis: delta, если по пути нет блоков,
+    иначе до грани первого блока """
+    if not delta:
+        return 0.0
+    a, b = (axis + 1) % 3, (axis + 2) % 3
+    across = [(i, j) for i in cells(low[a], high[a]) for j in cells(low[b], high[b])]
+    if delta > 0:
+        layers = range(math.floor(high[axis] + 0.5 - EPSILON) + 1, math.floor(high[axis] + delta + 0.5 - EPSILON) + 1)
+    else:
+        layers = range(math.floor(low[axis] + 0.5 + EPSILON) - 1, math.floor(low[axis] + delta + 0.5 + EPSILON) - 1, -1)
+    cell = [0, 0, 0]
+    for k in layers:
+        cell[axis] = k
+        for cell[a], cell[b] in across:
+            if solid(*cell):
+                return max(k - 0.5 - high[axis], 0.0) if delta > 0 else min(k + 0.5 - low[axis], 0.0)
+    return delta
+
+
+def overlaps(solid: Solid, low: list[float], high: list[float]) -> bool:
+    """ заходит ли тело в какой-нибудь блок """
+    return any(solid(x, y, z) for x in cells(low[0], high[0]) for y in cells(low[1], high[1])
+               for z in cells(low[2], high[2]))
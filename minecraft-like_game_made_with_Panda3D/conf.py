@@ -1,37 +1,114 @@
 KEY_SWITCH_CAMERA = 'f4'  # привязка камеры к герою по нажатию клавиши
 KEY_SWITCH_MODE = 'f3'  # отключение столкновения с объектами
 
-KEY_MOVE_BACK = 'w'  # шаг вперёд ( по направлению камеры)
-KEY_MOVE_FORWARD = 's'  # шаг назад
-KEY_MOVE_LEFT = 'a'  # шаг влево (вбок по направлению камеры)
-KEY_MOVE_RIGHT = 'd'  # шаг вправо
-KEY_MOVE_UP = 'arrow_up'  # шаг вверх
-KEY_MOVE_DOWN = 'arrow_down'  # шаг вниз
+KEY_MOVE_BACK = 'w'  # идти вперёд ( по направлению камеры), пока клавиша зажата
+KEY_MOVE_FORWARD = 's'  # идти назад
+KEY_MOVE_LEFT = 'a'  # идти влево (вбок по направлению камеры)
+KEY_MOVE_RIGHT = 'd'  # идти вправо
+KEY_MOVE_UP = 'arrow_up'  # вверх, в режиме прохождения сквозь объекты
+KEY_MOVE_DOWN = 'arrow_down'  # вниз, там же
 
 KEY_TURN_LEFT = 'q'  # поворот камеры направо (мира - налево)
 KEY_TURN_RIGHT = 'e'  # поворот камеры налево (мира - направо)
 
 KEY_BUILD_BLOCK = 'mouse3'  # построить блок перед собой
 KEY_DESTROY_BLOCK = 'mouse1'  # разрушить блок перед собой
+KEY_NEXT_BLOCK = 'r'  # выбрать следующий тип блока для строительства
+
+KEY_SELECT_CORNER = 'b'  # отметить клетку перед собой углом выделения (помнятся два последних угла)
+KEY_FILL_SELECTION = 'f'  # заполнить выделение блоками
+KEY_CLEAR_SELECTION = 'x'  # удалить все блоки в выделении
+KEY_COPY_SELECTION = 'c'  # скопировать выделение
+KEY_PASTE = 'v'  # вставить скопированное нижним углом в клетку перед собой
+KEY_FILL_SPHERE = 'g'  # построить шар с центром в клетке перед собой
+SPHERE_RADIUS = 4
+
+KEY_UNDO = 'z'  # отменить последнюю правку карты
+KEY_REDO = 'y'  # повторить отменённую правку
 
 KEY_SAVE_MAP = 'f5'
 KEY_LOAD_MAP = 'f9'
+KEY_DUMP_TRACE = 'f2'  # записать временную шкалу последних кадров, если включён PROFILE
 
 PATH_LAND = "data/land.txt"
-PATH_BASE_BLOCK = 'assets/models/block'
-PATH_BASE_TEXTURE = 'assets/textures/block.png'
-PATH_MAP = 'data/map.dat'
+PATH_BASE_TEXTURE = 'assets/textures/block.png'  # текстура блоков, у которых нет своей
+# свои текстуры типов блоков: <название>.png или <название>_top.png, _side.png, _bottom.png, см. atlas.py
+PATH_BLOCK_TEXTURES = 'assets/textures/blocks'
+PATH_ATLAS_CACHE = 'data/atlas'  # каталог собранных атласов текстур блоков
+ATLAS_TILE = 64  # размер текстуры одного блока в атласе, пикселей
+PATH_MAP = 'data/map.dat'  # карта прежних версий, импортируется в PATH_WORLD при первой загрузке
+PATH_WORLD = 'data/world'  # каталог с файлами регионов карты
+MAP_COMPRESSION = True  # сжимать чанки в файле карты zlib
+REGION_SIZE = 32  # сколько чанков по X и Y хранится в одном файле региона
+UNDO_LIMIT = 256  # сколько последних правок карты можно отменить
+JOURNAL_SYNC = False  # сбрасывать журнал правок на диск после каждой правки: переживёт и отключение питания
+JOURNAL_COMPACT_SIZE = 2 ** 20  # журнал больше этого размера в байтах сам сохраняется в карту
+
+CHUNK_SIZE = 16  # размер чанка карты по X и Y
+CHUNK_HEIGHT = 16  # шаг, с которым растёт высота чанка
+# сливать соседние грани одного типа в сетке чанка; текстура на слитой грани повторяется шейдером по клеткам,
+# без поддержки шейдеров грани не сливаются
+GREEDY_MESHING = False
+MESH_BUDGET = 0.008  # сколько секунд за кадр можно тратить на перестройку сеток чанков
+MESH_WORKERS = None  # сколько процессов строят сетки чанков: None - по числу ядер без одного, 0 - в основном потоке
+PATH_MESH_CACHE = 'data/meshes'  # каталог готовых сеток чанков, None - строить сетки всегда заново
+MESH_CACHE_SIZE = 512 * 1024 * 1024  # байт, сверх этого удаляются сетки, которые дольше всех не были нужны
+VIEW_RADIUS = 6  # сколько чанков вокруг героя показывать и держать в памяти
+LOD_RADIUS = 3  # дальше скольких чанков от героя карта рисуется грубыми сетками по верхним блокам
+LOD_TILE = 4  # грубая сетка строится одна на квадрат LOD_TILE x LOD_TILE чанков
+LOD_STEP = 2  # сколько столбцов по X и по Y сливается в одну клетку грубой сетки
+CHUNK_CACHE_SIZE = 256  # сколько недавно выгруженных чанков держать в памяти
+
+TERRAIN_SEED = None  # если задан, мир строится генератором рельефа, а не из PATH_LAND
+TERRAIN_SCALE = 96  # размер самых крупных холмов генератора в клетках
+TERRAIN_OCTAVES = 4  # сколько слоёв всё более мелкого шума складывать
+TERRAIN_BASE = 2  # высота самых низких мест
+TERRAIN_RELIEF = 24  # разница высот между низинами и вершинами
+
+SERVER_ADDRESS = None  # 'хост:порт' сервера мира (server.py), если играть не на своей карте, а на общей
+SERVER_HOST = '127.0.0.1'  # на каком адресе сервер мира принимает клиентов
+SERVER_PORT = 25570
+SERVER_TICK = 0.05  # как часто сервер рассылает накопленные изменения блоков, секунд
+SERVER_SAVE_PERIOD = 60  # как часто сервер сохраняет карту, секунд
+
+PROFILE = False  # замерять задачи и обработчики событий, показывать время кадра на экране
+PROFILE_PSTATS = False  # при PROFILE ещё и подключиться к серверу PStats
+PROFILE_FRAMES = 1000  # сколько последних кадров помнить
+PROFILE_SPANS = 100_000  # сколько последних замеров задач и событий помнить для временной шкалы
 
 PLAYER_COLOR = (1, 0.5, 0)
 PLAYER_SCALE = 0.3
 PLAYER_HORIZONTAL_POSITION = 180
-PLAYER_TURN_DEGREE = 5
+PLAYER_TURN_SPEED = 120  # градусов в секунду
+PLAYER_SPEED = 4.5  # блоков в секунду
+PLAYER_WIDTH = 0.6  # размеры тела героя для столкновений, в блоках
+PLAYER_HEIGHT = 0.9  # ниже блока: герой пролезает в проём высотой в один блок
+PLAYER_STEP = 1  # на какую высоту герой сам забирается на ходу
+PLAYER_GRAVITY = 30  # блоков в секунду за секунду
+PLAYER_FALL_SPEED = 40  # быстрее герой не падает, блоков в секунду
+PLAYER_MAX_DT = 0.1  # после долгого кадра (загрузка карты) герой сдвигается не дальше, чем за этот, секунд
+PLAYER_REACH = 8  # как далеко герой может строить и разрушать блоки под прицелом
 
 CAMERA_START_POSITION = (0, 0, 1.5)
 
-BLOCK_COLORS = [
-            (0.2, 0.2, 0.35, 1),
-            (0.2, 0.5, 0.2, 1),
-            (0.7, 0.2, 0.2, 1),
-            (0.5, 0.3, 0.0, 1)
+# типы блоков: название, цвет RGBA, уровень света, который блок излучает (0 - не светится, до 15),
+# и как блок движется: None - стоит на месте, 'fall' - падает, как песок, 'flow' - ещё и стекает с уступов, как вода;
+# номер типа в клетке карты - место в списке
+BLOCK_TYPES = [
+            ('air', (0, 0, 0, 0), 0, None),
+            ('stone', (0.2, 0.2, 0.35, 1), 0, None),
+            ('grass', (0.2, 0.5, 0.2, 1), 0, None),
+            ('brick', (0.7, 0.2, 0.2, 1), 0, None),
+            ('dirt', (0.5, 0.3, 0.0, 1), 0, None),
+            ('lamp', (1.0, 0.85, 0.5, 1), 15, None),
+            ('sand', (0.85, 0.75, 0.45, 1), 0, 'fall'),
+            ('water', (0.2, 0.35, 0.8, 1), 0, 'flow')
         ]
+BLOCK_SHADE = 0.2  # насколько блоки одного типа различаются по яркости
+
+PHYSICS_TICK = 0.05  # как часто сдвигаются падающие и текущие блоки, секунд
+PHYSICS_BUDGET = 0.004  # сколько секунд такта можно на них тратить, остальные блоки сдвинутся на следующем такте
+
+LIGHTING = True  # запекать в цвета вершин свет неба и светящихся блоков
+LIGHT_FALLOFF = 0.8  # во сколько раз темнеет блок с каждой ступенью света
+LIGHT_MIN = 0.1  # яркость блоков в полной темноте
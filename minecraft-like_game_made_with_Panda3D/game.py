@@ -3,16 +3,35 @@ from direct.showbase.ShowBase import ShowBase
 
 from mapmanager import Mapmanager
 from player import Player, Position
-from conf import PATH_LAND
+from conf import PATH_LAND, TERRAIN_SEED, PROFILE, SERVER_ADDRESS
+from journal import JOURNAL_FILE, has_edits
+from landfile import print_progress
 from camera import CameraControllerBehaviour
 
 
 class Game(ShowBase):
     def __init__(self):
         ShowBase.__init__(self)
+        if PROFILE:
+            from profiler import FrameProfiler
+            self.profiler = FrameProfiler(self)
         self.land = Mapmanager()
-        x, y, _ = self.land.load_land(PATH_LAND)
-        self.player = Player(Position(x // 2, y // 2, 2), self.land)
+        if PROFILE:
+            self.profiler.land = self.land
+        if SERVER_ADDRESS is not None:
+            # общая карта на сервере мира (server.py)
+            self.player = Player(self.land.connect(SERVER_ADDRESS), self.land)
+        elif has_edits(self.land.world / JOURNAL_FILE):
+            # в журнале остались правки, не сохранённые до выхода из игры, - сразу загружаем сохранённую
+            # карту вместе с ними, новая карта всё равно была бы выброшена
+            self.land.load_map()
+            self.player = Player(self.land.find_highest_empty(Position(0, 0, 0)), self.land)
+        elif TERRAIN_SEED is None:
+            x, y, _ = self.land.load_land(PATH_LAND, print_progress)
+            self.player = Player(Position(x // 2, y // 2, 2), self.land)
+        else:
+            self.player = Player(self.land.generate_land(TERRAIN_SEED), self.land)
+        self.land.follow(self.player.hero)
         self.camLens.setFov(90)
         # cam_controller = CameraControllerBehaviour(self.camera)
         # cam_controller.setMouseSensivity(0.9)
@@ -0,0 +1,247 @@
+""" Журнал правок карты: каждая правка дописывается в конец файла journal.vxj в каталоге мира,
+так что правки после последнего сохранения переживают аварийный выход из игры.
+Журнал - только правки поверх снимка карты, поэтому защищает он лишь карту, сохранённую хотя бы
+раз. Правки новой карты из карты высот или генератора рельефа до первого сохранения лежат в памяти
+и при аварийном выходе пропадают: сам записать снимок журнал не может, он заменил бы в каталоге мира
+карту, сохранённую раньше.
+
+    заголовок: magic 'VXJL' | версия u16
+    правка блока: вид u8 | x i32 | y i32 | z i32 | было u8 | стало u8 | crc32 u32
+    правка области: вид u8 | x i32 | y i32 | z i32 | размеры u16 x 3 | длина u32
+                    | zlib(было + стало) | crc32 u32
+
+В записи лежат значения клеток до и после правки, поэтому по журналу можно и повторить
+правку, и отменить её. Отмена и повтор тоже пишутся в журнал (вид записи говорит, что это было),
+так что после загрузки карты стек отмены восстанавливается вместе с правками.
+Сдвиги падающих блоков (physics.py) пишутся своим видом записи: при загрузке они повторяются,
+но в стек отмены не попадают.
+
+Все записи задают значения клеток, а не их изменение, поэтому журнал можно без вреда
+наложить на карту, в которую часть его правок уже сохранена. После сохранения карты
+записи до снимка выбрасываются. Запись, оборванная на середине, отбрасывается при чтении """
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+
+from blocks import TYPES
+from conf import UNDO_LIMIT, JOURNAL_SYNC
+from mapfile import MapFormatError
+from type_hints import Position
+
+
+MAGIC = b'VXJL'
+VERSION = 2  # во 2-й версии появился вид записи MOVE, журналы 1-й читаются как есть
+JOURNAL_FILE = 'journal.vxj'
+
+HEADER = struct.Struct('<4sH')
+BLOCK = struct.Struct('<BiiiBB')
+BOX = struct.Struct('<BiiiHHHI')
+CRC = struct.Struct('<I')
+
+# вид записи: правка, её отмена или повтор, сдвиг блока физикой, и флаг записи области
+EDIT, UNDO, REDO, MOVE = 0, 1, 2, 3
+KIND_BOX = 4
+
+
+class Edit(NamedTuple):
+    origin: Position  # нижний угол области
+    old: np.ndarray  # значения клеток до правки, массив (X, Y, Z)
+    new: np.ndarray  # значения клеток после правки
+
+
+def encode(kind: int, edit: Edit) -> bytes:
+    x, y, z = edit.origin
+    if edit.new.shape == (1, 1, 1):
+        record = BLOCK.pack(kind, x, y, z, edit.old.item(0), edit.new.item(0))
+    else:
+        data = zlib.compress(np.ascontiguousarray(edit.old).tobytes() + np.ascontiguousarray(edit.new).tobytes())
+        record = BOX.pack(kind | KIND_BOX, x, y, z, *edit.new.shape, len(data)) + data
+    return record + CRC.pack(zlib.crc32(record))
+
+
+def decode(data: bytes, offset: int) -> tuple[int, Edit, int] | None:
+    """ запись журнала с позиции offset: вид, правка и позиция следующей записи.
+    None - запись оборвана или повреждена, в том числе задаёт неизвестный тип блока """
+    if offset >= len(data):
+        return None
+    if data[offset] & KIND_BOX:
+        if offset + BOX.size > len(data):
+            return None
+        kind, x, y, z, width, depth, height, length = BOX.unpack_from(data, offset)
+        end = offset + BOX.size + length
+    else:
+        if offset + BLOCK.size > len(data):
+            return None
+        kind, x, y, z, old, new = BLOCK.unpack_from(data, offset)
+        width = depth = height = 1
+        end = offset + BLOCK.size
+    if kind & ~KIND_BOX > MOVE or end + CRC.size > len(data):
+        return None
+    if CRC.unpack_from(data, end)[0] != zlib.crc32(data[offset:end]):
+        return None
+    shape = (width, depth, height)
+    if kind & KIND_BOX:
+        try:
+            cells = np.frombuffer(zlib.decompress(data[offset + BOX.size:end]), dtype=np.uint8)
+        except zlib.error:
+            return None
+        if cells.size != 2 * width * depth * height:
+            return None
+        old, new = cells[:cells.size // 2].reshape(shape), cells[cells.size // 2:].reshape(shape)
+    else:
+        old, new = np.full(shape, old, dtype=np.uint8), np.full(shape, new, dtype=np.uint8)
+    if max(old.max(), new.max()) >= len(TYPES):
+        return None
+    return kind & ~KIND_BOX, Edit(Position(x, y, z), old, new), end + CRC.size
+
+
+def has_edits(path: Path) -> bool:
+    """ есть ли в файле журнала правки, ещё не сохранённые в карту """
+    path = Path(path)
+    return path.exists() and path.stat().st_size > HEADER.size
+
+
+class EditJournal:
+    """ Журнал правок открытой карты и стеки отмены и повтора.
+    Пока карта ни разу не сохранена, писать журнал некуда, и записи копятся в памяти,
+    а после первого сохранения переносятся в файл в каталоге мира. До этого аварийный выход
+    их не переживает """
+
+    def __init__(self, limit: int = UNDO_LIMIT) -> None:
+        self.limit = limit  # сколько последних правок можно отменить
+        self.persistent = True  # писать ли записи: игре на сервере мира журнал нужен только для отмены
+        self.path: Path | None = None
+        self._file = None
+        self._buffer = bytearray()  # записи, пока файла нет
+        self._size = 0  # байт записей в файле или в буфере
+        self._undo: list[Edit] = []
+        self._redo: list[Edit] = []
+
+    @property
+    def size(self) -> int: return self._size
+
+    @property
+    def attached(self) -> bool: return self._file is not None
+
+    def close(self) -> None:
+        """ забывает правки текущей карты: файл остаётся на диске, стеки и буфер очищаются """
+        if self._file is not None:
+            self._file.close()
+        self.path = self._file = None
+        self._buffer.clear()
+        self._size = 0
+        self._undo.clear()
+        self._redo.clear()
+
+    def open(self, path: Path) -> list[Edit]:
+        """ начинает журнал карты, сохранённой в каталоге мира. Возвращает правки, которые уже
+        записаны в файл журнала и которые нужно наложить на карту по порядку """
+        self.close()
+        path = Path(path)
+        data = path.read_bytes() if path.exists() else b''
+        header = HEADER.pack(MAGIC, VERSION)
+        magic, version = HEADER.unpack_from(data) if len(data) >= HEADER.size else (b'', 0)
+        if data and (magic != MAGIC or not 1 <= version <= VERSION):
+            raise MapFormatError(f"Not an edit journal: {path}")
+        edits, offset = [], HEADER.size
+        while (record := decode(data, offset)) is not None:
+            kind, edit, offset = record
+            self._track(kind, edit)
+            edits.append(edit)
+        if data and offset < len(data):
+            print(f"Edit journal {path} ends with a broken record, {len(data) - offset} bytes dropped")
+        self._write_file(path, header + data[HEADER.size:offset])
+        return edits
+
+    def _write_file(self, path: Path, data: bytes) -> None:
+        """ записывает файл журнала целиком через временный файл и открывает его на дозапись """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp = path.with_suffix('.tmp')
+        with open(temp, 'wb') as fout:
+            fout.write(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.replace(temp, path)
+        if self._file is not None:
+            self._file.close()
+        self.path = path
+        self._file = open(path, 'a+b')  # дописывается всегда в конец, читать можно откуда угодно
+        self._size = len(data) - HEADER.size
+
+    def _track(self, kind: int, edit: Edit) -> None:
+        """ ведёт стеки отмены и повтора так же, как при самой правке """
+        if kind == EDIT:
+            self._undo.append(edit)
+            del self._undo[:-self.limit]
+            self._redo.clear()
+        elif kind == UNDO and self._undo:
+            self._redo.append(self._undo.pop())
+        elif kind == REDO and self._redo:
+            self._undo.append(self._redo.pop())
+
+    def _append(self, kind: int, edit: Edit) -> None:
+        if self.persistent:
+            self._write(encode(kind, edit))
+
+    def _write(self, record: bytes) -> None:
+        self._size += len(record)
+        if self._file is None:
+            self._buffer += record
+            return
+        self._file.write(record)
+        self._file.flush()
+        if JOURNAL_SYNC:
+            os.fsync(self._file.fileno())
+
+    def record(self, origin: Position, old: np.ndarray, new: np.ndarray) -> None:
+        """ записывает правку: значения клеток области до и после неё. Правки без изменений не пишутся """
+        if old.item(0) == new.item(0) if old.size == 1 else np.array_equal(old, new):
+            return
+        edit = Edit(origin, old, new)
+        self._track(EDIT, edit)
+        self._append(EDIT, edit)
+
+    def record_moves(self, changes: list[tuple[Position, int, int]]) -> None:
+        """ записывает изменения клеток от падающих блоков: (позиция, было, стало) по порядку.
+        Отменить их нельзя, зато после аварийного выхода блоки окажутся там, куда успели упасть """
+        if self.persistent and changes:
+            self._write(b''.join(encode(MOVE, Edit(position, np.array([[[old]]], dtype=np.uint8),
+                                                   np.array([[[new]]], dtype=np.uint8)))
+                                 for position, old, new in changes))
+
+    def undo(self) -> Edit | None:
+        """ последняя правка, которую нужно отменить (вернуть клетки к edit.old), или None """
+        if not self._undo:
+            return None
+        edit = self._undo[-1]
+        self._track(UNDO, edit)
+        self._append(UNDO, Edit(edit.origin, edit.new, edit.old))
+        return edit
+
+    def redo(self) -> Edit | None:
+        """ последняя отменённая правка, которую нужно повторить (вернуть клетки к edit.new), или None """
+        if not self._redo:
+            return None
+        edit = self._redo[-1]
+        self._track(REDO, edit)
+        self._append(REDO, edit)
+        return edit
+
+    def mark(self) -> int:
+        """ место в журнале, до которого правки попадут в снимок карты """
+        return self._size
+
+    def saved(self, mark: int, path: Path) -> None:
+        """ снимок карты до mark записан в каталог мира: записи до mark больше не нужны,
+        а журнал дальше пишется в файл path """
+        if self._file is None:
+            tail = bytes(self._buffer[mark:])
+            self._buffer.clear()
+        else:
+            self._file.seek(HEADER.size + mark)
+            tail = self._file.read()
+        self._write_file(Path(path), HEADER.pack(MAGIC, VERSION) + tail)
@@ -0,0 +1,143 @@
+""" Чтение карты высот из текстового файла: строка файла - ряд по Y, число - высота столбца по X.
+
+Файл разбирается полосами по несколько мегабайт целиком средствами NumPy, большие файлы
+отображаются в память, так что время чтения растёт линейно с размером файла """
+import os
+from pathlib import Path
+from collections.abc import Iterator
+from typing import Callable
+
+import numpy as np
+
+from blocks import layers
+from conf import CHUNK_SIZE, CHUNK_HEIGHT
+from voxels import ChunkKey
+
+
+BAND_BYTES = 8 * 2 ** 20  # размер полосы файла, разбираемой за один раз
+MMAP_BYTES = 64 * 2 ** 20  # файлы больше этого размера отображаются в память
+MAX_DIGITS = 4  # высота столбца не больше 9999
+
+NO_COLUMN = -1  # клетка карты высот без столбца (короткая строка файла)
+
+DIGIT_0, DIGIT_9 = ord('0'), ord('9')
+NEWLINE = ord('\n')
+SPACES = (ord(' '), ord('\t'), ord('\r'))
+
+Progress = Callable[[str, int, int], None]  # (этап, сделано, всего)
+
+
+class HeightmapSource:
+    """ Карта высот как источник чанков для VoxelGrid: чанк строится из столбцов (трава, земля,
+    камень), когда понадобится, поэтому нетронутые чанки можно выгружать из памяти так же,
+    как прочитанные с диска. При сохранении мира его чанки переписываются в файлы регионов """
+
+    def __init__(self, heights: np.ndarray) -> None:
+        width, depth = heights.shape
+        # по краю карты столбцы дополнены до целых чанков пустыми
+        self.columns = np.full((-(-width // CHUNK_SIZE) * CHUNK_SIZE, -(-depth // CHUNK_SIZE) * CHUNK_SIZE),
+                               NO_COLUMN, dtype=np.int32)
+        self.columns[:width, :depth] = heights
+        rows, cols = self.columns.shape[0] // CHUNK_SIZE, self.columns.shape[1] // CHUNK_SIZE
+        tops = self.columns.reshape(rows, CHUNK_SIZE, cols, CHUNK_SIZE).max(axis=(1, 3))
+        # чанки, в которых есть хотя бы один столбец
+        self._keys = {(cx, cy) for cx, cy in np.argwhere(tops > NO_COLUMN).tolist()}
+
+    def __contains__(self, key: ChunkKey) -> bool: return key in self._keys
+
+    def __iter__(self) -> Iterator[ChunkKey]: return iter(sorted(self._keys))
+
+    def read_chunk(self, key: ChunkKey) -> np.ndarray:
+        cx, cy = key
+        part = self.columns[cx * CHUNK_SIZE:(cx + 1) * CHUNK_SIZE, cy * CHUNK_SIZE:(cy + 1) * CHUNK_SIZE]
+        height = (int(part.max()) // CHUNK_HEIGHT + 1) * CHUNK_HEIGHT
+        return layers(part[:, :, None] - np.arange(height, dtype=np.int32))
+
+
+class LandFormatError(ValueError):
+    """ ошибка в файле карты высот с указанием строки и столбца (считая с 1) """
+
+    def __init__(self, path: Path, line: int, column: int, message: str) -> None:
+        super().__init__(f"{path}:{line}:{column}: {message}")
+        self.path = path
+        self.line = line
+        self.column = column
+
+
+def print_progress(stage: str, done: int, total: int) -> None:
+    print(f"\r{stage}: {done * 100 // max(total, 1):3d}%", end='\n' if done >= total else '', flush=True)
+
+
+def _line_end(data: np.ndarray, position: int) -> int:
+    """ позиция сразу за концом строки, в которой лежит байт position """
+    window = 2 ** 16
+    while position < len(data):
+        newlines = np.flatnonzero(data[position:position + window] == NEWLINE)
+        if len(newlines):
+            return position + int(newlines[0]) + 1
+        position += window
+    return len(data)
+
+
+def _parse_band(band: np.ndarray, path: Path, first_line: int) -> np.ndarray:
+    """ разбирает полосу целых строк файла, возвращает высоты (столбец, строка) """
+    digit = (band >= DIGIT_0) & (band <= DIGIT_9)
+    newline = band == NEWLINE
+    bad = ~(digit | newline | np.isin(band, SPACES))
+    line_of = np.cumsum(newline) - newline  # номер строки полосы для каждого байта
+    line_start = np.flatnonzero(np.concatenate(([True], newline[:-1])))
+    if bad.any():
+        at = int(np.argmax(bad))
+        raise LandFormatError(path, first_line + int(line_of[at]) + 1, at - int(line_start[line_of[at]]) + 1,
+                              f"unexpected character {chr(band[at])!r}, expected a column height")
+
+    before = np.concatenate(([False], digit[:-1]))
+    after = np.concatenate((digit[1:], [False]))
+    starts = np.flatnonzero(digit & ~before)
+    lengths = np.flatnonzero(digit & ~after) + 1 - starts
+    if len(lengths) and lengths.max() > MAX_DIGITS:
+        at = int(starts[np.argmax(lengths > MAX_DIGITS)])
+        raise LandFormatError(path, first_line + int(line_of[at]) + 1, at - int(line_start[line_of[at]]) + 1,
+                              "column is too high")
+    values = np.zeros(len(starts), dtype=np.int16)
+    for k in range(int(lengths.max()) if len(lengths) else 0):
+        more = lengths > k
+        values[more] = values[more] * 10 + (band[starts[more] + k] - DIGIT_0)
+
+    rows = line_of[starts]
+    row_count = len(line_start)
+    per_row = np.bincount(rows, minlength=row_count)
+    columns = np.arange(len(starts)) - np.repeat(np.cumsum(per_row) - per_row, per_row)
+    heights = np.full((int(per_row.max()) if len(per_row) else 0, row_count), NO_COLUMN, dtype=np.int16)
+    heights[columns, rows] = values
+    return heights
+
+
+def read_heightmap(path: Path, progress: Progress | None = None) -> np.ndarray:
+    """ читает карту высот, массив (X, Y), NO_COLUMN там, где строка короче остальных """
+    size = os.path.getsize(path)
+    if size > MMAP_BYTES:
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+        data = np.fromfile(path, dtype=np.uint8)
+
+    bands = []
+    lines = 0
+    start = 0
+    while start < size:
+        # полоса заканчивается на конце строки
+        end = _line_end(data, start + BAND_BYTES) if start + BAND_BYTES < size else size
+        band = _parse_band(np.asarray(data[start:end]), path, lines)
+        bands.append(band)
+        lines += band.shape[1]
+        start = end
+        if progress is not None:
+            progress("Reading land", start, size)
+
+    width = max((band.shape[0] for band in bands), default=0)
+    heights = np.full((width, lines), NO_COLUMN, dtype=np.int16)
+    y = 0
+    for band in bands:
+        heights[:band.shape[0], y:y + band.shape[1]] = band
+        y += band.shape[1]
+    return heights
@@ -0,0 +1,154 @@
+""" Свет в клетках карты: от неба и от светящихся блоков, уровни от 0 до MAX_LIGHT.
+
+Свет не хранится в файлах карты, а считается по клеткам: для чанка целиком - когда строится его
+сетка, дальше после каждой правки пересчитывается только окрестность изменённых клеток.
+Свет в пустой клетке на ступень слабее, чем у самого светлого соседа, поэтому правка меняет его
+не дальше чем в REACH клетках по X и Y (а небо - ещё и во всём столбце под ней).
+Распространение - обход в ширину от источников: вся волна одной ступени обрабатывается за шаг в numpy.
+Уровни запекаются в цвета вершин сеток чанков (mesher.py), так что при отрисовке свет ничего не стоит """
+import numpy as np
+
+from blocks import TYPES, AIR
+from conf import CHUNK_SIZE, LIGHT_FALLOFF, LIGHT_MIN
+from type_hints import Position
+from voxels import VoxelGrid, ChunkKey, ChunkKeys
+
+
+MAX_LIGHT = 15
+REACH = MAX_LIGHT - 1  # дальше этого числа клеток свет источника не доходит
+# свет клетки упакован в байт: небо в старших 4 битах, светящиеся блоки - в младших
+SKY = MAX_LIGHT << 4  # свет клетки под открытым небом
+EMISSION = np.array([block.light for block in TYPES], dtype=np.uint8)
+# множитель яркости вершины по упакованному свету клетки перед гранью
+BRIGHTNESS = (LIGHT_MIN + (1 - LIGHT_MIN) * LIGHT_FALLOFF ** (
+        MAX_LIGHT - np.maximum(np.arange(256) >> 4, np.arange(256) & 15))).astype(np.float32)
+
+
+def solve(blocks: np.ndarray, border: np.ndarray | None = None) -> np.ndarray:
+    """ упакованный свет клеток области, над которой открытое небо.
+    :param blocks: клетки области от z=0
+    :param border: прежний свет той же области: клетки рамки толщиной в одну клетку по X и Y
+        берутся из него как есть. Без border за краем области темно """
+    transparent = blocks == AIR
+    # под открытым небом клетки, над которыми до верха области нет ни одного блока
+    sky = np.flip(np.logical_and.accumulate(np.flip(transparent, 2), axis=2), 2)
+    light = np.stack((np.where(sky, MAX_LIGHT, 0).astype(np.uint8), EMISSION[blocks]))
+    free = transparent  # клетки, куда свет приходит от соседей
+    if border is not None:
+        old = np.stack((border >> 4, border & 15))
+        free = transparent.copy()
+        for edge in (np.s_[[0, -1], :], np.s_[:, [0, -1]]):
+            free[edge] = False
+            light[(slice(None),) + edge] = old[(slice(None),) + edge]
+    if not light[1].any():
+        # светящихся блоков рядом нет, считаем только небо
+        light = light[:1]
+
+    around = np.empty_like(light)
+    for _ in range(REACH):
+        # самый светлый из шести соседей
+        around[:] = 0
+        around[:, 1:] = light[:, :-1]
+        np.maximum(around[:, :-1], light[:, 1:], out=around[:, :-1])
+        np.maximum(around[:, :, 1:], light[:, :, :-1], out=around[:, :, 1:])
+        np.maximum(around[:, :, :-1], light[:, :, 1:], out=around[:, :, :-1])
+        np.maximum(around[..., 1:], light[..., :-1], out=around[..., 1:])
+        np.maximum(around[..., :-1], light[..., 1:], out=around[..., :-1])
+        np.subtract(around, 1, out=around, where=around > 0)
+        brighter = free & (around > light)
+        if not brighter.any():
+            break
+        np.copyto(light, around, where=brighter)
+    return light[0] << 4 | light[1] if len(light) > 1 else light[0] << 4
+
+
+class LightMap:
+    """ Свет чанков VoxelGrid: упакованный байт на клетку, массивы той же формы, что клетки чанков.
+    Свет чанков, которых нет, - открытое небо """
+
+    def __init__(self, voxels: VoxelGrid) -> None:
+        self.voxels = voxels
+        self.chunks: dict[ChunkKey, np.ndarray] = {}
+
+    def clear(self) -> None:
+        self.chunks.clear()
+
+    def forget(self, key: ChunkKey) -> None:
+        """ свет чанка больше не нужен, при надобности он посчитается заново """
+        self.chunks.pop(key, None)
+
+    def _height(self, x: int, y: int, width: int, depth: int) -> int:
+        """ высота самого высокого чанка в области """
+        chunks = (self.voxels.chunk(key) for key, _, _ in self.voxels._box_parts(x, y, width, depth))
+        return max((chunk.height for chunk in chunks if chunk is not None), default=0)
+
+    def chunk(self, key: ChunkKey) -> np.ndarray | None:
+        """ свет чанка, в первый раз он считается целиком """
+        chunk = self.voxels.chunk(key)
+        if chunk is None:
+            return None
+        light = self.chunks.get(key)
+        if light is None or light.shape[2] != chunk.height:
+            # свет чанка зависит только от клеток не дальше REACH от него
+            x, y = key[0] * CHUNK_SIZE - REACH, key[1] * CHUNK_SIZE - REACH
+            size = CHUNK_SIZE + 2 * REACH
+            blocks = self.voxels.read_box(Position(x, y, 0), (size, size, self._height(x, y, size, size)))
+            light = solve(blocks)[REACH:-REACH, REACH:-REACH, :chunk.height].copy()
+            self.chunks[key] = light
+        return light
+
+    def read_box(self, origin: Position, shape: tuple[int, int, int]) -> np.ndarray:
+        """ упакованный свет клеток области, как VoxelGrid.read_box """
+        x, y, z = origin
+        result = np.full(shape, SKY, dtype=np.uint8)
+        for key, box, cells in self.voxels._box_parts(x, y, shape[0], shape[1]):
+            light = self.chunk(key)
+            if light is None:
+                continue
+            z0, z1 = max(z, 0), min(z + shape[2], light.shape[2])
+            if z0 < z1:
+                result[box + (slice(z0 - z, z1 - z),)] = light[cells + (slice(z0, z1),)]
+        return result
+
+    def padded(self, key: ChunkKey) -> np.ndarray:
+        """ свет чанка в рамке толщиной в одну клетку, как VoxelGrid.padded """
+        height = self.voxels.chunk(key).height
+        light = np.full((CHUNK_SIZE + 2, CHUNK_SIZE + 2, height + 2), SKY, dtype=np.uint8)
+        light[:, :, 1:-1] = self.read_box(Position(key[0] * CHUNK_SIZE - 1, key[1] * CHUNK_SIZE - 1, 0),
+                                          (CHUNK_SIZE + 2, CHUNK_SIZE + 2, height))
+        return light
+
+    def update(self, origin: Position, shape: tuple[int, int, int]) -> ChunkKeys:
+        """ пересчитывает свет вокруг изменённой области клеток. Возвращает чанки, сетку которых
+        нужно перестроить из-за изменившегося света. Чанки, свет которых ещё не считался, не трогаются:
+        он посчитается по новым клеткам, когда понадобится """
+        if not self.chunks:
+            return set()
+        x, y, _ = origin
+        nearby = {key for key, _, _ in self.voxels._box_parts(x - REACH, y - REACH, shape[0] + 2 * REACH,
+                                                              shape[1] + 2 * REACH)}
+        if not nearby & self.chunks.keys():
+            return set()
+        # окрестность правки и рамка вокруг неё, в которой свет правка уже не меняет
+        corner = Position(x - REACH - 1, y - REACH - 1, 0)
+        width, depth = shape[0] + 2 * REACH + 2, shape[1] + 2 * REACH + 2
+        height = self._height(corner.x, corner.y, width, depth)
+        if not height:
+            return set()
+        old = self.read_box(corner, (width, depth, height))
+        new = solve(self.voxels.read_box(corner, (width, depth, height)), old)
+        # свет клетки виден на гранях соседних клеток, в том числе из соседнего чанка
+        changed = (new != old).any(axis=2)
+        changed[1:] |= changed[:-1].copy()
+        changed[:-1] |= changed[1:].copy()
+        changed[:, 1:] |= changed[:, :-1].copy()
+        changed[:, :-1] |= changed[:, 1:].copy()
+        touched = set()
+        for key, box, cells in self.voxels._box_parts(corner.x, corner.y, width, depth):
+            light = self.chunks.get(key)
+            if light is None:
+                continue
+            light[cells] = new[box + (slice(0, light.shape[2]),)]
+            if changed[box].any():
+                touched.add(key)
+        return touched
@@ -0,0 +1,117 @@
+""" Двоичный формат файла карты.
+
+Заголовок, таблица чанков и данные чанков - массивы значений клеток uint8
+(CHUNK_SIZE x CHUNK_SIZE x высота), по желанию сжатые zlib:
+
+    magic 'VXMP' | версия u16 | флаги u16 | размер чанка u16 | число чанков u32
+    таблица: (cx i32, cy i32, высота u16, смещение u64, длина u32) на каждый чанк
+    данные чанков
+
+Мир теперь хранится в файлах регионов (regions.py), файл карты в этом формате только
+импортируется при первой загрузке, как и старый pickle-формат
+"""
+import pickle
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from conf import CHUNK_SIZE
+from voxels import ChunkKey
+
+
+MAGIC = b'VXMP'
+VERSION = 1
+FLAG_ZLIB = 1
+
+HEADER = struct.Struct('<4sHHHI')
+INDEX_DTYPE = np.dtype([('cx', '<i4'), ('cy', '<i4'), ('height', '<u2'), ('offset', '<u8'), ('length', '<u4')])
+
+
+class MapFormatError(Exception):
+    """ файл карты повреждён или записан в неизвестном формате """
+
+
+def encode_chunk(blocks: np.ndarray, compress: bool) -> bytes:
+    """ данные чанка для записи в файл """
+    data = np.ascontiguousarray(blocks, dtype=np.uint8).tobytes()
+    return zlib.compress(data) if compress else data
+
+
+def decode_chunk(data, height: int, compressed: bool, key: ChunkKey) -> np.ndarray:
+    """ значения клеток чанка из данных файла, новый массив, доступный для записи """
+    if compressed:
+        try:
+            data = zlib.decompress(data)
+        except zlib.error as err:
+            raise MapFormatError(f"Chunk {key} is corrupted: {err}") from err
+    data = np.frombuffer(data, dtype=np.uint8)
+    shape = (CHUNK_SIZE, CHUNK_SIZE, height)
+    if data.size != np.prod(shape):
+        raise MapFormatError(f"Chunk {key} has wrong size")
+    return data.reshape(shape).copy()
+
+
+class MapReader:
+    """ Чтение карты (для импорта в файлы регионов): таблица чанков разбирается сразу, чанки - по запросу.
+    Файл отображается в память (mmap=True) или читается целиком одним вызовом """
+
+    def __init__(self, path: Path, mmap: bool = True) -> None:
+        with open(path, 'rb') as fin:
+            header = fin.read(HEADER.size)
+        if len(header) < HEADER.size or header[:4] != MAGIC:
+            raise MapFormatError(f"Not a map file: {path}")
+        _, version, self.flags, chunk_size, count = HEADER.unpack(header)
+        if version != VERSION:
+            raise MapFormatError(f"Unsupported map version {version}: {path}")
+        if chunk_size != CHUNK_SIZE:
+            raise MapFormatError(f"Map has chunk size {chunk_size}, expected {CHUNK_SIZE}: {path}")
+
+        if mmap:
+            self._data = np.memmap(path, dtype=np.uint8, mode='r')
+        else:
+            self._data = np.frombuffer(Path(path).read_bytes(), dtype=np.uint8)
+        end = HEADER.size + count * INDEX_DTYPE.itemsize
+        if len(self._data) < end:
+            raise MapFormatError(f"Map file is truncated: {path}")
+        index = self._data[HEADER.size:end].view(INDEX_DTYPE)
+        if count and int((index['offset'] + index['length']).max()) > len(self._data):
+            raise MapFormatError(f"Map file is truncated: {path}")
+        # номер строки таблицы по координатам чанка и столбцы таблицы списками - так быстрее, чем по записям
+        self.index = dict(zip(zip(index['cx'].tolist(), index['cy'].tolist()), range(count)))
+        self._heights = index['height'].tolist()
+        self._offsets = index['offset'].tolist()
+        self._lengths = index['length'].tolist()
+
+    def __iter__(self): return iter(self.index)
+
+    def __contains__(self, key: ChunkKey) -> bool: return key in self.index
+
+    def __len__(self) -> int: return len(self.index)
+
+    def read_chunk(self, key: ChunkKey) -> np.ndarray:
+        """ значения клеток чанка, новый массив, доступный для записи """
+        row = self.index[key]
+        offset = self._offsets[row]
+        return decode_chunk(self._data[offset:offset + self._lengths[row]], self._heights[row],
+                            bool(self.flags & FLAG_ZLIB), key)
+
+    __getitem__ = read_chunk
+
+
+def is_legacy_map(path: Path) -> bool:
+    """ старый формат - поток pickle: количество блоков и позиции по одной """
+    with open(path, 'rb') as fin:
+        return fin.read(len(MAGIC)) != MAGIC
+
+
+def import_legacy_map(path: Path) -> np.ndarray:
+    """ читает позиции блоков из старого pickle-файла карты, массив (N, 3).
+    Цвета в старом формате не сохранялись. Записывать старый формат больше нельзя """
+    with open(path, 'rb') as fin:
+        try:
+            length = pickle.load(fin)
+            return np.array([pickle.load(fin) for _ in range(length)], dtype=np.int64).reshape(-1, 3)
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError) as err:
+            raise MapFormatError(f"Legacy map file is corrupted: {path}. {err}") from err
@@ -1,72 +1,500 @@
-import pickle
+import hashlib
 import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
 
-from conf import PATH_BASE_BLOCK, PATH_BASE_TEXTURE, PATH_MAP, BLOCK_COLORS
-from type_hints import Position, IMapmanager, RGBA
-from random import choice
+import numpy as np
+from panda3d.core import GeomNode, RenderState, TextureAttrib
+
+from conf import (PATH_MAP, PATH_WORLD, CHUNK_SIZE, GREEDY_MESHING, MESH_BUDGET, MESH_WORKERS,
+                  PATH_MESH_CACHE, MESH_CACHE_SIZE, BLOCK_SHADE,
+                  JOURNAL_COMPACT_SIZE, LIGHTING, PHYSICS_TICK, PHYSICS_BUDGET,
+                  VIEW_RADIUS, LOD_RADIUS, LOD_TILE, LOD_STEP)
+from type_hints import Position, RayHit, IMapmanager
+from blocks import TYPES, BUILDING, BRICK, STONE, palette
+from voxels import VoxelGrid, AIR, ChunkKey, ChunkKeys, chunk_key, chunks_touching, tile_key
+from light import LightMap, BRIGHTNESS
+from physics import BlockPhysics
+from atlas import load_atlas, atlas_shader, shaders_supported
+from mesher import MESHER_VERSION, PackedMesh, chunk_mesh, tile_mesh, make_geom_node
+from meshpool import MeshPool
+from meshcache import MeshCache
+from journal import EditJournal, JOURNAL_FILE
+from client import WorldClient, RemoteSource, apply_message, parse_address
+from protocol import ProtocolError, CLOSED, CHUNK, SAVE, message, encode_set, encode_box
+from mapfile import MapReader, is_legacy_map, import_legacy_map
+from regions import RegionStore
+from terrain import TerrainGenerator
+from landfile import HeightmapSource, read_heightmap, Progress
 from pathlib import Path
 
 
 class Mapmanager(IMapmanager):
     """ Управление картой """
     def __init__(self) -> None:
-        self.model = PATH_BASE_BLOCK  # модель кубика
-        # текстура блока
-        self.texture = PATH_BASE_TEXTURE
-        self.colors = BLOCK_COLORS  # цвет в формате RGBA
+        # текстуры всех типов блоков собраны в один атлас, все чанки делят одно состояние отрисовки:
+        # атлас и шейдер, который повторяет его текстуры по клеткам слитых граней
+        self.texture, self._uvs = load_atlas()
+        self._block_state = RenderState.make(TextureAttrib.make(self.texture), atlas_shader(self.texture))
+        # цвета вершин по типу блока в клетке, 0 - воздух
+        self._palette = palette()
+        self.block = BRICK  # тип блоков, которые ставит игрок
+        # сливать ли грани чанков в большие прямоугольники; без шейдеров текстура растянулась бы на слитую грань
+        self.greedy = GREEDY_MESHING and shaders_supported()
+        # индекс занятости клеток, чтобы не искать блоки по тегам в графе сцены
+        self.voxels = VoxelGrid()
+        # свет в клетках, запекается в цвета вершин сеток
+        self.light = LightMap(self.voxels)
+        self.lighting = LIGHTING
+        # падающие и текущие блоки сдвигаются по тактам; на общей карте это делает сервер
+        self.physics = BlockPhysics(self.voxels)
+        # клетки, сдвинутые физикой, свет вокруг которых ещё не пересчитан, по чанкам
+        self._unsettled: dict[ChunkKey, list[Position]] = {}
+        self._settle_turn = False  # чей такт: пересчёта света или сдвигов
+        self._chunks: dict[ChunkKey, object] = {}  # узлы сеток чанков
+        self._dirty: set[ChunkKey] = set()  # чанки, сетку которых нужно перестроить
+        # сетки строят процессы-помощники, задания - по ключам (грубая ли сетка, чанк или квадрат)
+        self.meshes = MeshPool(MESH_WORKERS)
+        # готовые сетки чанков на диске, по хэшу клеток, от которых сетка зависит
+        self.mesh_cache = MeshCache(None if PATH_MESH_CACHE is None else Path(PATH_MESH_CACHE), MESH_CACHE_SIZE)
+        self._digests: dict[ChunkKey, str] = {}  # под каким хэшем запомнить сетку чанка, которая строится
+        # показываются и держатся в памяти только чанки не дальше view_radius чанков от focus
+        self.focus = None  # узел, вокруг которого подгружается карта, например герой
+        self.view_radius = VIEW_RADIUS
+        self._center: ChunkKey | None = None  # чанк, в котором был focus при прошлой подгрузке
+        # дальше lod_radius чанков карта рисуется грубыми сетками, по одной на квадрат LOD_TILE x LOD_TILE чанков
+        self.lod_radius = LOD_RADIUS
+        self._tiles: dict[ChunkKey, object] = {}  # узлы грубых сеток
+        self._tile_steps: dict[ChunkKey, int] = {}  # сколько столбцов слито в клетку грубой сетки квадрата
+        self._dirty_tiles: set[ChunkKey] = set()  # квадраты, грубую сетку которых нужно перестроить
+        # карта записывается в фоновом потоке, чтобы игра не замирала
+        self.world = Path(PATH_WORLD)  # каталог с файлами регионов карты
+        self._saver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="SaveMap")
+        self._save: Future | None = None
+        self._save_callback: Callable[[Exception | None], None] | None = None
+        self._save_mark = 0  # место в журнале правок, до которого правки попадают в сохраняемый снимок
+        # каждая правка дописывается в журнал: он переживает аварийный выход и ведёт отмену правок
+        self.journal = EditJournal()
+        self.remote: WorldClient | None = None  # соединение с сервером мира, если карта общая
         # создаём основу для новой карты
-        self.land = render.attachNewNode("Land")  # узел, к которому привязаны все блоки карты
+        self.land = None  # узел, к которому привязаны все чанки карты
+        self._clear()
+        taskMgr.add(self._update_chunks_task, "UpdateChunksTask")
+        taskMgr.doMethodLater(PHYSICS_TICK, self._physics_task, "PhysicsTask")
+        # при выходе из игры ShowBase.destroy вызывает close
+        base.finalExitCallbacks.append(self.close)
 
-    def _get_color(self) -> RGBA: return RGBA(*choice(self.colors))
+    def next_block(self) -> str:
+        """выбирает следующий тип блоков для строительства, возвращает его название"""
+        self.block = BUILDING[(BUILDING.index(self.block) + 1) % len(BUILDING)]
+        return TYPES[self.block].name
 
-    def _find_blocks(self, position: Position): return self.land.findAllMatches("=at=" + str(position))
+    def close(self) -> None:
+        """дописывает начатое сохранение и сетки в кэш, закрывает файлы карты и останавливает процессы-помощники"""
+        self._finish_save()
+        if isinstance(self.voxels.source, RegionStore):
+            self.voxels.source.close()
+        if self.remote is not None:
+            self.remote.close()
+            self.remote = None
+        self.journal.close()
+        self.meshes.close()
+        self.mesh_cache.close()
 
     def _clear(self) -> None:
         """обнуляет карту"""
-        self.land.removeNode()
+        self._finish_save()
+        if self.land is not None:
+            self.land.removeNode()
         self.land = render.attachNewNode("Land")
+        if isinstance(self.voxels.source, RegionStore):
+            self.voxels.source.close()
+        if self.remote is not None:
+            taskMgr.remove("SyncTask")
+            self.remote.close()
+            self.remote = None
+        self.voxels.clear()
+        self.light.clear()
+        self.physics.clear()
+        self._unsettled.clear()
+        self.meshes.clear()
+        self._digests.clear()
+        self.journal.close()
+        self.journal.persistent = True
+        self._chunks.clear()
+        self._dirty.clear()
+        self._tiles.clear()
+        self._tile_steps.clear()
+        self._dirty_tiles.clear()
+        self._center = None
+
+    def _set_block(self, position: Position, value: int) -> None:
+        x, y, z = position
+        old = self.voxels.get(x, y, z)
+        self.voxels.set(x, y, z, value)
+        self._dirty |= chunks_touching(x, y)
+        self._relight(position, (1, 1, 1))
+        self._wake(position, (1, 1, 1))
+        self._record(position, np.array([[[old]]], dtype=np.uint8), np.array([[[value]]], dtype=np.uint8))
+        if self.remote is not None:
+            self.remote.send(encode_set(position, value))
+
+    def _write_box(self, origin: Position, values: np.ndarray, mask: np.ndarray | None = None) -> None:
+        """записывает область клеток и запоминает правку в журнале"""
+        old = self.voxels.read_box(origin, values.shape)
+        self._dirty |= self.voxels.write_box(origin, values, mask)
+        self._relight(origin, values.shape)
+        self._wake(origin, values.shape)
+        # что на самом деле оказалось в области: маска, клетки ниже z=0
+        self._record(origin, old, self.voxels.read_box(origin, values.shape))
+        if self.remote is not None:
+            self.remote.send(encode_box(origin, values, mask))
+
+    def _apply(self, origin: Position, values: np.ndarray) -> None:
+        """записывает клетки правки из журнала, сама правка в журнал не пишется"""
+        if values.shape == (1, 1, 1):
+            x, y, z = origin
+            self.voxels.set(x, y, z, values.item(0))
+            self._dirty |= chunks_touching(x, y)
+            if self.remote is not None:
+                self.remote.send(encode_set(origin, values.item(0)))
+        else:
+            self._dirty |= self.voxels.write_box(origin, values)
+            if self.remote is not None:
+                self.remote.send(encode_box(origin, values))
+        self._relight(origin, values.shape)
+        self._wake(origin, values.shape)
+
+    def _relight(self, origin: Position, shape: tuple[int, int, int]) -> None:
+        """пересчитывает свет вокруг изменённых клеток, сетки чанков, где он поменялся, перестраиваются"""
+        if self.lighting:
+            self._dirty |= self.light.update(origin, shape)
+
+    def _relight_chunks(self, keys: ChunkKeys) -> None:
+        """пересчитывает свет вокруг чанков, клетки которых поменялись целиком.
+        Каждый чанк отдельно, как в _settle: изменения с сервера могут быть разбросаны по всей карте"""
+        for x, y in keys:
+            self._relight(Position(x * CHUNK_SIZE, y * CHUNK_SIZE, 0), (CHUNK_SIZE, CHUNK_SIZE, 1))
+
+    def _wake(self, origin: Position, shape: tuple[int, int, int]) -> None:
+        """будит падающие блоки вокруг изменённых клеток"""
+        if self.remote is None:
+            self.physics.wake(origin, shape)
+
+    def _physics_task(self, task):
+        if self.remote is None:
+            self._physics_tick()
+        return task.again
+
+    def _physics_tick(self) -> None:
+        """такт падающих блоков: сдвиги пишутся в журнал, а свет и сетки вокруг них пересчитываются
+        по чанкам в пределах PHYSICS_BUDGET. Чанки, которые не успели, пересчитываются на следующих
+        тактах; пока они ждут, новые сдвиги в них добавляются к прежним и пересчитываются вместе"""
+        deadline = time.perf_counter() + PHYSICS_BUDGET
+        if self._unsettled and (self._settle_turn or not self.physics.active):
+            # пересчёт чанка не делится на части, поэтому такт пересчёта берёт хотя бы один чанк,
+            # а со сдвигами такты чередуются, чтобы ни то ни другое не вставало
+            self._settle(self._unsettled.pop(next(iter(self._unsettled))))
+        elif self.physics.active:
+            changes = self.physics.step(PHYSICS_BUDGET)
+            if changes:
+                self.journal.record_moves(changes)
+                self._compact_journal()
+                for position, _, _ in changes:
+                    self._unsettled.setdefault(chunk_key(position.x, position.y), []).append(position)
+        self._settle_turn = not self._settle_turn
+        while self._unsettled and time.perf_counter() < deadline:
+            self._settle(self._unsettled.pop(next(iter(self._unsettled))))
+
+    def _settle(self, positions: list[Position]) -> None:
+        """перестраивает сетки и свет вокруг клеток одного чанка, сдвинутых физикой"""
+        xs, ys, zs = zip(*positions)
+        for x, y in set(zip(xs, ys)):
+            self._dirty |= chunks_touching(x, y)
+        # свет пересчитывается отдельно по каждому чанку: одна общая рамка для далёких друг от друга
+        # сдвигов была бы огромной, а рамка одного чанка не больше CHUNK_SIZE + 2 * REACH
+        self._relight(Position(min(xs), min(ys), min(zs)),
+                      (max(xs) - min(xs) + 1, max(ys) - min(ys) + 1, max(zs) - min(zs) + 1))
+
+    def _record(self, origin: Position, old: np.ndarray, new: np.ndarray) -> None:
+        # у несохранённой карты журнал в памяти: после аварийного выхода правки восстановятся
+        # только начиная с первого сохранения
+        self.journal.record(origin, old, new)
+        self._compact_journal()
+
+    def _compact_journal(self) -> None:
+        # журнал сохранённой карты время от времени сам сбрасывается в файлы регионов
+        if self.journal.attached and self.journal.size > JOURNAL_COMPACT_SIZE and self._save is None:
+            self.save_map()
+
+    def undo(self) -> None:
+        """отменяет последнюю правку карты"""
+        edit = self.journal.undo()
+        if edit is not None:
+            self._apply(edit.origin, edit.old)
+
+    def redo(self) -> None:
+        """повторяет последнюю отменённую правку"""
+        edit = self.journal.redo()
+        if edit is not None:
+            self._apply(edit.origin, edit.new)
+
+    def _update_chunks_task(self, task):
+        self.update_chunks(MESH_BUDGET)
+        return task.cont
+
+    def follow(self, focus) -> None:
+        """подгружать карту вокруг узла focus, а не целиком"""
+        self.focus = focus
+        self._center = None
+
+    def _distance(self, key: ChunkKey) -> int:
+        return max(abs(key[0] - self._center[0]), abs(key[1] - self._center[1]))
+
+    def _tile_distance(self, tile: ChunkKey) -> int:
+        """расстояние в чанках от focus до ближайшего чанка квадрата"""
+        cx, cy = self._center
+        left, bottom = tile[0] * LOD_TILE, tile[1] * LOD_TILE
+        return max(left - cx, cx - left - LOD_TILE + 1, bottom - cy, cy - bottom - LOD_TILE + 1, 0)
+
+    def _tile_step(self, tile: ChunkKey) -> int:
+        """во сколько раз огрублять сетку квадрата: вдвое сильнее с каждым удвоением расстояния"""
+        distance = self._tile_distance(tile)
+        return min(LOD_STEP << max(0, (distance // max(self.lod_radius, 1)).bit_length() - 1), LOD_TILE * CHUNK_SIZE)
+
+    def _is_coarse(self, key: ChunkKey) -> bool:
+        """рисуется ли чанк в составе грубой сетки своего квадрата"""
+        return self._tile_distance(tile_key(key)) > self.lod_radius
+
+    def _stream(self) -> None:
+        """убирает сетки и выгружает чанки, от которых ушёл focus, и ставит в очередь новые"""
+        radius = self.view_radius
+        cx, cy = self._center
+        wanted = {(x, y) for x in range(cx - radius, cx + radius + 1) for y in range(cy - radius, cy + radius + 1)
+                  if self.voxels.has_chunk((x, y))}
+        tiles = {tile_key(key) for key in wanted if self._is_coarse(key)}
+        wanted = {key for key in wanted if tile_key(key) not in tiles}
+        for key in list(self._chunks):
+            if key not in wanted:
+                self._chunks.pop(key).removeNode()
+        for tile in list(self._tile_steps):
+            if tile not in tiles:
+                del self._tile_steps[tile]
+                node = self._tiles.pop(tile, None)
+                if node is not None:
+                    node.removeNode()
+        # сетки, которые уже не покажутся, можно не достраивать
+        for job in list(self.meshes):
+            coarse, key = job
+            if key not in (tiles if coarse else wanted):
+                self.meshes.cancel(job)
+                if not coarse:
+                    self._digests.pop(key, None)
+        self._dirty |= wanted - set(self._chunks)
+        # старая грубая сетка показывается, пока не готова сетка с новым шагом
+        self._dirty_tiles |= {tile for tile in tiles if self._tile_steps.get(tile) != self._tile_step(tile)}
+        # соседи видимых чанков нужны для построения их сеток, а чанки грубых квадратов - для их сеток
+        if self.remote is None:
+            for key in list(self.voxels.chunks):
+                if self._distance(key) > radius + 1 and tile_key(key) not in tiles:
+                    self.voxels.unload(key)
+                    self.light.forget(key)
+        else:
+            # чанки общей карты не кэшируются: сервер пришлёт их заново, когда понадобятся
+            far = {key for key in self.voxels.source.requested
+                   if self._distance(key) > radius + 1 and tile_key(key) not in tiles}
+            for key in far:
+                self.voxels.chunks.pop(key, None)
+                self.light.forget(key)
+            self.voxels.source.forget(far)
+
+    def update_chunks(self, budget: float | None = None) -> None:
+        """перестраивает сетки изменившихся чанков, остальные не трогает.
+        Сетки строят процессы-помощники: здесь задания ставятся в очередь, а готовые сетки подменяют старые.
+        Если задан focus, сначала строятся ближайшие к нему чанки, а дальние - грубыми сетками.
+        budget - сколько секунд можно потратить, остальные чанки подождут следующего вызова.
+        Без budget возвращается, только когда построены все сетки"""
+        deadline = None if budget is None else time.perf_counter() + budget
+        if self.focus is not None:
+            x, y, _ = self.focus.getPos(render)
+            center = chunk_key(round(x), round(y))
+            if center != self._center:
+                self._center = center
+                self._stream()
+            # изменённый дальний чанк перестраивает грубую сетку своего квадрата, если она показана
+            for key in self._dirty:
+                if tile_key(key) in self._tiles:
+                    self._dirty_tiles.add(tile_key(key))
+            self._dirty = {key for key in self._dirty
+                           if self._distance(key) <= self.view_radius and not self._is_coarse(key)}
+            self._dirty_tiles = {tile for tile in self._dirty_tiles if self._tile_distance(tile) <= self.view_radius}
+            queue = sorted([(self._distance(key), False, key) for key in self._dirty]
+                           + [(self._tile_distance(tile), True, tile) for tile in self._dirty_tiles], reverse=True)
+        else:
+            queue = [(0, False, key) for key in self._dirty]
+        while True:
+            while queue and not self.meshes.is_full() and (deadline is None or time.perf_counter() < deadline):
+                _, coarse, key = queue.pop()
+                if coarse:
+                    self._dirty_tiles.discard(key)
+                    self._build_tile(key)
+                else:
+                    self._dirty.discard(key)
+                    self._build_chunk(key)
+            for (coarse, key), mesh in self.meshes.done(block=deadline is None):
+                self._show(coarse, key, mesh)
+            if deadline is not None or not queue and not len(self.meshes):
+                break
+
+    def _show(self, coarse: bool, key: ChunkKey, mesh: PackedMesh) -> None:
+        """подменяет узел сетки чанка или грубой сетки квадрата готовой сеткой"""
+        name = ("tile %d %d" if coarse else "chunk %d %d") % key
+        geom_node = make_geom_node(name, mesh) if mesh.indices else GeomNode(name)
+        digest = None if coarse else self._digests.pop(key, None)
+        if digest is not None:
+            # в кэш сетка попадает без состояния отрисовки, оно общее и добавляется при показе
+            self.mesh_cache.store(digest, geom_node)
+        self._place(coarse, key, geom_node)
+
+    def _place(self, coarse: bool, key: ChunkKey, geom_node: GeomNode) -> None:
+        nodes = self._tiles if coarse else self._chunks
+        old = nodes.pop(key, None)
+        if old is not None:
+            old.removeNode()
+        if geom_node.getNumGeoms():
+            geom_node.setGeomState(0, self._block_state)
+            size = LOD_TILE * CHUNK_SIZE if coarse else CHUNK_SIZE
+            node = self.land.attachNewNode(geom_node)
+            node.setPos(key[0] * size, key[1] * size, 0)
+            nodes[key] = node
+
+    def scene_counts(self) -> tuple[int, int]:
+        """сколько в сцене узлов сеток чанков и грубых сеток; у каждого узла ровно один Geom"""
+        return len(self._chunks), len(self._tiles)
+
+    def _mesh_digest(self, key: ChunkKey) -> str:
+        """хэш всего, от чего зависит сетка чанка: свет доходит не дальше соседних чанков, так что
+        хватает клеток чанка и восьми соседей"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((MESHER_VERSION, key, self.greedy, self.lighting, BLOCK_SHADE)).encode())
+        digest.update(self._palette.tobytes())
+        digest.update(self._uvs.tobytes())
+        if self.lighting:
+            digest.update(BRIGHTNESS.tobytes())
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                chunk = self.voxels.chunk((key[0] + dx, key[1] + dy))
+                if chunk is None:
+                    digest.update(b'-')
+                else:
+                    digest.update(repr(chunk.blocks.shape).encode())
+                    digest.update(np.ascontiguousarray(chunk.blocks).data)
+        return digest.hexdigest()
+
+    def _build_chunk(self, key: ChunkKey) -> None:
+        if self.voxels.chunk(key) is None:
+            self.meshes.cancel((False, key))
+            self._digests.pop(key, None)
+            old = self._chunks.pop(key, None)
+            if old is not None:
+                old.removeNode()
+            return
+        digest = self._mesh_digest(key)
+        geom_node = self.mesh_cache.load(digest)
+        if geom_node is not None:
+            self.meshes.cancel((False, key))
+            self._digests.pop(key, None)
+            self._place(False, key, geom_node)
+            return
+        self._digests[key] = digest
+        # старая сетка показывается, пока не готова новая
+        self.meshes.submit((False, key), chunk_mesh, self.voxels.padded(key), self._palette, self.greedy,
+                           (key[0] * CHUNK_SIZE, key[1] * CHUNK_SIZE, 0),
+                           self.light.padded(key) if self.lighting else None, self._uvs)
+
+    def _build_tile(self, tile: ChunkKey) -> None:
+        """грубая сетка квадрата чанков по верхним блокам столбцов"""
+        step = self._tile_steps[tile] = self._tile_step(tile)
+        size = LOD_TILE * CHUNK_SIZE
+        tops = np.zeros((size, size), dtype=np.int32)
+        values = np.zeros((size, size), dtype=np.uint8)
+        for dx in range(LOD_TILE):
+            for dy in range(LOD_TILE):
+                chunk = self.voxels.chunk((tile[0] * LOD_TILE + dx, tile[1] * LOD_TILE + dy))
+                if chunk is None:
+                    continue
+                part = np.s_[dx * CHUNK_SIZE:(dx + 1) * CHUNK_SIZE, dy * CHUNK_SIZE:(dy + 1) * CHUNK_SIZE]
+                top = np.take_along_axis(chunk.blocks, chunk.heights[..., None].astype(np.intp) - 1, 2)[..., 0]
+                values[part] = top
+                tops[part] = np.where(top != AIR, chunk.heights, 0)
+        self.meshes.submit((True, tile), tile_mesh, tops, values, self._palette, step,
+                           (tile[0] * size, tile[1] * size, 0), self._uvs)
+
+    def connect(self, address: str) -> Position:
+        """играть на общей карте сервера мира по адресу 'хост:порт'. Возвращает место для героя.
+        Чанки приходят с сервера, когда к ним подходит герой, правки уходят на сервер"""
+        self._clear()
+        self.remote = WorldClient()
+        self.remote.start(*parse_address(address))
+        self.voxels.attach(RemoteSource(self.remote))
+        # карту хранит сервер, свой журнал нужен только для отмены правок
+        self.journal.persistent = False
+        taskMgr.add(self._sync_task, "SyncTask")
+        return self.remote.spawn
+
+    def _sync_task(self, task):
+        """применяет изменения карты, пришедшие с сервера, и запрашивает нужные чанки"""
+        for kind, payload in self.remote.messages():
+            if kind == CLOSED:
+                print("Lost connection to the world server")
+                sys.exit()
+            try:
+                touched = apply_message(self.voxels, self.voxels.source, kind, payload)
+            except ProtocolError as err:
+                print(f"World server sent a broken message: {err}")
+                sys.exit()
+            if touched:
+                self._dirty |= touched
+                self._relight_chunks(touched)
+            if kind == CHUNK:
+                # пришёл новый чанк: пересчитываем, какие чанки показывать
+                self._center = None
+        self.voxels.source.flush()
+        return task.cont
 
     def add_block(self, position: Position) -> None:
-        # создаём строительные блоки
-        block = loader.loadModel(self.model)
-        block.setTexture(loader.loadTexture(self.texture))
-        block.setPos(position)
-        color = self._get_color()
-        block.setColor(color)
-        block.setTag("at", str(position))
-        block.reparentTo(self.land)
-
-    def load_land(self, land_file: Path) -> Position:
-        """создаёт карту земли из текстового файла, возвращает её размеры"""
+        # ставим блок выбранного типа
+        self._set_block(position, self.block)
+
+    def load_land(self, land_file: Path, progress: Progress | None = None) -> Position:
+        """создаёт карту земли из текстового файла, возвращает её размеры.
+        Ошибка в файле - LandFormatError с номером строки и столбца, ошибка чтения - OSError.
+        Сетки чанков строятся постепенно, по несколько за кадр"""
         self._clear()
-        try:
-            with open(land_file) as file:
-                y = 0
-                for line in file:
-                    x = 0
-                    line = line.split(' ')
-                    for z in line:
-                        for z0 in range(int(z) + 1):
-                            self.add_block(Position(x, y, z0))
-                        x += 1
-                    y += 1
-        except IOError as err:
-            print(f"Could not open/read file: {land_file}. {err}")
-            sys.exit()
-        except Exception as err:
-            print("Unexpected error:", err)
-            sys.exit()
+        heights = read_heightmap(land_file, progress)
+        # чанки строятся из столбцов, когда понадобятся, и выгружаются, как чанки с диска
+        self.voxels.attach(HeightmapSource(heights))
+        self._dirty |= self.voxels.keys()
+        width, depth = heights.shape
+        return Position(width, depth, None)
+
+    def generate_land(self, seed: int) -> Position:
+        """создаёт бесконечную карту генератором рельефа, возвращает место для героя над началом координат.
+        Чанки строятся, когда к ним подходит герой"""
+        self._clear()
+        self.voxels.attach(TerrainGenerator(seed))
+        return self.find_highest_empty(Position(0, 0, 0))
 
-        return Position(x, y, None)
+    def is_empty(self, position: Position) -> bool: return self.voxels.get(*position) == AIR
 
-    def is_empty(self, position: Position) -> bool: return False if self._find_blocks(position) else True
+    def is_loaded(self, position: Position) -> bool:
+        """известны ли клетки столбца: на общей карте чанк может ещё не прийти с сервера"""
+        return self.remote is None or chunk_key(position[0], position[1]) in self.voxels.chunks
 
     def find_highest_empty(self, position: Position) -> Position:
-        x, y, z = position
-        z = 1
-        while not self.is_empty(Position(x, y, z)):
-            z += 1
-        return Position(x, y, z)
+        x, y, _ = position
+        return Position(x, y, self.voxels.column_height(x, y))
 
     def build_block(self, position: Position) -> None:
         """Ставим блок с учётом гравитации: """
@@ -77,59 +505,133 @@ class Mapmanager(IMapmanager):
 
     def del_block(self, position: Position) -> None:
         """удаляет блоки в указанной позиции """
-        blocks = self._find_blocks(position)
-        for block in blocks:
-            block.removeNode()
+        self._set_block(position, AIR)
 
     def del_block_from(self, position: Position) -> None:
         x, y, z = self.find_highest_empty(position)
-        pos = Position(x, y, z - 1)
-        for block in self._find_blocks(pos):
-            block.removeNode()
+        self._set_block(Position(x, y, z - 1), AIR)
 
-    def save_map(self) -> None:
-        """сохраняет все блоки, включая постройки, в бинарный файл"""
+    def raycast(self, origin, direction, reach: float) -> RayHit | None:
+        """первый блок на луче из точки origin в направлении direction не дальше reach"""
+        return self.voxels.raycast(origin, direction, reach)
 
-        # возвращает коллекцию NodePath для всех существующих в карте мира блоков
-        blocks = self.land.getChildren()
-        # открываем бинарный файл на запись
-        try:
-            with open(PATH_MAP, 'wb') as fout:
-                # сохраняем в начало файла количество блоков
-                pickle.dump(len(blocks), fout)
-
-                # обходим все блоки
-                for block in blocks:
-                    # сохраняем позицию
-                    x, y, z = block.getPos()
-                    pos = (int(x), int(y), int(z))
-                    pickle.dump(pos, fout)
-        except IOError as err:
-            print(f"Can't open map file, there might be no such a file: {PATH_MAP}. {err}")
-            sys.exit()
-        except Exception as err:
-            print("Unexpected error:", err)
-            sys.exit()
+    @staticmethod
+    def _box(corner: Position, opposite: Position) -> tuple[Position, tuple[int, int, int]]:
+        """нижний угол и размеры параллелепипеда между двумя углами включительно"""
+        origin = Position(*(min(a, b) for a, b in zip(corner, opposite)))
+        return origin, tuple(abs(a - b) + 1 for a, b in zip(corner, opposite))
+
+    def fill_box(self, corner: Position, opposite: Position) -> None:
+        """заполняет блоками выбранного типа параллелепипед между двумя углами включительно.
+        Сетка каждого задетого чанка перестраивается один раз"""
+        origin, shape = self._box(corner, opposite)
+        self._write_box(origin, np.full(shape, self.block, dtype=np.uint8))
+
+    def clear_box(self, corner: Position, opposite: Position) -> None:
+        """удаляет все блоки в параллелепипеде между двумя углами включительно"""
+        origin, shape = self._box(corner, opposite)
+        self._write_box(origin, np.zeros(shape, dtype=np.uint8))
+
+    def fill_sphere(self, center: Position, radius: int) -> None:
+        """заполняет блоками выбранного типа шар с центром в клетке center"""
+        offsets = np.arange(-radius, radius + 1)
+        distance = offsets[:, None, None] ** 2 + offsets[None, :, None] ** 2 + offsets[None, None, :] ** 2
+        # + radius, чтобы у шара не торчали одиночные клетки на полюсах
+        inside = distance <= radius * radius + radius
+        origin = Position(*(c - radius for c in center))
+        self._write_box(origin, np.full(inside.shape, self.block, dtype=np.uint8), inside)
+
+    def copy_box(self, corner: Position, opposite: Position) -> np.ndarray:
+        """клетки параллелепипеда между двумя углами включительно, чтобы потом вставить их paste_box"""
+        return self.voxels.read_box(*self._box(corner, opposite))
+
+    def paste_box(self, position: Position, blocks: np.ndarray, with_air: bool = True) -> None:
+        """вставляет скопированные клетки нижним углом в клетку position.
+        with_air=False - пустые клетки скопированного не стирают то, что уже стоит на месте вставки"""
+        self._write_box(position, blocks, None if with_air else blocks != AIR)
+
+    def save_map(self, callback: Callable[[Exception | None], None] | None = None) -> None:
+        """сохраняет карту в файлы регионов в фоновом потоке. Записываются только чанки, изменённые
+        после загрузки или прошлого сохранения; новая карта из карты высот или генератора рельефа
+        пишется в новый каталог, который подменяет старый.
+        callback(error) вызывается в основном потоке, когда запись закончится, error - None при успехе"""
+        if self.remote is not None:
+            # общую карту сохраняет сервер
+            self.remote.send(message(SAVE))
+            if callback is not None:
+                callback(None)
+            return
+        if self._save is not None:
+            print("The map is already being saved")
+            return
+        # снимок изменённых чанков: массивы типов блоков в клетках
+        chunks = self.voxels.snapshot()
+        self._save_mark = self.journal.mark()
+        store = self.voxels.source
+        if isinstance(store, RegionStore):
+            self._save = self._saver.submit(store.write_chunks, chunks)
+        else:
+            # мир генератора пишется как его настройки и изменённые чанки, мир из карты высот - целиком
+            self._save = self._saver.submit(RegionStore.replace, self.world, chunks, store)
+        self._save_callback = callback
+        taskMgr.add(self._save_task, "SaveMapTask")
+
+    def _save_task(self, task):
+        if not self._save.done():
+            return task.cont
+        self._finish_save()
+        return task.done
+
+    def _finish_save(self) -> None:
+        """дожидается фоновой записи карты и подгружает дальше чанки из записанных файлов регионов"""
+        if self._save is None:
+            return
+        save, callback = self._save, self._save_callback
+        self._save = self._save_callback = None
+        taskMgr.remove("SaveMapTask")
+        error = save.exception()
+        if error is None:
+            store = self.voxels.source
+            self.voxels.saved(store if isinstance(store, RegionStore) else RegionStore(self.world))
+            # правки из снимка уже в файлах регионов, в журнале остаются только более поздние
+            self.journal.saved(self._save_mark, self.world / JOURNAL_FILE)
+        else:
+            self.voxels.save_failed()
+            print(f"Could not save map: {self.world}. {error}")
+        if callback is not None:
+            callback(error)
 
     def load_map(self) -> None:
+        if self.remote is not None:
+            print("The map is kept by the world server")
+            return
         # удаляем все блоки
         self._clear()
 
         try:
-            # открываем бинарный файл на чтение
-            with open(PATH_MAP, 'rb') as fin:
-                # считываем количество блоков
-                length = pickle.load(fin)
-
-                for i in range(length):
-                    # считываем позицию
-                    pos = pickle.load(fin)
-
-                    # создаём новый блок
-                    self.add_block(pos)
+            world = RegionStore(self.world)
+            if world.is_empty() and Path(PATH_MAP).exists():
+                self._import_map(world)
+            # чанки читаются с диска по мере надобности
+            self.voxels.attach(world)
+            self._dirty |= self.voxels.keys()
+            # правки после последнего сохранения
+            for edit in self.journal.open(self.world / JOURNAL_FILE):
+                self._apply(edit.origin, edit.new)
         except IOError as err:
-            print(f"Could not open/read file: {PATH_MAP}. {err}")
+            print(f"Could not open/read map: {self.world}. {err}")
             sys.exit()
         except Exception as err:
             print("Unexpected error:", err)
             sys.exit()
+
+    def _import_map(self, world: RegionStore) -> None:
+        """переписывает карту прежнего формата из PATH_MAP в файлы регионов"""
+        if is_legacy_map(PATH_MAP):
+            # старая карта из pickle: только позиции, типа блоков в ней нет
+            positions = import_legacy_map(PATH_MAP)
+            grid = VoxelGrid()
+            grid.set_many(positions, STONE)
+            world.write_chunks({key: chunk.blocks for key, chunk in grid.chunks.items()})
+        else:
+            world.write_chunks(MapReader(PATH_MAP))
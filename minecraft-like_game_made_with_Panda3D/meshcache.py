@@ -0,0 +1,104 @@
+""" Готовые сетки чанков на диске, чтобы не строить их заново при каждой загрузке большой карты.
+
+Сетка хранится в файле .bam, имя которого - хэш всего, от чего она зависит: клеток чанка
+и его соседей (по ним считаются грани и свет), цветов блоков и версии построителя сеток.
+Изменённый чанк просто получает другое имя, так что устаревший файл никогда не читается,
+а со временем удаляется как самый давно нужный, когда кэш превышает свой размер: кэш
+проверяется при открытии и каждый раз, когда в него записана PRUNE_SHARE-я часть размера.
+Файлы пишутся в фоновом потоке, основному потоку остаётся только упаковать сетку в байты """
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from panda3d.core import BoundingBox, GeomNode, PandaNode, Point3
+
+
+PRUNE_SHARE = 8  # после записи какой доли limit снова удалять лишние файлы
+
+
+class MeshCache:
+    """ Каталог с файлами сеток. Без каталога кэш ничего не хранит и ничего не находит """
+
+    def __init__(self, directory: Path | None, limit: int) -> None:
+        self.directory = None if directory is None else Path(directory)
+        self.limit = limit  # байт, лишние файлы удаляются, начиная с самых давно прочитанных
+        self.hits = self.misses = 0
+        self._written = 0  # байт записано с последней очистки
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="MeshCache")
+        if self.directory is not None:
+            self._writer.submit(self.prune)
+
+    def _path(self, digest: str) -> Path:
+        # по подкаталогам, чтобы в одном каталоге не скапливались десятки тысяч файлов
+        return self.directory / digest[:2] / f"{digest}.bam"
+
+    def load(self, digest: str) -> GeomNode | None:
+        """ сетка из кэша или None, если её там нет """
+        if self.directory is None:
+            return None
+        path = self._path(digest)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # для очистки: файл снова нужен
+        except OSError:
+            self.misses += 1
+            return None
+        node = PandaNode.decodeFromBamStream(data)
+        if not isinstance(node, GeomNode):
+            self.misses += 1
+            return None
+        if node.hasTag('bounds'):
+            # границы, заданные при построении сетки, в .bam не пишутся, их хранит тег
+            bounds = [float(value) for value in node.getTag('bounds').split()]
+            node.setBounds(BoundingBox(Point3(*bounds[:3]), Point3(*bounds[3:])))
+            node.setFinal(True)
+        self.hits += 1
+        return node
+
+    def store(self, digest: str, node: GeomNode) -> None:
+        """ запоминает сетку: упаковывается сразу, на диск попадает в фоновом потоке """
+        if self.directory is None:
+            return
+        bounds = node.getInternalBounds()
+        if isinstance(bounds, BoundingBox):
+            node.setTag('bounds', ' '.join(map(repr, [*bounds.getMin(), *bounds.getMax()])))
+        data = node.encodeToBamStream()
+        self._writer.submit(self._write, self._path(digest), data)
+        self._written += len(data)
+        if self._written > self.limit // PRUNE_SHARE:
+            self._written = 0
+            self._writer.submit(self.prune)
+
+    @staticmethod
+    def _write(path: Path, data: bytes) -> None:
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp = path.with_suffix('.tmp')
+            temp.write_bytes(data)
+            os.replace(temp, path)
+        except OSError as err:
+            print(f"Could not write mesh cache file {path}: {err}")
+
+    def prune(self) -> None:
+        """ удаляет самые давно нужные файлы, пока кэш не уложится в limit """
+        files = []
+        for path in self.directory.glob('*/*.bam'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.limit:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def flush(self) -> None:
+        """ дожидается записи всех сеток """
+        self._writer.submit(lambda: None).result()
+
+    def close(self) -> None:
+        """ дожидается записи всех сеток и останавливает поток записи """
+        self._writer.shutdown()
@@ -0,0 +1,264 @@
+""" Построение одной сетки (Geom) на весь чанк: только грани, граничащие с воздухом.
+Яркость грани - свет в пустой клетке перед ней (light.py), он запекается в цвет вершин.
+В жадном режиме соседние грани одного типа блока с одинаковым светом в одной плоскости сливаются
+в один прямоугольник с оттенком его первой клетки.
+Для дальних чанков строится грубая сетка только по верхним блокам столбцов.
+С атласом текстур (atlas.py) грань получает текстуру своего типа блока и направления, а столбец
+tiling - координаты в клетках, по которым шейдер атласа повторяет текстуру на слитых гранях
+и в грубых сетках по разу на клетку """
+from typing import NamedTuple
+
+import numpy as np
+from panda3d.core import (BoundingBox, Geom, GeomNode, GeomTriangles, GeomVertexArrayFormat, GeomVertexData,
+                          GeomVertexFormat, InternalName, Point3, RenderState)
+
+from blocks import shade
+from light import BRIGHTNESS
+from voxels import AIR
+
+
+# меняется при любом изменении того, как строятся сетки: прежние сетки в кэше (meshcache.py) перестают подходить
+MESHER_VERSION = 3
+VERTEX_DTYPE = np.dtype([('vertex', np.float32, 3), ('texcoord', np.float32, 2), ('tiling', np.float32, 2),
+                         ('color', np.uint8, 4)])
+TILING = InternalName.make('tiling')
+
+# грани куба: нормаль и два ребра (u, v), для которых u x v = нормаль,
+# так обход вершин получается против часовой стрелки, если смотреть снаружи
+FACES = (
+    ((1, 0, 0), (0, 1, 0), (0, 0, 1)),
+    ((-1, 0, 0), (0, -1, 0), (0, 0, 1)),
+    ((0, 1, 0), (-1, 0, 0), (0, 0, 1)),
+    ((0, -1, 0), (1, 0, 0), (0, 0, 1)),
+    ((0, 0, 1), (1, 0, 0), (0, 1, 0)),
+    ((0, 0, -1), (1, 0, 0), (0, -1, 0)),
+)
+QUAD_UV = np.array([(0, 0), (1, 0), (1, 1), (0, 1)], dtype=np.float32)
+QUAD_INDICES = np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32)
+
+
+class ChunkMesh(NamedTuple):
+    vertices: np.ndarray  # массив вершин с типом VERTEX_DTYPE
+    indices: np.ndarray  # индексы вершин треугольников, uint32
+
+
+class PackedMesh(NamedTuple):
+    """ сетка в виде байтов, как её передаёт процесс-помощник """
+    vertices: bytes  # вершины VERTEX_DTYPE подряд
+    indices: bytes  # индексы uint32
+    bounds: tuple[tuple[float, float, float], tuple[float, float, float]] | None  # углы рамки вокруг вершин
+
+
+def _merge_faces(faces: np.ndarray, axis: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """ жадно сливает грани одного направления.
+    :param faces: значения видимых граней по клеткам чанка, 0 - грани нет
+    :param axis: ось нормали граней
+    :return: нижняя клетка прямоугольника, его размер в клетках по осям и значение """
+    # оси (нормаль, p, q): сначала собираем отрезки вдоль q, потом одинаковые отрезки - вдоль p
+    p_axis, q_axis = (a for a in range(3) if a != axis)
+    planes = np.moveaxis(faces, (axis, p_axis, q_axis), (0, 1, 2))
+    before = np.zeros_like(planes)
+    before[:, :, 1:] = planes[:, :, :-1]
+    after = np.zeros_like(planes)
+    after[:, :, :-1] = planes[:, :, 1:]
+    s, p, q0 = np.nonzero((planes != AIR) & (planes != before))
+    q1 = np.nonzero((planes != AIR) & (planes != after))[2]
+    values = planes[s, p, q0]
+
+    order = np.lexsort((p, q1, q0, values, s))
+    s, p, q0, q1, values = s[order], p[order], q0[order], q1[order], values[order]
+    new = np.ones(len(s), dtype=bool)
+    new[1:] = ((s[1:] != s[:-1]) | (values[1:] != values[:-1]) | (q0[1:] != q0[:-1])
+               | (q1[1:] != q1[:-1]) | (p[1:] != p[:-1] + 1))
+    first = np.flatnonzero(new)
+    last = np.flatnonzero(np.append(new[1:], True)) if len(s) else first
+
+    count = len(first)
+    origin = np.empty((count, 3), dtype=np.int64)
+    size = np.ones((count, 3), dtype=np.int64)
+    origin[:, axis], origin[:, p_axis], origin[:, q_axis] = s[first], p[first], q0[first]
+    size[:, p_axis] = p[last] - p[first] + 1
+    size[:, q_axis] = q1[first] - q0[first] + 1
+    return origin, size, values[first]
+
+
+def _colors(palette: np.ndarray, values: np.ndarray, cells: np.ndarray,
+            light: np.ndarray | None = None) -> np.ndarray:
+    """ цвета граней: цвет типа блока с оттенком клетки, cells - координаты клеток в мире, массив (N, 3).
+    light - упакованный свет перед каждой гранью """
+    colors = palette[values]
+    factor = shade(cells[:, 0], cells[:, 1], cells[:, 2])
+    if light is not None:
+        factor *= BRIGHTNESS[light]
+    colors[:, :3] = colors[:, :3] * factor[:, None]
+    return colors
+
+
+def build_mesh(blocks: np.ndarray, palette: np.ndarray, greedy: bool = False,
+               offset: tuple[int, int, int] = (0, 0, 0), light: np.ndarray | None = None,
+               uvs: np.ndarray | None = None) -> ChunkMesh:
+    """ строит сетку чанка.
+    :param blocks: клетки чанка с рамкой толщиной в одну клетку из соседних чанков
+    :param palette: цвета RGBA (uint8) для каждого значения клетки
+    :param greedy: сливать ли соседние грани одного типа в большие прямоугольники
+    :param offset: координаты первой клетки чанка в мире, от них зависит оттенок блоков
+    :param light: упакованный свет клеток той же формы, что blocks; без него все грани полностью освещены
+    :param uvs: прямоугольники текстур в атласе по значению клетки и грани, см. atlas.load_atlas;
+    без них текстура повторяется по каждой клетке """
+    solid = blocks != AIR
+    inner = blocks[1:-1, 1:-1, 1:-1]
+    sx, sy, sz = inner.shape
+    vertices = []
+    for number, (normal, u, v) in enumerate(FACES):
+        dx, dy, dz = normal
+        # грань видна, если соседняя клетка в направлении нормали пуста
+        exposed = (inner != AIR) & ~solid[1 + dx:1 + dx + sx, 1 + dy:1 + dy + sy, 1 + dz:1 + dz + sz]
+        lit = None if light is None else light[1 + dx:1 + dx + sx, 1 + dy:1 + dy + sy, 1 + dz:1 + dz + sz]
+        if greedy:
+            # сливаются только грани с одинаковыми типом и светом: свет - в старшем байте значения
+            faces = inner if lit is None else inner | lit.astype(np.uint16) << 8
+            origin, size, values = _merge_faces(np.where(exposed, faces, AIR), int(np.flatnonzero(normal)[0]))
+            if lit is not None:
+                lit = (values >> 8).astype(np.uint8)
+                values = (values & 0xFF).astype(np.uint8)
+        else:
+            origin = np.argwhere(exposed)
+            size = np.ones_like(origin)
+            values = inner[exposed]
+            lit = None if lit is None else lit[exposed]
+
+        n, u, v = (np.array(axis, dtype=np.float32) for axis in (normal, u, v))
+        # размеры прямоугольника вдоль рёбер u и v грани
+        width, height = size @ np.abs(u), size @ np.abs(v)
+        colors = _colors(palette, values, origin + offset, lit)
+        rects = None if uvs is None else uvs[values, number]
+        vertices.append(_quads(origin + (size - 1) / 2 + n / 2, u, v, width, height, colors, rects))
+    return _mesh(vertices)
+
+
+def _quads(center: np.ndarray, u: np.ndarray, v: np.ndarray, width: np.ndarray, height: np.ndarray,
+           colors: np.ndarray, rects: np.ndarray | None = None) -> np.ndarray:
+    """ вершины прямоугольников с центрами center, размерами width x height вдоль рёбер u и v.
+    rects - прямоугольники текстур (u0, v0, u1, v1) в атласе, без них текстура повторяется по клеткам """
+    cells = np.column_stack((width, height))
+    face = np.empty((len(center), 4), dtype=VERTEX_DTYPE)
+    for corner, (su, sv) in enumerate(QUAD_UV * 2 - 1):
+        face['vertex'][:, corner] = center + np.outer(su * width / 2, u) + np.outer(sv * height / 2, v)
+        face['tiling'][:, corner] = cells * QUAD_UV[corner]
+        if rects is None:
+            face['texcoord'][:, corner] = face['tiling'][:, corner]
+        else:
+            face['texcoord'][:, corner] = rects[:, :2] + (rects[:, 2:] - rects[:, :2]) * QUAD_UV[corner]
+    face['color'] = colors[:, None, :]
+    return face.reshape(-1)
+
+
+def _mesh(vertices: list[np.ndarray]) -> ChunkMesh:
+    vertices = np.concatenate(vertices)
+    count = len(vertices) // 4
+    indices = (QUAD_INDICES[None, :] + 4 * np.arange(count, dtype=np.uint32)[:, None]).reshape(-1)
+    return ChunkMesh(vertices, indices)
+
+
+def build_heightmap_mesh(tops: np.ndarray, values: np.ndarray, palette: np.ndarray, step: int,
+                         offset: tuple[int, int, int] = (0, 0, 0), uvs: np.ndarray | None = None) -> ChunkMesh:
+    """ грубая сетка по верхним блокам столбцов: верхние грани и ступеньки между ними, без пещер и нависаний.
+    :param tops: высота над верхним блоком каждого столбца, 0 - столбца нет; размеры кратны step
+    :param values: значения верхних блоков столбцов
+    :param step: сколько столбцов по X и по Y сливать в одну клетку сетки (берётся самый высокий)
+    :param offset: координаты первого столбца в мире
+    :param uvs: прямоугольники текстур в атласе, как у build_mesh """
+    width, depth = tops.shape[0] // step, tops.shape[1] // step
+    cells = tops.reshape(width, step, depth, step).transpose(0, 2, 1, 3).reshape(width, depth, step * step)
+    highest = cells.argmax(axis=2)[..., None]
+    heights = np.take_along_axis(cells, highest, 2)[..., 0].astype(np.float32)
+    top_values = np.take_along_axis(
+        values.reshape(width, step, depth, step).transpose(0, 2, 1, 3).reshape(width, depth, step * step),
+        highest, 2)[..., 0]
+    # оттенок клетки грубой сетки - как у самого высокого блока в ней
+    x, y = np.indices((width, depth))
+    columns = np.stack((x * step + highest[..., 0] // step, y * step + highest[..., 0] % step,
+                        heights - 1), axis=-1).reshape(-1, 3).astype(np.int64) + offset
+    colors = _colors(palette, top_values.reshape(-1), columns).reshape(width, depth, 4)
+    # вокруг участка высота 0, чтобы по краю участка получилась юбка до земли и не было щелей с соседями
+    around = np.zeros((width + 2, depth + 2), dtype=np.float32)
+    around[1:-1, 1:-1] = heights
+    size = np.full(width * depth, step, dtype=np.float32)
+
+    vertices = []
+    for number, (normal, u, v) in enumerate(FACES[:5]):
+        dx, dy, _ = normal
+        n, u, v = (np.array(axis, dtype=np.float32) for axis in (normal, u, v))
+        if normal[2]:
+            x, y = np.nonzero(heights)
+            low = high = heights[x, y]
+        else:
+            # ступенька там, где сосед в направлении нормали ниже
+            neighbour = around[1 + dx:1 + dx + width, 1 + dy:1 + dy + depth]
+            x, y = np.nonzero(heights > neighbour)
+            low, high = neighbour[x, y], heights[x, y]
+        center = np.column_stack(((x + 0.5) * step - 0.5, (y + 0.5) * step - 0.5, (low + high) / 2 - 0.5))
+        if not normal[2]:
+            center[:, :2] += n[:2] * step / 2
+        # у боковых граней ребро u горизонтальное, v - вертикальное
+        side = size[:len(x)]
+        rects = None if uvs is None else uvs[top_values[x, y], number]
+        vertices.append(_quads(center, u, v, side, side if normal[2] else high - low, colors[x, y], rects))
+    return _mesh(vertices)
+
+
+def pack(mesh: ChunkMesh) -> PackedMesh:
+    bounds = None
+    if len(mesh.vertices):
+        points = mesh.vertices['vertex']
+        bounds = tuple(points.min(axis=0).tolist()), tuple(points.max(axis=0).tolist())
+    return PackedMesh(mesh.vertices.tobytes(), mesh.indices.tobytes(), bounds)
+
+
+def chunk_mesh(blocks: np.ndarray, palette: np.ndarray, greedy: bool, offset: tuple[int, int, int],
+               light: np.ndarray | None = None, uvs: np.ndarray | None = None) -> PackedMesh:
+    """ задание для процесса-помощника: build_mesh с упакованным результатом """
+    return pack(build_mesh(blocks, palette, greedy, offset, light, uvs))
+
+
+def tile_mesh(tops: np.ndarray, values: np.ndarray, palette: np.ndarray, step: int,
+              offset: tuple[int, int, int], uvs: np.ndarray | None = None) -> PackedMesh:
+    """ задание для процесса-помощника: build_heightmap_mesh с упакованным результатом """
+    return pack(build_heightmap_mesh(tops, values, palette, step, offset, uvs))
+
+
+def _vertex_format() -> GeomVertexFormat:
+    array = GeomVertexArrayFormat()
+    array.addColumn(InternalName.getVertex(), 3, Geom.NT_float32, Geom.C_point)
+    array.addColumn(InternalName.getTexcoord(), 2, Geom.NT_float32, Geom.C_texcoord)
+    array.addColumn(TILING, 2, Geom.NT_float32, Geom.C_other)
+    array.addColumn(InternalName.getColor(), 4, Geom.NT_uint8, Geom.C_color)
+    return GeomVertexFormat.registerFormat(array)
+
+
+VERTEX_FORMAT = _vertex_format()
+
+
+def make_geom_node(name: str, mesh: PackedMesh, state: RenderState = RenderState.makeEmpty()) -> GeomNode:
+    """ переносит упакованную сетку в GeomNode одним копированием памяти,
+    state - общее для всех чанков состояние отрисовки (текстура блоков) """
+    vdata = GeomVertexData(name, VERTEX_FORMAT, Geom.UH_static)
+    vdata.uncleanSetNumRows(len(mesh.vertices) // VERTEX_DTYPE.itemsize)
+    memoryview(vdata.modifyArray(0)).cast('B')[:] = mesh.vertices
+
+    triangles = GeomTriangles(Geom.UH_static)
+    triangles.setIndexType(Geom.NT_uint32)
+    indices = triangles.modifyVertices()
+    indices.uncleanSetNumRows(len(mesh.indices) // 4)
+    memoryview(indices).cast('B')[:] = mesh.indices
+
+    geom = Geom(vdata)
+    geom.addPrimitive(triangles)
+    node = GeomNode(name)
+    node.addGeom(geom, state)
+    # границы посчитаны сразу по массиву вершин: прямоугольник плотнее сферы по умолчанию,
+    # и Panda3D не придётся обходить вершины при первом отсечении
+    if mesh.bounds is not None:
+        node.setBounds(BoundingBox(Point3(*mesh.bounds[0]), Point3(*mesh.bounds[1])))
+        node.setFinal(True)
+    return node
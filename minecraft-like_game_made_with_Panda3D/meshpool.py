@@ -0,0 +1,82 @@
+""" Построение сеток чанков в процессах-помощниках.
+
+Помощник получает клетки чанка (или столбцы квадрата грубой сетки) и возвращает упакованные
+байты вершин и индексов, а основному потоку остаётся создать из них GeomNode и подменить узел
+в сцене. Пока сетки строятся, игра продолжает принимать ввод и рисовать кадры.
+Процессы, а не потоки: сетка строится множеством мелких операций numpy, которые почти всё
+время держат GIL """
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from typing import Callable, Hashable, Iterator
+
+from mesher import PackedMesh
+
+
+JOBS_PER_WORKER = 4  # сколько заданий держать в очереди на каждого помощника
+
+
+class MeshPool:
+    """ Задания на построение сеток по ключам. Новое задание с тем же ключом заменяет прежнее:
+    результат прежнего выбрасывается, даже если он уже готов.
+    При workers=0 сетки строятся сразу в основном потоке """
+
+    def __init__(self, workers: int | None = None) -> None:
+        # одно ядро остаётся основному потоку: на одноядерной машине помощники только отнимали бы у него время
+        self.workers = max((os.cpu_count() or 1) - 1, 0) if workers is None else workers
+        self._executor: ProcessPoolExecutor | None = None
+        self._jobs: dict[Hashable, Future] = {}  # незабранные задания помощников
+        self._ready: dict[Hashable, PackedMesh] = {}  # сетки, построенные в основном потоке
+
+    def __len__(self) -> int:
+        """ сколько заданий ещё не забрано """
+        return len(self._jobs) + len(self._ready)
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(list(self._jobs) + list(self._ready))
+
+    def is_full(self) -> bool:
+        """ хватит ли помощникам заданий: остальные лучше придержать, пока не поменялась очерёдность """
+        return self.workers > 0 and len(self._jobs) >= self.workers * JOBS_PER_WORKER
+
+    def submit(self, key: Hashable, build: Callable[..., PackedMesh], *args) -> None:
+        """ ставит в очередь build(*args), build и аргументы должны передаваться в другой процесс """
+        self.cancel(key)
+        if not self.workers:
+            self._ready[key] = build(*args)
+            return
+        if self._executor is None:
+            # spawn, а не fork: в основном процессе уже работают потоки Panda3D
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=get_context('spawn'))
+        self._jobs[key] = self._executor.submit(build, *args)
+
+    def cancel(self, key: Hashable) -> None:
+        job = self._jobs.pop(key, None)
+        if job is not None:
+            job.cancel()
+        self._ready.pop(key, None)
+
+    def clear(self) -> None:
+        for key in list(self._jobs):
+            self.cancel(key)
+        self._ready.clear()
+
+    def done(self, block: bool = False) -> list[tuple[Hashable, PackedMesh]]:
+        """ забирает готовые сетки. block - дождаться хотя бы одной, если готовых нет, а задания есть.
+        Ошибка в задании поднимается здесь """
+        if block and not self._ready and self._jobs:
+            wait(self._jobs.values(), return_when=FIRST_COMPLETED)
+        ready = list(self._ready.items())
+        self._ready.clear()
+        for key, job in list(self._jobs.items()):
+            if job.done():
+                del self._jobs[key]
+                ready.append((key, job.result()))
+        return ready
+
+    def close(self) -> None:
+        """ отменяет задания и дожидается выхода помощников """
+        self.clear()
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
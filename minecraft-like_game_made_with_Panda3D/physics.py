@@ -0,0 +1,97 @@
+""" Падающие и текущие блоки: песок падает вниз, вода ещё и стекает с уступов в сторону.
+
+Мир по клеткам не обходится: проверяются только клетки из активного набора. В него попадают
+клетки вокруг каждой правки карты и клетки, куда блок только что сдвинулся или откуда ушёл,
+поэтому работа такта растёт с числом движущихся блоков, а не с размером мира.
+Блок, которому двигаться некуда, из набора выпадает до следующей правки рядом с ним.
+Такт ограничен по времени: если клеток больше, чем успевает обработаться, остальные ждут
+следующего такта, и большой обвал растягивается на несколько кадров """
+import time
+
+import numpy as np
+
+from blocks import TYPES, AIR
+from type_hints import Position
+from voxels import VoxelGrid
+
+
+STILL, FALL, FLOW = 0, 1, 2
+MOTION = np.array([{None: STILL, 'fall': FALL, 'flow': FLOW}[block.motion] for block in TYPES], dtype=np.uint8)
+SIDES = ((1, 0), (0, 1), (-1, 0), (0, -1))
+CHECK_EVERY = 32  # через сколько клеток сверяться с бюджетом такта
+
+# изменение клетки: позиция, было, стало
+Change = tuple[Position, int, int]
+
+
+class BlockPhysics:
+    """ Активный набор клеток VoxelGrid и их сдвиги по тактам """
+
+    def __init__(self, voxels: VoxelGrid) -> None:
+        self.voxels = voxels
+        self.active: set[Position] = set()
+        self.ticks = 0
+
+    def __len__(self) -> int:
+        return len(self.active)
+
+    def clear(self) -> None:
+        self.active.clear()
+
+    def wake(self, origin: Position, shape: tuple[int, int, int]) -> None:
+        """ ставит в набор подвижные блоки, которые могли сдвинуться после правки области:
+        в ней самой, сбоку от неё и на слой выше """
+        x, y, z = origin
+        corner = Position(x - 1, y - 1, max(z, 0))
+        blocks = self.voxels.read_box(corner, (shape[0] + 2, shape[1] + 2, max(shape[2] + 1 + min(z, 0), 0)))
+        for dx, dy, dz in np.argwhere(MOTION[blocks]).tolist():
+            self.active.add(Position(corner.x + dx, corner.y + dy, corner.z + dz))
+
+    def _wake_cell(self, x: int, y: int, z: int) -> None:
+        if z >= 0 and MOTION[self.voxels.get(x, y, z)]:
+            self.active.add(Position(x, y, z))
+
+    def _target(self, x: int, y: int, z: int, motion: int) -> Position | None:
+        """ куда сдвинуть блок из клетки (x, y, z) или None, если некуда. Ниже z=0 падать нельзя """
+        if not z:
+            return None
+        get = self.voxels.get
+        if get(x, y, z - 1) == AIR:
+            return Position(x, y, z - 1)
+        if motion == FLOW:
+            # вода уходит в сторону, только если там обрыв: на ровном месте она стоит
+            for i in range(4):
+                dx, dy = SIDES[(self.ticks + i) % 4]
+                if get(x + dx, y + dy, z) == AIR and get(x + dx, y + dy, z - 1) == AIR:
+                    return Position(x + dx, y + dy, z)
+        return None
+
+    def step(self, budget: float | None = None) -> list[Change]:
+        """ один такт: сдвигает блоки активного набора, нижние - первыми, и возвращает изменения клеток.
+        budget - секунд на такт, клетки, до которых не дошла очередь, остаются в наборе """
+        deadline = None if budget is None else time.perf_counter() + budget
+        cells = sorted(self.active, key=lambda cell: cell.z)
+        self.active = set()
+        self.ticks += 1
+        changes = []
+        for number, (x, y, z) in enumerate(cells):
+            if deadline is not None and number % CHECK_EVERY == 0 and number and time.perf_counter() > deadline:
+                self.active.update(cells[number:])
+                break
+            value = self.voxels.get(x, y, z)
+            motion = MOTION[value]
+            if not motion:
+                continue
+            target = self._target(x, y, z, motion)
+            if target is None:
+                continue
+            self.voxels.set(x, y, z, AIR)
+            self.voxels.set(*target, value)
+            changes += [(Position(x, y, z), value, AIR), (target, AIR, value)]
+            # блок продолжит движение со следующего такта, за ним могут двинуться соседи покинутой клетки
+            self.active.add(target)
+            self._wake_cell(x, y, z + 1)
+            for dx, dy in SIDES:
+                self._wake_cell(x + dx, y + dy, z)
+                self._wake_cell(x + dx, y + dy, z + 1)
+        return changes
@@ -1,5 +1,12 @@
+import math
+
+from direct.gui.OnscreenText import OnscreenText
+from panda3d.core import Vec3, TextNode
+
+from blocks import TYPES
+from collision import cells, sweep, overlaps
 from conf import *
-from type_hints import Position, IMapmanager, degrees
+from type_hints import Position, RayHit, IMapmanager, degrees
 
 
 class Player:
@@ -11,14 +18,25 @@ class Player:
         """
         self.land = land
         self.mode = False  # режим прохождения сквозь объекты
+        self.selection: list[Position] = []  # углы выделенной области, не больше двух
+        self.clipboard = None  # скопированные клетки области
+        # зажатые клавиши движения: герой идёт, пока клавиша не отпущена, с одной скоростью на любом компьютере
+        self.keys = dict.fromkeys(('forward', 'back', 'left', 'right', 'up', 'down', 'turn_left', 'turn_right'), False)
+        self.fall_speed = 0.0  # вертикальная скорость героя, блоков в секунду
+        self.on_ground = False
         self.hero = loader.loadModel('smiley')
         self.hero.setColor(*PLAYER_COLOR)
         self.hero.setScale(PLAYER_SCALE)
         self.hero.setH(PLAYER_HORIZONTAL_POSITION)
         self.hero.setPos(position)
         self.hero.reparentTo(render)
+        self.crosshair = OnscreenText(text='+', pos=(0, -0.02), scale=0.08, fg=(1, 1, 1, 1), shadow=(0, 0, 0, 1))
+        # название типа блоков, которые ставит игрок
+        self.block_name = OnscreenText(text=TYPES[land.block].name, parent=base.a2dBottomLeft, pos=(0.05, 0.05),
+                                       scale=0.06, fg=(1, 1, 1, 1), shadow=(0, 0, 0, 1), align=TextNode.ALeft)
         self._camera_bind()
         self._accept_events()
+        taskMgr.add(self._move_task, "PlayerMoveTask")
 
     def _camera_bind(self) -> None:
         base.disableMouse()
@@ -35,10 +53,6 @@ class Player:
 
     def _change_view(self) -> None: self._camera_up() if self.cameraOn else self._camera_bind()
 
-    def _turn_left(self) -> None: self.hero.setH((self.hero.getH() + PLAYER_TURN_DEGREE) % 360)
-
-    def _turn_right(self) -> None: self.hero.setH((self.hero.getH() - PLAYER_TURN_DEGREE) % 360)
-
     def _look_at(self, angle: degrees) -> Position:
         """ возвращает координаты, в которые переместится персонаж, стоящий в точке (x, y),
         если он делает шаг в направлении angle"""
@@ -52,8 +66,6 @@ class Player:
         y_to = y_from + dy
         return Position(x_to, y_to, z_from)
 
-    def _update_pos(self, angle: degrees) -> None: self.hero.setPos(self._look_at(angle))
-
     @staticmethod
     def _check_dir(angle: degrees) -> Position:
         """ возвращает округленные изменения координат X, Y,
@@ -90,81 +102,185 @@ class Player:
         else:
             return Position(0, -1, None)
 
-    def _forward(self) -> None: self.move_to((self.hero.getH() + 180) % 360)
+    def _switch_mode(self) -> None:
+        self.mode = not self.mode
+        self.fall_speed = 0.0
 
-    def _back(self) -> None: self.move_to((self.hero.getH()) % 360)
+    def _press(self, action: str, pressed: bool) -> None: self.keys[action] = pressed
 
-    def _left(self) -> None: self.move_to((self.hero.getH() + 270) % 360)
+    def _move_task(self, task):
+        self.update(globalClock.getDt())
+        return task.cont
 
-    def _right(self) -> None: self.move_to((self.hero.getH() + 90) % 360)
+    def _solid(self, x: int, y: int, z: int) -> bool:
+        """ занята ли клетка для героя: ниже z=0 земля непроходима """
+        return z < 0 or not self.land.is_empty(Position(x, y, z))
 
-    def _switch_mode(self) -> None: self.mode = not self.mode
+    def _box(self) -> tuple[list[float], list[float]]:
+        """ углы тела героя: он стоит в клетке своей позиции, ноги - на её нижней грани """
+        x, y, z = self.hero.getPos()
+        half = PLAYER_WIDTH / 2
+        return [x - half, y - half, z - 0.5], [x + half, y + half, z - 0.5 + PLAYER_HEIGHT]
 
-    def _try_move(self, angle: degrees) -> None:
-        """перемещается, если может"""
-        position = self._look_at(angle)
-        if self.land.is_empty(position):
-            # перед нами свободно. Возможно, надо упасть вниз:
-            position = self.land.find_highest_empty(position)
-            self.hero.setPos(position)
-        else:
-            # перед нами занято. Если получится, заберёмся на этот блок:
-            position = Position(position[0], position[1], position[2] + 1)
-            if self.land.is_empty(position):
-                self.hero.setPos(position)
-                # не получится забраться - стоим на месте
+    def _inside(self, position: Position) -> bool:
+        """ заходит ли тело героя в клетку position """
+        low, high = self._box()
+        return all(c in cells(a, b) for c, a, b in zip(position, low, high))
 
-    def _up(self) -> None:
+    def update(self, dt: float) -> None:
+        """ двигает героя за кадр длиной dt секунд: по зажатым клавишам, с силой тяжести
+        и столкновениями с блоками. Проверяются только клетки рядом с героем, без поиска по сцене """
+        dt = min(dt, PLAYER_MAX_DT)
+        keys = self.keys
+        turn = keys['turn_left'] - keys['turn_right']
+        if turn:
+            self.hero.setH((self.hero.getH() + turn * PLAYER_TURN_SPEED * dt) % 360)
+        # вперёд - куда смотрит камера, вправо - вправо от неё
+        forward, right = keys['forward'] - keys['back'], keys['right'] - keys['left']
+        heading = math.radians(self.hero.getH())
+        dx = -forward * math.sin(heading) + right * math.cos(heading)
+        dy = forward * math.cos(heading) + right * math.sin(heading)
+        length = math.hypot(dx, dy)
+        if length:
+            dx, dy = dx / length * PLAYER_SPEED * dt, dy / length * PLAYER_SPEED * dt
         if self.mode:
-            self.hero.setZ(self.hero.getZ() + 1)
+            # сквозь блоки, без силы тяжести
+            dz = (keys['up'] - keys['down']) * PLAYER_SPEED * dt
+            x, y, z = self.hero.getPos()
+            self.hero.setPos(x + dx, y + dy, max(z + dz, 0))
+            return
+        position = Position(*(round(c) for c in self.hero.getPos()))
+        if not self.land.is_loaded(position):
+            # карта под героем ещё не пришла с сервера: ждём, чтобы не провалиться
+            return
+        low, high = self._box()
+        if overlaps(self._solid, low, high):
+            # блок появился там, куда заходит тело героя: выталкиваем героя на верх всех столбцов под ним,
+            # а если и там тело в чём-то застряло (в столбце есть пустоты) - ещё выше, пока не освободится
+            z = max(self.land.find_highest_empty(Position(x, y, 0)).z
+                    for x in cells(low[0], high[0]) for y in cells(low[1], high[1]))
+            low[2], high[2] = z - 0.5, z - 0.5 + PLAYER_HEIGHT
+            while overlaps(self._solid, low, high):
+                low[2] += 1
+                high[2] += 1
+            self.hero.setZ(low[2] + 0.5)
+            self.fall_speed = 0.0
+            return
 
-    def _down(self) -> None:
-        if self.mode and self.hero.getZ() > 1:
-            self.hero.setZ(self.hero.getZ() - 1)
+        self.fall_speed = max(self.fall_speed - PLAYER_GRAVITY * dt, -PLAYER_FALL_SPEED)
+        fall = self.fall_speed * dt
+        moved = sweep(self._solid, low, high, 2, fall)
+        self.on_ground = fall < 0 and moved > fall
+        if moved != fall:
+            self.fall_speed = 0.0
+        low[2] += moved
+        high[2] += moved
+        for axis, delta in ((0, dx), (1, dy)):
+            moved = sweep(self._solid, low, high, axis, delta)
+            if moved != delta and self.on_ground:
+                # упёрлись в блок: пробуем на него шагнуть
+                raised = sweep(self._solid, low, high, 2, PLAYER_STEP)
+                low[2] += raised
+                high[2] += raised
+                stepped = sweep(self._solid, low, high, axis, delta)
+                if raised == PLAYER_STEP and abs(stepped) > abs(moved):
+                    moved = stepped
+                else:
+                    low[2] -= raised
+                    high[2] -= raised
+            low[axis] += moved
+            high[axis] += moved
+        self.hero.setPos(low[0] + PLAYER_WIDTH / 2, low[1] + PLAYER_WIDTH / 2, low[2] + 0.5)
+
+    def _pick(self) -> RayHit | None:
+        """ блок, на который смотрит прицел (центр экрана), не дальше PLAYER_REACH """
+        direction = render.getRelativeVector(base.camera, Vec3.forward())
+        return self.land.raycast(base.camera.getPos(render), direction, PLAYER_REACH)
+
+    def _target(self) -> Position:
+        """ клетка, с которой работают выделение и вставка: блок под прицелом или клетка перед героем """
+        hit = self._pick()
+        return hit.position if hit is not None else self._look_at(self.hero.getH() % 180)
+
+    @staticmethod
+    def _next_to(hit: RayHit) -> Position:
+        """ пустая клетка вплотную к грани блока, на которую смотрит прицел """
+        return Position(*(p + n for p, n in zip(hit.position, hit.normal)))
 
     def _build(self) -> None:
-        angle = self.hero.getH() % 180
-        position = self._look_at(angle)
+        hit = self._pick()
+        if hit is not None:
+            position = self._next_to(hit)
+            # в клетки, куда заходит тело героя, не строим
+            if not self._inside(position):
+                self.land.add_block(position)
+            return
+        position = self._look_at(self.hero.getH() % 180)
         if self.mode:
-            self.land.add_block(position)
-        else:
+            if not self._inside(position):
+                self.land.add_block(position)
+        elif not self._inside(self.land.find_highest_empty(position)):
+            # блок падает на верх столбца
             self.land.build_block(position)
 
     def _destroy(self) -> None:
-        angle = self.hero.getH() % 180
-        position = self._look_at(angle)
+        hit = self._pick()
+        if hit is not None:
+            self.land.del_block(hit.position)
+            return
+        position = self._look_at(self.hero.getH() % 180)
         if self.mode:
             self.land.del_block(position)
         else:
             self.land.del_block_from(position)
 
+    def _next_block(self) -> None: self.block_name.setText(self.land.next_block())
+
+    def _select_corner(self) -> None: self.selection = self.selection[-1:] + [self._target()]
+
+    def _fill_selection(self) -> None:
+        if len(self.selection) == 2:
+            self.land.fill_box(*self.selection)
+
+    def _clear_selection(self) -> None:
+        if len(self.selection) == 2:
+            self.land.clear_box(*self.selection)
+
+    def _copy_selection(self) -> None:
+        if len(self.selection) == 2:
+            self.clipboard = self.land.copy_box(*self.selection)
+
+    def _paste(self) -> None:
+        if self.clipboard is not None:
+            hit = self._pick()
+            self.land.paste_box(self._target() if hit is None else self._next_to(hit), self.clipboard)
+
+    def _fill_sphere(self) -> None: self.land.fill_sphere(self._target(), SPHERE_RADIUS)
+
     def _accept_events(self) -> None:
-        base.accept(KEY_TURN_LEFT, self._turn_left)
-        base.accept(KEY_TURN_LEFT + '-repeat', self._turn_left)
-        base.accept(KEY_TURN_RIGHT, self._turn_right)
-        base.accept(KEY_TURN_RIGHT + '-repeat', self._turn_right)
-
-        base.accept(KEY_MOVE_BACK, self._forward)
-        base.accept(KEY_MOVE_BACK + '-repeat', self._forward)
-        base.accept(KEY_MOVE_FORWARD, self._back)
-        base.accept(KEY_MOVE_FORWARD + '-repeat', self._back)
-        base.accept(KEY_MOVE_LEFT, self._left)
-        base.accept(KEY_MOVE_LEFT + '-repeat', self._left)
-        base.accept(KEY_MOVE_RIGHT, self._right)
-        base.accept(KEY_MOVE_RIGHT + '-repeat', self._right)
+        for key, action in ((KEY_MOVE_BACK, 'forward'), (KEY_MOVE_FORWARD, 'back'), (KEY_MOVE_LEFT, 'left'),
+                            (KEY_MOVE_RIGHT, 'right'), (KEY_MOVE_UP, 'up'), (KEY_MOVE_DOWN, 'down'),
+                            (KEY_TURN_LEFT, 'turn_left'), (KEY_TURN_RIGHT, 'turn_right')):
+            base.accept(key, self._press, [action, True])
+            base.accept(key + '-up', self._press, [action, False])
 
         base.accept(KEY_SWITCH_CAMERA, self._change_view)
         base.accept(KEY_SWITCH_MODE, self._switch_mode)
 
-        base.accept(KEY_MOVE_UP, self._up)
-        base.accept(KEY_MOVE_UP + '-repeat', self._up)
-        base.accept(KEY_MOVE_DOWN, self._down)
-        base.accept(KEY_MOVE_DOWN + '-repeat', self._down)
-
         base.accept(KEY_BUILD_BLOCK, self._build)
         base.accept(KEY_DESTROY_BLOCK, self._destroy)
 
+        base.accept(KEY_SELECT_CORNER, self._select_corner)
+        base.accept(KEY_FILL_SELECTION, self._fill_selection)
+        base.accept(KEY_CLEAR_SELECTION, self._clear_selection)
+        base.accept(KEY_COPY_SELECTION, self._copy_selection)
+        base.accept(KEY_PASTE, self._paste)
+        base.accept(KEY_FILL_SPHERE, self._fill_sphere)
+
+        base.accept(KEY_NEXT_BLOCK, self._next_block)
+
+        base.accept(KEY_UNDO, self.land.undo)
+        base.accept(KEY_REDO, self.land.redo)
+
         base.accept(KEY_SAVE_MAP, self.land.save_map)
         base.accept(KEY_LOAD_MAP, self.land.load_map)
-
-    def move_to(self, angle: degrees) -> None: self._update_pos(angle) if self.mode else self._try_move(angle)
@@ -0,0 +1,120 @@
+""" Замеры кадров для поиска подвисаний: включается в conf.PROFILE.
+
+Каждая задача taskMgr и каждый обработчик, подписанный через base.accept, оборачивается
+замером времени. Замеры и длительности кадров хранятся в кольцевых буферах, сводка
+показывается поверх игры, а по KEY_DUMP_TRACE последние кадры записываются в JSON-файл
+для chrome://tracing или https://ui.perfetto.dev. Отсечение и отрисовка сцены попадают
+в задачу igLoop, разделить их можно в PStats (PROFILE_PSTATS) """
+import json
+import time
+from collections import deque
+from functools import wraps
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+import numpy as np
+from direct.gui.OnscreenText import OnscreenText
+from panda3d.core import PStatClient, PStatCollector, TextNode
+
+from conf import KEY_DUMP_TRACE, PROFILE_PSTATS, PROFILE_FRAMES, PROFILE_SPANS
+
+
+OVERLAY_PERIOD = 0.25  # как часто обновлять сводку на экране, секунд
+
+
+class Span(NamedTuple):
+    name: str
+    category: str  # frame, task или event
+    start: float  # секунды time.perf_counter()
+    duration: float
+
+
+class FrameProfiler:
+    """ Замеры задач и обработчиков событий игры. Создаётся сразу после ShowBase,
+    до того как подписаны обработчики, которые нужно замерять """
+
+    def __init__(self, base, pstats: bool = PROFILE_PSTATS) -> None:
+        self.base = base
+        self.frames: deque[float] = deque(maxlen=PROFILE_FRAMES)  # длительности кадров, секунд
+        self.spans: deque[Span] = deque(maxlen=PROFILE_SPANS)
+        self._frame_start: float | None = None
+        self._overlay_time = 0.0
+        self.pstats = pstats and PStatClient.connect()
+        # карта, узлы сеток которой показывает сводка: обходить сцену ради них слишком дорого для замеров
+        self.land = None
+        self._collectors: dict[str, PStatCollector] = {}
+
+        # все base.accept после этого момента получают замеряемые обработчики
+        self._accept = base.accept
+        base.accept = self.accept
+        base.taskMgr.add(self._frame_task, "ProfilerFrameTask", sort=-1000)
+        self._wrap_tasks()
+
+        self.overlay = OnscreenText(parent=base.a2dTopLeft, pos=(0.05, -0.08), scale=0.05, align=TextNode.ALeft,
+                                    fg=(1, 1, 1, 1), shadow=(0, 0, 0, 1), mayChange=True)
+        base.accept(KEY_DUMP_TRACE, self.dump_trace)
+
+    def _timed(self, name: str, category: str, function: Callable) -> Callable:
+        collector = None
+        if self.pstats and category == 'event':
+            collector = self._collectors.setdefault(name, PStatCollector(f"App:Show code:Events:{name}"))
+
+        @wraps(function)
+        def timed(*args, **kwargs):
+            if collector is not None:
+                collector.start()
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.spans.append(Span(name, category, start, time.perf_counter() - start))
+                if collector is not None:
+                    collector.stop()
+        timed.profiled = True
+        return timed
+
+    def accept(self, event: str, method: Callable, extraArgs: list = []) -> None:
+        self._accept(event, self._timed(event, 'event', method), extraArgs)
+
+    def _wrap_tasks(self) -> None:
+        """ оборачивает задачи, добавленные с прошлого кадра, в том числе отложенные (doMethodLater) """
+        for task in self.base.taskMgr.getTasks() + self.base.taskMgr.getDoLaters():
+            function = getattr(task, 'getFunction', lambda: None)()
+            if function is not None and not getattr(function, 'profiled', False):
+                task.setFunction(self._timed(task.getName(), 'task', function))
+
+    def _frame_task(self, task):
+        now = time.perf_counter()
+        if self._frame_start is not None:
+            self.frames.append(now - self._frame_start)
+            self.spans.append(Span("frame", 'frame', self._frame_start, now - self._frame_start))
+        self._frame_start = now
+        self._wrap_tasks()
+        if now - self._overlay_time > OVERLAY_PERIOD:
+            self._overlay_time = now
+            self.overlay.setText(self.summary())
+        return task.cont
+
+    def summary(self) -> str:
+        text = ""
+        if self.land is not None:
+            chunks, tiles = self.land.scene_counts()
+            text = f"chunks {chunks}  tiles {tiles}  geoms {chunks + tiles}"
+        if self.frames:
+            frames = np.array(self.frames) * 1000
+            text = (f"frame {frames[-1]:5.1f} ms  p99 {np.percentile(frames, 99):5.1f} ms  "
+                    f"max {frames.max():5.1f} ms\n" + text)
+        return text
+
+    def trace(self) -> dict:
+        """ последние замеры в формате Chrome trace event """
+        origin = self.spans[0].start if self.spans else 0.0
+        events = [{'name': span.name, 'cat': span.category, 'ph': 'X', 'pid': 1, 'tid': 1,
+                   'ts': (span.start - origin) * 1e6, 'dur': span.duration * 1e6} for span in self.spans]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump_trace(self, path: Path | None = None) -> Path:
+        path = Path(path or time.strftime("trace-%Y%m%d-%H%M%S.json"))
+        path.write_text(json.dumps(self.trace()))
+        print(f"Frame trace written to {path}")
+        return path
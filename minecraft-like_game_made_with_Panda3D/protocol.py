@@ -0,0 +1,162 @@
+""" Протокол сервера мира: сообщения по TCP, каждое - длина u32 | тип u8 | данные.
+
+    HELLO   сервер -> клиент  версия u16 | размер чанка u16 | место героя i32 x 3
+    REQUEST клиент -> сервер  нужные чанки: (cx i32, cy i32) на каждый
+    FORGET  клиент -> сервер  чанки, которые клиенту больше не нужны, в том же виде
+    CHUNK   сервер -> клиент  cx i32 | cy i32 | высота u16 | zlib(клетки), высота 0 - пустой чанк
+    SET     клиент -> сервер  x i32 | y i32 | z i32 | значение u8
+    BOX     оба               x i32 | y i32 | z i32 | размеры u16 x 3 | флаги u8 | zlib(клетки [+ маска])
+    BLOCKS  сервер -> клиент  число u32 | zlib(разности отсортированных позиций i32 x 3 + значения u8)
+    SAVE    клиент -> сервер  сохранить карту
+
+Клиент получает чанк один раз, по запросу, а дальше только изменения его клеток.
+Изменения отдельных блоков копятся на сервере и уходят одним сообщением BLOCKS за такт:
+позиции отсортированы и записаны разностями с предыдущей, поэтому хорошо сжимаются.
+Значения клеток проверяются при разборе сообщения: неизвестный тип блока - ProtocolError,
+и до карты, журнала и построителя сеток такое значение не доходит """
+import asyncio
+import struct
+import zlib
+
+import numpy as np
+
+from blocks import TYPES
+from conf import CHUNK_SIZE
+from mapfile import encode_chunk, decode_chunk
+from type_hints import Position
+from voxels import ChunkKey
+
+
+VERSION = 1
+FRAME = struct.Struct('<IB')
+MAX_MESSAGE = 64 * 2 ** 20
+
+HELLO, REQUEST, FORGET, CHUNK, SET, BOX, BLOCKS, SAVE = range(1, 9)
+CLOSED = 0  # не сообщение: соединение закрыто
+
+HELLO_DATA = struct.Struct('<HHiii')
+CHUNK_HEAD = struct.Struct('<iiH')
+SET_DATA = struct.Struct('<iiiB')
+BOX_HEAD = struct.Struct('<iiiHHHB')
+BLOCKS_HEAD = struct.Struct('<I')
+FLAG_MASK = 1
+
+
+class ProtocolError(Exception):
+    """ сообщение не по протоколу """
+
+
+def _check_values(values: np.ndarray, what: str) -> None:
+    """ все ли значения клеток - известные типы блоков """
+    if values.size and int(values.max()) >= len(TYPES):
+        raise ProtocolError(f"Unknown block type {int(values.max())} in {what}")
+
+
+def _inflate(data: bytes, size: int, what: str) -> np.ndarray:
+    """ распаковывает zlib не больше чем в size байт: размер данных задаёт заголовок сообщения """
+    try:
+        data = zlib.decompressobj().decompress(data, size + 1)
+    except zlib.error as err:
+        raise ProtocolError(f"Broken {what}: {err}") from err
+    if len(data) != size:
+        raise ProtocolError(f"Broken {what}")
+    return np.frombuffer(data, dtype=np.uint8)
+
+
+def message(kind: int, payload: bytes = b'') -> bytes:
+    return FRAME.pack(len(payload), kind) + payload
+
+
+async def read_message(reader: asyncio.StreamReader) -> tuple[int, bytes]:
+    length, kind = FRAME.unpack(await reader.readexactly(FRAME.size))
+    if length > MAX_MESSAGE:
+        raise ProtocolError(f"Message is too long: {length} bytes")
+    return kind, await reader.readexactly(length)
+
+
+def encode_hello(spawn: Position) -> bytes:
+    return message(HELLO, HELLO_DATA.pack(VERSION, CHUNK_SIZE, *spawn))
+
+
+def decode_hello(payload: bytes) -> Position:
+    version, chunk_size, x, y, z = HELLO_DATA.unpack(payload)
+    if version != VERSION or chunk_size != CHUNK_SIZE:
+        raise ProtocolError(f"Unsupported server: version {version}, chunk size {chunk_size}")
+    return Position(x, y, z)
+
+
+def encode_keys(kind: int, keys) -> bytes:
+    return message(kind, np.array(list(keys), dtype='<i4').reshape(-1, 2).tobytes())
+
+
+def decode_keys(payload: bytes) -> list[ChunkKey]:
+    if len(payload) % 8:
+        raise ProtocolError("Broken chunk list")
+    return [tuple(key) for key in np.frombuffer(payload, dtype='<i4').reshape(-1, 2).tolist()]
+
+
+def encode_chunk_message(key: ChunkKey, blocks: np.ndarray | None) -> bytes:
+    if blocks is None:
+        return message(CHUNK, CHUNK_HEAD.pack(*key, 0))
+    return message(CHUNK, CHUNK_HEAD.pack(*key, blocks.shape[2]) + encode_chunk(blocks, True))
+
+
+def decode_chunk_message(payload: bytes) -> tuple[ChunkKey, np.ndarray | None]:
+    cx, cy, height = CHUNK_HEAD.unpack_from(payload)
+    if not height:
+        return (cx, cy), None
+    blocks = decode_chunk(payload[CHUNK_HEAD.size:], height, True, (cx, cy))
+    _check_values(blocks, "chunk")
+    return (cx, cy), blocks
+
+
+def encode_set(position: Position, value: int) -> bytes:
+    return message(SET, SET_DATA.pack(*position, value))
+
+
+def decode_set(payload: bytes) -> tuple[Position, int]:
+    x, y, z, value = SET_DATA.unpack(payload)
+    if value >= len(TYPES):
+        raise ProtocolError(f"Unknown block type {value}")
+    return Position(x, y, z), value
+
+
+def encode_box(origin: Position, values: np.ndarray, mask: np.ndarray | None = None) -> bytes:
+    data = np.ascontiguousarray(values, dtype=np.uint8).tobytes()
+    if mask is not None:
+        data += np.packbits(mask, axis=None).tobytes()
+    head = BOX_HEAD.pack(*origin, *values.shape, 0 if mask is None else FLAG_MASK)
+    return message(BOX, head + zlib.compress(data))
+
+
+def decode_box(payload: bytes) -> tuple[Position, np.ndarray, np.ndarray | None]:
+    x, y, z, width, depth, height, flags = BOX_HEAD.unpack_from(payload)
+    shape = (width, depth, height)
+    size = width * depth * height
+    if size > MAX_MESSAGE:
+        raise ProtocolError(f"Box is too large: {shape}")
+    data = _inflate(payload[BOX_HEAD.size:], size + (-(-size // 8) if flags & FLAG_MASK else 0), "box")
+    mask = None
+    if flags & FLAG_MASK:
+        mask = np.unpackbits(data[size:], count=size).astype(bool).reshape(shape)
+    _check_values(data[:size], "box")
+    return Position(x, y, z), data[:size].reshape(shape), mask
+
+
+def encode_blocks(positions: np.ndarray, values: np.ndarray) -> bytes:
+    """ изменения отдельных блоков: positions - массив (N, 3), values - (N,) """
+    order = np.lexsort(positions.T[::-1])
+    positions, values = positions[order], values[order]
+    deltas = np.diff(positions, axis=0, prepend=np.zeros((1, 3), dtype=positions.dtype))
+    data = deltas.astype('<i4').tobytes() + values.astype(np.uint8).tobytes()
+    return message(BLOCKS, BLOCKS_HEAD.pack(len(values)) + zlib.compress(data))
+
+
+def decode_blocks(payload: bytes) -> tuple[np.ndarray, np.ndarray]:
+    count, = BLOCKS_HEAD.unpack_from(payload)
+    if count * 13 > MAX_MESSAGE:
+        raise ProtocolError(f"Too many blocks: {count}")
+    data = _inflate(payload[BLOCKS_HEAD.size:], count * 13, "blocks")
+    positions = np.cumsum(data[:count * 12].view('<i4').reshape(-1, 3), axis=0, dtype=np.int64)
+    _check_values(data[count * 12:], "blocks")
+    return positions, data[count * 12:]
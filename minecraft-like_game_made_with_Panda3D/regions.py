@@ -0,0 +1,243 @@
+""" Хранение мира в файлах регионов: каталог с файлами r.<rx>.<ry>.vxr, в каждом до
+REGION_SIZE x REGION_SIZE чанков. Сохраняются только изменённые чанки.
+
+Файл региона пишется только в конец:
+
+    заголовок: magic 'VXRG' | версия u16 | флаги u16 | размер чанка u16 | размер региона u16
+               | смещение таблицы u64 | длина таблицы u32
+    данные чанков и таблицы: (высота u16, смещение u64, длина u32) на каждый чанк региона
+
+При сохранении новые данные чанков и новая таблица дописываются в конец файла, и только
+потом заголовок переключается на новую таблицу. Если запись оборвётся, заголовок будет
+указывать на старую таблицу, а старые данные не затираются. Когда мусора в файле становится
+больше, чем живых данных, файл переписывается заново и подменяет старый целиком """
+import os
+import re
+import shutil
+import struct
+import threading
+from collections.abc import Iterator, Mapping
+from pathlib import Path
+
+import numpy as np
+
+from conf import CHUNK_SIZE, REGION_SIZE, MAP_COMPRESSION
+from mapfile import MapFormatError, encode_chunk, decode_chunk
+from terrain import TerrainGenerator
+from voxels import ChunkKey, ChunkSource
+
+
+MAGIC = b'VXRG'
+VERSION = 1
+FLAG_ZLIB = 1
+
+HEADER = struct.Struct('<4sHHHHQI')
+TABLE_DTYPE = np.dtype([('height', '<u2'), ('offset', '<u8'), ('length', '<u4')])
+REGION_NAME = re.compile(r'^r\.(-?\d+)\.(-?\d+)\.vxr$')
+TERRAIN_FILE = 'terrain.json'  # настройки генератора рельефа, если мир построен им
+
+RegionKey = tuple[int, int]
+
+
+def region_key(key: ChunkKey) -> RegionKey:
+    return key[0] // REGION_SIZE, key[1] // REGION_SIZE
+
+
+def _slot(key: ChunkKey) -> int:
+    """ номер строки таблицы региона для чанка """
+    return (key[0] % REGION_SIZE) * REGION_SIZE + key[1] % REGION_SIZE
+
+
+class Region:
+    """ Открытый файл региона и его текущая таблица чанков """
+
+    def __init__(self, path: Path, create: bool = False, compress: bool = MAP_COMPRESSION) -> None:
+        self.path = path
+        if create and not path.exists():
+            self.flags = FLAG_ZLIB if compress else 0
+            self.table = np.zeros(REGION_SIZE * REGION_SIZE, dtype=TABLE_DTYPE)
+            with open(path, 'xb') as fout:
+                fout.write(HEADER.pack(MAGIC, VERSION, self.flags, CHUNK_SIZE, REGION_SIZE, 0, 0))
+            self.fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            return
+
+        self.fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        header = os.pread(self.fd, HEADER.size, 0)
+        if len(header) < HEADER.size or header[:4] != MAGIC:
+            os.close(self.fd)
+            raise MapFormatError(f"Not a region file: {path}")
+        _, version, self.flags, chunk_size, region_size, table_offset, table_length = HEADER.unpack(header)
+        if version != VERSION or chunk_size != CHUNK_SIZE or region_size != REGION_SIZE:
+            os.close(self.fd)
+            raise MapFormatError(f"Unsupported region file: {path}")
+        self.table = np.zeros(REGION_SIZE * REGION_SIZE, dtype=TABLE_DTYPE)
+        if table_length:
+            data = os.pread(self.fd, table_length, table_offset)
+            if len(data) != self.table.nbytes:
+                os.close(self.fd)
+                raise MapFormatError(f"Region file is truncated: {path}")
+            self.table = np.frombuffer(data, dtype=TABLE_DTYPE).copy()
+
+    def close(self) -> None: os.close(self.fd)
+
+    def keys(self, rx: int, ry: int) -> Iterator[ChunkKey]:
+        for slot in np.flatnonzero(self.table['length']).tolist():
+            yield rx * REGION_SIZE + slot // REGION_SIZE, ry * REGION_SIZE + slot % REGION_SIZE
+
+    def has(self, key: ChunkKey) -> bool: return bool(self.table['length'][_slot(key)])
+
+    def read(self, key: ChunkKey) -> np.ndarray:
+        height, offset, length = self.table[_slot(key)].tolist()
+        return decode_chunk(os.pread(self.fd, length, offset), height, bool(self.flags & FLAG_ZLIB), key)
+
+    def live_bytes(self) -> int: return int(self.table['length'].sum()) + self.table.nbytes + HEADER.size
+
+    def append(self, chunks: dict[ChunkKey, np.ndarray]) -> np.ndarray:
+        """ дописывает чанки и новую таблицу в конец файла и переключает на неё заголовок.
+        Возвращает новую таблицу, self.table не меняется """
+        table = self.table.copy()
+        end = os.fstat(self.fd).st_size
+        for key, blocks in chunks.items():
+            data = encode_chunk(blocks, bool(self.flags & FLAG_ZLIB))
+            os.pwrite(self.fd, data, end)
+            table[_slot(key)] = (blocks.shape[2], end, len(data))
+            end += len(data)
+        os.pwrite(self.fd, table.tobytes(), end)
+        # таблица и данные должны оказаться на диске раньше заголовка, который на них указывает
+        os.fsync(self.fd)
+        os.pwrite(self.fd, HEADER.pack(MAGIC, VERSION, self.flags, CHUNK_SIZE, REGION_SIZE, end, table.nbytes), 0)
+        os.fsync(self.fd)
+        return table
+
+
+class RegionStore:
+    """ Мир в каталоге файлов регионов. Подходит как source для VoxelGrid: чанки читаются
+    по одному, а write_chunks дописывает только переданные чанки. Чтение из основного
+    потока и запись из фонового можно вести одновременно.
+    Если мир построен генератором рельефа, в файлах лежат только изменённые чанки, а остальные
+    строятся заново генератором """
+
+    def __init__(self, path: Path, compress: bool = MAP_COMPRESSION) -> None:
+        self.path = Path(path)
+        self.compress = compress
+        self._recover(self.path)
+        self._lock = threading.Lock()
+        self._regions: dict[RegionKey, Region] = {}
+        self._existing: set[RegionKey] = set()
+        self.generator: TerrainGenerator | None = None
+        if (self.path / TERRAIN_FILE).exists():
+            self.generator = TerrainGenerator.load(self.path / TERRAIN_FILE)
+        if self.path.is_dir():
+            for name in os.listdir(self.path):
+                match = REGION_NAME.match(name)
+                if match:
+                    self._existing.add((int(match[1]), int(match[2])))
+
+    @staticmethod
+    def _recover(path: Path) -> None:
+        """ доделывает подмену каталога мира, если replace оборвался """
+        old, temp = Path(f"{path}.old"), Path(f"{path}.tmp")
+        if not path.exists() and old.exists():
+            old.rename(path)
+        shutil.rmtree(old, ignore_errors=True)
+        shutil.rmtree(temp, ignore_errors=True)
+
+    @classmethod
+    def replace(cls, path: Path, chunks: Mapping[ChunkKey, np.ndarray], source: ChunkSource | None = None,
+                compress: bool = MAP_COMPRESSION) -> None:
+        """ записывает мир из chunks целиком в новый каталог и подменяет им старый.
+        Чанки, которых нет в chunks, берутся из source: генератор рельефа сохраняется своими
+        настройками и потом строит их заново, а чанки других источников (карты высот) переписываются """
+        path = Path(path)
+        temp, old = Path(f"{path}.tmp"), Path(f"{path}.old")
+        shutil.rmtree(temp, ignore_errors=True)
+        temp.mkdir(parents=True)
+        if isinstance(source, TerrainGenerator):
+            source.save(temp / TERRAIN_FILE)
+        store = cls(temp, compress)
+        try:
+            if source is not None and not isinstance(source, TerrainGenerator):
+                # по региону за раз, чтобы не держать в памяти весь мир
+                batch: dict[ChunkKey, np.ndarray] = {}
+                for key in sorted((key for key in source if key not in chunks), key=region_key):
+                    if batch and region_key(key) != region_key(next(iter(batch))):
+                        store.write_chunks(batch)
+                        batch = {}
+                    batch[key] = source.read_chunk(key)
+                store.write_chunks(batch)
+            store.write_chunks(chunks)
+        finally:
+            store.close()
+        if path.exists():
+            path.rename(old)
+        temp.rename(path)
+        shutil.rmtree(old, ignore_errors=True)
+
+    def is_empty(self) -> bool: return not self._existing and self.generator is None
+
+    def close(self) -> None:
+        with self._lock:
+            for region in self._regions.values():
+                region.close()
+            self._regions.clear()
+
+    def _region(self, key: RegionKey, create: bool = False) -> Region | None:
+        region = self._regions.get(key)
+        if region is None and (create or key in self._existing):
+            self.path.mkdir(parents=True, exist_ok=True)
+            region = self._regions[key] = Region(self.path / f"r.{key[0]}.{key[1]}.vxr", create, self.compress)
+            self._existing.add(key)
+        return region
+
+    def __iter__(self) -> Iterator[ChunkKey]:
+        with self._lock:
+            keys = [key for rx, ry in sorted(self._existing) for key in self._region((rx, ry)).keys(rx, ry)]
+        return iter(keys)
+
+    def __contains__(self, key: ChunkKey) -> bool:
+        with self._lock:
+            region = self._region(region_key(key))
+            return region is not None and region.has(key) or self.generator is not None
+
+    def read_chunk(self, key: ChunkKey) -> np.ndarray:
+        with self._lock:
+            region = self._region(region_key(key))
+            if region is not None and region.has(key):
+                return region.read(key)
+        if self.generator is None:
+            raise KeyError(key)
+        return self.generator.read_chunk(key)
+
+    def write_chunks(self, chunks: Mapping[ChunkKey, np.ndarray]) -> int:
+        """ сохраняет переданные чанки, остальные не трогает. Возвращает число записанных байт """
+        by_region: dict[RegionKey, dict[ChunkKey, np.ndarray]] = {}
+        for key in chunks:
+            by_region.setdefault(region_key(key), {})[key] = chunks[key]
+        written = 0
+        for key, region_chunks in by_region.items():
+            with self._lock:
+                region = self._region(key, create=True)
+            size = os.fstat(region.fd).st_size
+            # дописывает в файл только фоновая запись, а читатели видят старую таблицу, пока она не подменена
+            table = region.append(region_chunks)
+            written += os.fstat(region.fd).st_size - size
+            with self._lock:
+                region.table = table
+            if os.fstat(region.fd).st_size > 2 * region.live_bytes() + 2 ** 20:
+                self._compact(key)
+        return written
+
+    def _compact(self, key: RegionKey) -> None:
+        """ переписывает файл региона без устаревших данных """
+        region = self._regions[key]
+        temp_path = region.path.with_suffix('.tmp')
+        temp_path.unlink(missing_ok=True)
+        with self._lock:
+            chunks = {chunk: region.read(chunk) for chunk in region.keys(*key)}
+        fresh = Region(temp_path, create=True, compress=bool(region.flags & FLAG_ZLIB))
+        fresh.table = fresh.append(chunks)
+        with self._lock:
+            os.replace(temp_path, region.path)
+            fresh.path = region.path
+            region.close()
+            self._regions[key] = fresh
@@ -0,0 +1,220 @@
+""" Сценарии игры без окна для сравнения производительности между коммитами.
+
+    python scenarios.py --out results.json
+
+Сцена рисуется программным рендером в крошечный невидимый буфер, так что видеокарта не нужна,
+а в время кадра входят задачи, отсечение и отправка сцены на отрисовку, но почти не входит растеризация.
+Для каждого сценария записываются общее время, перцентили задержки отдельных операций,
+число узлов сцены и пиковая память процесса """
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from panda3d.core import PandaSystem, loadPrcFileData
+
+loadPrcFileData('', 'window-type offscreen\nload-display p3tinydisplay\nwin-size 64 48\n'
+                    'audio-library-name null\nsync-video false')
+
+from direct.showbase.ShowBase import ShowBase  # noqa: E402
+
+from mapmanager import Mapmanager  # noqa: E402
+from meshcache import MeshCache  # noqa: E402
+from player import Player  # noqa: E402
+from type_hints import Position  # noqa: E402
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+LAND_SIZES = [64, 256, 1024]
+EDIT_MAP_SIZE = 128
+EDITS = 2000
+WALK_SEED = 1
+WALK_STEPS = 600
+WALK_DT = 1 / 30  # кадр героя в сценарии ходьбы, секунд
+SAVE_ROUNDS = 5
+PERCENTILES = (50, 90, 99)
+
+
+def peak_rss() -> int | None:
+    """ пиковая память процесса в байтах """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def latency(timings: list[float]) -> dict[str, float]:
+    """ перцентили задержки операций в миллисекундах """
+    values = np.array(timings) * 1000
+    result = {f"p{p}": float(np.percentile(values, p)) for p in PERCENTILES}
+    result.update(mean=float(values.mean()), max=float(values.max()), count=len(values))
+    return result
+
+
+def scene_stats(land: Mapmanager) -> dict[str, int]:
+    return {'scene_nodes': render.countNumDescendants(), 'chunk_nodes': len(land._chunks),
+            'loaded_chunks': len(land.voxels.chunks)}
+
+
+def write_heightmap(path: Path, size: int, seed: int = 0) -> Path:
+    rng = np.random.default_rng(seed)
+    path.write_text('\n'.join(' '.join(map(str, row)) for row in rng.integers(0, 12, (size, size))))
+    return path
+
+
+def frame() -> float:
+    """ один кадр игры: задачи, отсечение и отрисовка. Возвращает его длительность """
+    start = time.perf_counter()
+    taskMgr.step()
+    return time.perf_counter() - start
+
+
+def scenario_load_land(land: Mapmanager, directory: Path) -> dict:
+    """ загрузка карт высот разного размера и первый кадр с сетками вокруг центра карты """
+    focus = render.attachNewNode("focus")
+    land.follow(focus)
+    results = {}
+    for size in LAND_SIZES:
+        path = write_heightmap(directory / f"land_{size}.txt", size)
+        focus.setPos(size // 2, size // 2, 0)
+        start = time.perf_counter()
+        land.load_land(path)
+        loaded = time.perf_counter() - start
+        land.update_chunks()
+        results[str(size)] = {'load_land_s': loaded, 'wall_s': time.perf_counter() - start, **scene_stats(land)}
+    focus.removeNode()
+    land.follow(None)
+    return results
+
+
+def scenario_edits(land: Mapmanager, directory: Path) -> dict:
+    """ постройка и разрушение блоков вперемешку, после каждой операции - кадр с перестройкой сеток """
+    land.load_land(write_heightmap(directory / "edits.txt", EDIT_MAP_SIZE))
+    land.update_chunks()
+    rng = np.random.default_rng(1)
+    positions = rng.integers(0, EDIT_MAP_SIZE, (EDITS, 2))
+    builds, deletes, frames = [], [], []
+    start = time.perf_counter()
+    for number, (x, y) in enumerate(positions.tolist()):
+        operation_start = time.perf_counter()
+        if number % 2:
+            land.del_block_from(Position(x, y, 0))
+            deletes.append(time.perf_counter() - operation_start)
+        else:
+            land.build_block(Position(x, y, 0))
+            builds.append(time.perf_counter() - operation_start)
+        frames.append(frame())
+    return {'wall_s': time.perf_counter() - start, 'build_block_ms': latency(builds),
+            'del_block_from_ms': latency(deletes), 'frame_ms': latency(frames), **scene_stats(land)}
+
+
+def scenario_walk(land: Mapmanager, directory: Path) -> dict:
+    """ герой идёт по миру генератора рельефа через Player.update с постоянным шагом времени,
+    карта подгружается вокруг него """
+    player = Player(land.generate_land(WALK_SEED), land)
+    # ход героя меряется отдельно от кадра, с одинаковым dt на любой машине
+    taskMgr.remove("PlayerMoveTask")
+    land.follow(player.hero)
+    land.update_chunks()
+    steps, frames = [], []
+    player.keys['forward'] = True
+    start = time.perf_counter()
+    for step in range(WALK_STEPS):
+        # идём то прямо, то по диагонали, поворачивая
+        player.keys['right'] = step % 200 < 100
+        player.keys['turn_left'] = step % 100 == 99
+        step_start = time.perf_counter()
+        player.update(WALK_DT)
+        steps.append(time.perf_counter() - step_start)
+        frames.append(frame())
+    result = {'wall_s': time.perf_counter() - start, 'move_ms': latency(steps), 'frame_ms': latency(frames),
+              'position': list(player.hero.getPos()), **scene_stats(land)}
+    player.hero.removeNode()
+    land.follow(None)
+    return result
+
+
+def scenario_save_load(land: Mapmanager, directory: Path) -> dict:
+    """ сохранение и загрузка карты по кругу, между ними - несколько изменений """
+    land.world = directory / "world"
+    land.load_land(write_heightmap(directory / "save.txt", EDIT_MAP_SIZE))
+    saves, loads, waits = [], [], []
+    start = time.perf_counter()
+    for round_number in range(SAVE_ROUNDS):
+        for x in range(8):
+            land.build_block(Position(x * 20, round_number * 20, 0))
+        save_start = time.perf_counter()
+        land.save_map()
+        saves.append(time.perf_counter() - save_start)
+        # запись идёт в фоне, отдельно замеряем, сколько ждать её окончания
+        land._finish_save()
+        waits.append(time.perf_counter() - save_start)
+        load_start = time.perf_counter()
+        land.load_map()
+        loads.append(time.perf_counter() - load_start)
+    return {'wall_s': time.perf_counter() - start, 'save_map_ms': latency(saves), 'save_done_ms': latency(waits),
+            'load_map_ms': latency(loads), **scene_stats(land)}
+
+
+SCENARIOS = {
+    'load_land': scenario_load_land,
+    'edits': scenario_edits,
+    'walk': scenario_walk,
+    'save_load': scenario_save_load,
+}
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--out', type=Path, help="куда записать JSON, по умолчанию - в stdout")
+    parser.add_argument('scenarios', nargs='*', metavar='scenario',
+                        help=f"какие сценарии запускать: {', '.join(SCENARIOS)}, по умолчанию все")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    ShowBase()
+    land = Mapmanager()
+    # сетки, сохранённые прошлыми запусками, сделали бы результаты несравнимыми
+    land.mesh_cache.close()
+    land.mesh_cache = MeshCache(None, 0)
+    results = {'commit': commit(), 'python': platform.python_version(), 'panda3d': PandaSystem.getVersionString(),
+               'cpus': os.cpu_count(), 'mesh_workers': land.meshes.workers, 'scenarios': {}}
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.scenarios or SCENARIOS:
+            start = time.perf_counter()
+            result = SCENARIOS[name](land, Path(directory))
+            result['peak_rss_bytes'] = peak_rss()
+            results['scenarios'][name] = result
+            print(f"{name}: {time.perf_counter() - start:.1f} s", file=sys.stderr)
+        land._clear()
+
+    text = json.dumps(results, indent=2)
+    if args.out is None:
+        print(text)
+    else:
+        args.out.write_text(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+""" Сервер мира: одна карта на всех игроков, клиенты подключаются по TCP.
+
+    python server.py --world data/world --port 25570
+
+Сервер хранит карту и решает, что в ней стоит: правки клиентов применяются по очереди,
+а их итог рассылается всем, кто держит задетые чанки, включая автора правки. Клиент
+получает чанк целиком, только когда попросит, дальше - только изменения его клеток, так
+что трафик и работа сервера растут с числом правок, а не с размером мира.
+Падающие блоки тоже сдвигает сервер, а клиенты получают сдвиги как обычные изменения блоков.
+Карта хранится как у одиночной игры: файлы регионов и журнал правок в каталоге мира """
+import argparse
+import asyncio
+import struct
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from conf import PATH_WORLD, CHUNK_SIZE, VIEW_RADIUS, SERVER_HOST, SERVER_PORT, SERVER_TICK, SERVER_SAVE_PERIOD, PHYSICS_BUDGET
+from journal import EditJournal, JOURNAL_FILE
+from protocol import (REQUEST, FORGET, SET, BOX, SAVE, ProtocolError, read_message, encode_hello, decode_keys,
+                      encode_chunk_message, decode_set, decode_box, encode_box, encode_blocks)
+from physics import BlockPhysics
+from regions import RegionStore
+from terrain import TerrainGenerator
+from type_hints import Position
+from voxels import VoxelGrid, ChunkKey, chunk_key
+
+
+MAX_HEIGHT = 4096  # выше клиентам строить нельзя, чтобы одна правка не съела память сервера
+# область шире, чем клиент видит вокруг героя, не правится одним сообщением: иначе одна область
+# в MAX_MESSAGE клеток подгрузила бы сотни тысяч чанков
+MAX_BOX_WIDTH = (2 * VIEW_RADIUS + 1) * CHUNK_SIZE
+
+
+class Session:
+    """ Подключённый клиент: какие чанки у него есть и какие изменения ещё не отправлены """
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.chunks: set[ChunkKey] = set()
+        self.blocks: dict[Position, int] = {}  # изменения отдельных блоков за текущий такт
+
+    def flush(self) -> None:
+        """ отправляет накопленные изменения блоков одним сообщением """
+        if self.blocks:
+            positions = np.array(list(self.blocks), dtype=np.int64)
+            self.writer.write(encode_blocks(positions, np.array(list(self.blocks.values()), dtype=np.uint8)))
+            self.blocks.clear()
+
+
+class WorldServer:
+    """ Карта сервера и подключённые клиенты """
+
+    def __init__(self, world: Path, seed: int = 0) -> None:
+        self.world = Path(world)
+        self.voxels = VoxelGrid()
+        store = RegionStore(self.world)
+        # пустой мир строит генератор рельефа
+        self.voxels.attach(TerrainGenerator(seed) if store.is_empty() else store)
+        self.journal = EditJournal()
+        self.physics = BlockPhysics(self.voxels)
+        if not store.is_empty():
+            for edit in self.journal.open(self.world / JOURNAL_FILE):
+                self.voxels.write_box(edit.origin, edit.new)
+                # блоки, которые не успели упасть до выхода, падают дальше
+                self.physics.wake(edit.origin, edit.new.shape)
+        self.sessions: list[Session] = []
+        self._subscribers: defaultdict[ChunkKey, int] = defaultdict(int)  # сколько клиентов держат чанк
+        self._saving = False
+
+    def spawn(self) -> Position:
+        """ место для героя: над серединой сохранённой карты или над началом координат """
+        keys = list(self.voxels.source)
+        x = y = 0
+        if keys:
+            xs, ys = zip(*keys)
+            x, y = (min(xs) + max(xs) + 1) * CHUNK_SIZE // 2, (min(ys) + max(ys) + 1) * CHUNK_SIZE // 2
+        return Position(x, y, self.voxels.column_height(x, y))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        session = Session(writer)
+        self.sessions.append(session)
+        writer.write(encode_hello(self.spawn()))
+        try:
+            while True:
+                kind, payload = await read_message(reader)
+                if kind == REQUEST:
+                    self._send_chunks(session, decode_keys(payload))
+                elif kind == FORGET:
+                    self._forget(session, decode_keys(payload))
+                elif kind == SET:
+                    self._set_block(*decode_set(payload))
+                elif kind == BOX:
+                    self._write_box(*decode_box(payload))
+                elif kind == SAVE:
+                    asyncio.create_task(self.save())
+                else:
+                    raise ProtocolError(f"Unknown message type {kind}")
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except (ProtocolError, struct.error, ValueError) as err:
+            print(f"Client {writer.get_extra_info('peername')} disconnected: {err}")
+        finally:
+            self.sessions.remove(session)
+            self._forget(session, list(session.chunks))
+            writer.close()
+
+    def _send_chunks(self, session: Session, keys: list[ChunkKey]) -> None:
+        for key in keys:
+            chunk = self.voxels.chunk(key)
+            # изменения, накопленные до отправки чанка, уже в нём
+            session.writer.write(encode_chunk_message(key, None if chunk is None else chunk.blocks))
+            if key not in session.chunks:
+                session.chunks.add(key)
+                self._subscribers[key] += 1
+
+    def _forget(self, session: Session, keys: list[ChunkKey]) -> None:
+        for key in keys:
+            if key in session.chunks:
+                session.chunks.remove(key)
+                self._subscribers[key] -= 1
+                if not self._subscribers[key]:
+                    del self._subscribers[key]
+                    self.voxels.unload(key)
+
+    def _set_block(self, position: Position, value: int) -> None:
+        x, y, z = position
+        if not 0 <= z < MAX_HEIGHT:
+            raise ProtocolError(f"Block position is out of the world: {position}")
+        old = self.voxels.get(x, y, z)
+        self.voxels.set(x, y, z, value)
+        self.journal.record(position, np.array([[[old]]], dtype=np.uint8), np.array([[[value]]], dtype=np.uint8))
+        self.physics.wake(position, (1, 1, 1))
+        self._send_block(position, value)
+
+    def _send_block(self, position: Position, value: int) -> None:
+        key = chunk_key(position[0], position[1])
+        for session in self.sessions:
+            if key in session.chunks:
+                session.blocks[position] = value
+
+    def _write_box(self, origin: Position, values: np.ndarray, mask: np.ndarray | None) -> None:
+        if origin[2] + values.shape[2] > MAX_HEIGHT:
+            raise ProtocolError(f"Box is out of the world: {origin}, {values.shape}")
+        if max(values.shape[:2]) > MAX_BOX_WIDTH:
+            raise ProtocolError(f"Box is too large: {values.shape}")
+        old = self.voxels.read_box(origin, values.shape)
+        self.voxels.write_box(origin, values, mask)
+        new = self.voxels.read_box(origin, values.shape)
+        self.journal.record(origin, old, new)
+        self.physics.wake(origin, values.shape)
+        # итог правки по частям в каждом чанке - только тем, у кого этот чанк есть
+        x, y, z = origin
+        for key, box, _ in self.voxels._box_parts(x, y, values.shape[0], values.shape[1]):
+            receivers = [session for session in self.sessions if key in session.chunks]
+            if not receivers:
+                continue
+            data = encode_box(Position(x + box[0].start, y + box[1].start, z), new[box])
+            for session in receivers:
+                # изменения блоков, сделанные раньше, должны прийти раньше
+                session.flush()
+                session.writer.write(data)
+
+    async def tick(self) -> None:
+        """ раз в такт сдвигает падающие блоки и рассылает накопленные изменения блоков """
+        while True:
+            await asyncio.sleep(SERVER_TICK)
+            if self.physics.active:
+                changes = self.physics.step(PHYSICS_BUDGET)
+                self.journal.record_moves(changes)
+                for position, _, new in changes:
+                    self._send_block(position, new)
+            for session in self.sessions:
+                session.flush()
+
+    async def autosave(self) -> None:
+        while True:
+            await asyncio.sleep(SERVER_SAVE_PERIOD)
+            await self.save()
+
+    async def save(self) -> None:
+        """ сохраняет изменённые чанки в фоновом потоке, клиенты тем временем продолжают играть """
+        if self._saving or not self.voxels.modified:
+            return
+        self._saving = True
+        chunks = self.voxels.snapshot()
+        mark = self.journal.mark()
+        store = self.voxels.source
+        try:
+            if isinstance(store, RegionStore):
+                await asyncio.to_thread(store.write_chunks, chunks)
+            else:
+                await asyncio.to_thread(RegionStore.replace, self.world, chunks, store)
+        except OSError as err:
+            self.voxels.save_failed()
+            print(f"Could not save map: {self.world}. {err}")
+        else:
+            self.voxels.saved(store if isinstance(store, RegionStore) else RegionStore(self.world))
+            self.journal.saved(mark, self.world / JOURNAL_FILE)
+            # сохранённые чанки, которые никому не нужны, можно выгрузить
+            for key in chunks:
+                if key not in self._subscribers:
+                    self.voxels.unload(key)
+        finally:
+            self._saving = False
+
+    async def serve(self, host: str, port: int) -> None:
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"World server on {', '.join(str(sock.getsockname()) for sock in server.sockets)}")
+        tasks = [asyncio.create_task(self.tick()), asyncio.create_task(self.autosave())]
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.save()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--world', type=Path, default=Path(PATH_WORLD), help="каталог мира")
+    parser.add_argument('--seed', type=int, default=0, help="seed генератора рельефа, если мир ещё пуст")
+    parser.add_argument('--host', default=SERVER_HOST)
+    parser.add_argument('--port', type=int, default=SERVER_PORT)
+    args = parser.parse_args()
+    try:
+        asyncio.run(WorldServer(args.world, args.seed).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+""" Генератор рельефа: карта высот из фрактального шума значений, целиком средствами NumPy.
+
+Шум зависит только от seed и координат, поэтому любой участок мира можно построить
+независимо от остальных. Генератор подходит как source для VoxelGrid: чанк строится,
+когда к нему обратились впервые, так что мир ничем не ограничен по X и Y """
+import json
+from functools import lru_cache
+from collections.abc import Iterator
+from pathlib import Path
+
+import numpy as np
+
+from conf import CHUNK_SIZE, CHUNK_HEIGHT, TERRAIN_SCALE, TERRAIN_OCTAVES, TERRAIN_BASE, TERRAIN_RELIEF
+from blocks import layers
+from voxels import ChunkKey
+
+# высоты считаются сразу для квадрата TILE x TILE чанков: соседние чанки обычно нужны вместе,
+# а на один чанк уходит почти столько же вызовов NumPy, сколько на весь квадрат
+TILE = 4
+TILE_CACHE = 64
+
+
+def _hash(ix: np.ndarray, iy: np.ndarray, salt: int) -> np.ndarray:
+    """ псевдослучайные числа от 0 до 1 для целых точек решётки (перемешивание splitmix64) """
+    h = (ix.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+         ^ iy.astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+         ^ np.uint64(salt & 0xFFFFFFFFFFFFFFFF))
+    h ^= h >> np.uint64(30)
+    h *= np.uint64(0xBF58476D1CE4E5B9)
+    h ^= h >> np.uint64(27)
+    h *= np.uint64(0x94D049BB133111EB)
+    h ^= h >> np.uint64(31)
+    return (h >> np.uint64(11)).astype(np.float64) / 2.0 ** 53
+
+
+def _axis(start: int, count: int, step: float) -> tuple[np.ndarray, np.ndarray]:
+    """ клетки решётки и сглаженные доли внутри клетки для координат start..start+count-1 """
+    position = (np.arange(start, start + count) + 0.5) * step
+    cell = np.floor(position)
+    fraction = position - cell
+    return cell.astype(np.int64), fraction * fraction * (3 - 2 * fraction)
+
+
+class TerrainGenerator:
+    """ Бесконечный мир из шума. seed задаёт мир целиком: одинаковый seed - одинаковый рельеф """
+
+    def __init__(self, seed: int, scale: float = TERRAIN_SCALE, octaves: int = TERRAIN_OCTAVES,
+                 base: int = TERRAIN_BASE, relief: int = TERRAIN_RELIEF) -> None:
+        self.seed = seed
+        self.scale = scale  # размер самых крупных холмов в клетках
+        self.octaves = octaves  # сколько слоёв всё более мелкого шума складывать
+        self.base = base  # высота самых низких мест
+        self.relief = relief  # разница высот между низинами и вершинами
+        self._tile = lru_cache(maxsize=TILE_CACHE)(self._make_tile)
+
+    @classmethod
+    def load(cls, path: Path) -> 'TerrainGenerator':
+        return cls(**json.loads(Path(path).read_text()))
+
+    def save(self, path: Path) -> None:
+        Path(path).write_text(json.dumps({'seed': self.seed, 'scale': self.scale, 'octaves': self.octaves,
+                                          'base': self.base, 'relief': self.relief}))
+
+    def noise(self, x: int, y: int, width: int, depth: int) -> np.ndarray:
+        """ фрактальный шум от 0 до 1 на участке (width, depth) клеток, начиная с клетки (x, y) """
+        total = np.zeros((width, depth))
+        amplitude, norm = 1.0, 0.0
+        for octave in range(self.octaves):
+            step = 2 ** octave / self.scale
+            cx, fx = _axis(x, width, step)
+            cy, fy = _axis(y, depth, step)
+            # значения в узлах решётки, покрывающей участок, и интерполяция между ними сначала по X, потом по Y
+            lattice = _hash(np.arange(cx[0], cx[-1] + 2)[:, None], np.arange(cy[0], cy[-1] + 2)[None, :],
+                            self.seed * 1_000_003 + octave)
+            nx, ny = cx - cx[0], cy - cy[0]
+            rows = lattice[nx] + (lattice[nx + 1] - lattice[nx]) * fx[:, None]
+            total += amplitude * (rows[:, ny] + (rows[:, ny + 1] - rows[:, ny]) * fy)
+            norm += amplitude
+            amplitude /= 2
+        return total / norm
+
+    def heights(self, x: int, y: int, width: int, depth: int) -> np.ndarray:
+        """ карта высот участка, как у read_heightmap: высота верхнего блока столбца, массив (X, Y) """
+        return (self.base + self.noise(x, y, width, depth) * self.relief).astype(np.int16)
+
+    def columns(self, heights: np.ndarray) -> np.ndarray:
+        """ клетки столбцов от z=0 до heights включительно, высота массива кратна CHUNK_HEIGHT """
+        height = (int(heights.max()) // CHUNK_HEIGHT + 1) * CHUNK_HEIGHT
+        return layers(heights[:, :, None] - np.arange(height, dtype=np.int16))
+
+    def __contains__(self, key: ChunkKey) -> bool: return True
+
+    def __iter__(self) -> Iterator[ChunkKey]:
+        """ сгенерированные чанки нигде не хранятся, перечислять нечего """
+        return iter(())
+
+    def _make_tile(self, tx: int, ty: int) -> np.ndarray:
+        size = TILE * CHUNK_SIZE
+        return self.heights(tx * size, ty * size, size, size)
+
+    def read_chunk(self, key: ChunkKey) -> np.ndarray:
+        cx, cy = key
+        x, y = cx % TILE * CHUNK_SIZE, cy % TILE * CHUNK_SIZE
+        return self.columns(self._tile(cx // TILE, cy // TILE)[x:x + CHUNK_SIZE, y:y + CHUNK_SIZE])
@@ -10,6 +10,12 @@ class Position(NamedTuple):
     z: int | None
 
 
+class RayHit(NamedTuple):
+    position: Position  # блок, в который попал луч
+    normal: Position  # грань блока, через которую вошёл луч, например (0, 0, 1) - верхняя
+    distance: float
+
+
 class RGBA(NamedTuple):
     red: int | float
     green: int | float
@@ -18,10 +24,9 @@ class RGBA(NamedTuple):
 
 
 class IMapmanager:
-    def _get_color(self) -> RGBA:
-        pass
+    block: int  # тип блоков, которые ставит игрок
 
-    def _find_blocks(self, pos):
+    def next_block(self) -> str:
         pass
 
     def _clear(self) -> None:
@@ -36,6 +41,9 @@ class IMapmanager:
     def is_empty(self, pos: Position) -> bool:
         pass
 
+    def is_loaded(self, pos: Position) -> bool:
+        pass
+
     def find_highest_empty(self, pos: Position) -> Position:
         pass
 
@@ -48,6 +56,30 @@ class IMapmanager:
     def del_block_from(self, position: Position) -> None:
         pass
 
+    def raycast(self, origin, direction, reach: float) -> RayHit | None:
+        pass
+
+    def fill_box(self, corner: Position, opposite: Position) -> None:
+        pass
+
+    def clear_box(self, corner: Position, opposite: Position) -> None:
+        pass
+
+    def fill_sphere(self, center: Position, radius: int) -> None:
+        pass
+
+    def copy_box(self, corner: Position, opposite: Position):
+        pass
+
+    def paste_box(self, position: Position, blocks, with_air: bool = True) -> None:
+        pass
+
+    def undo(self) -> None:
+        pass
+
+    def redo(self) -> None:
+        pass
+
     def save_map(self) -> None:
         pass
 
@@ -0,0 +1,395 @@
+from collections import OrderedDict
+from collections.abc import Iterator
+from itertools import chain
+from typing import Protocol
+
+import math
+
+import numpy as np
+
+from blocks import AIR
+from conf import CHUNK_SIZE, CHUNK_HEIGHT, CHUNK_CACHE_SIZE, LOD_TILE
+from type_hints import Position, RayHit
+
+
+ChunkKey = tuple[int, int]
+ChunkKeys = set[ChunkKey]
+BoxSlices = tuple[slice, slice]
+
+
+def chunk_key(x: int, y: int) -> ChunkKey:
+    """ координаты чанка, в который попадает клетка (x, y) """
+    return x // CHUNK_SIZE, y // CHUNK_SIZE
+
+
+def tile_key(key: ChunkKey) -> ChunkKey:
+    """ квадрат LOD_TILE x LOD_TILE чанков, в который входит чанк (для грубых сеток дальних чанков) """
+    return key[0] // LOD_TILE, key[1] // LOD_TILE
+
+
+def chunks_touching(x: int, y: int) -> ChunkKeys:
+    """ чанки, сетку которых меняет клетка (x, y): её собственный и соседи, если она на краю """
+    cx, cy = chunk_key(x, y)
+    keys = {(cx, cy)}
+    lx, ly = x % CHUNK_SIZE, y % CHUNK_SIZE
+    if lx == 0:
+        keys.add((cx - 1, cy))
+    elif lx == CHUNK_SIZE - 1:
+        keys.add((cx + 1, cy))
+    if ly == 0:
+        keys.add((cx, cy - 1))
+    elif ly == CHUNK_SIZE - 1:
+        keys.add((cx, cy + 1))
+    return keys
+
+
+class Chunk:
+    """ Столбец мира CHUNK_SIZE x CHUNK_SIZE клеток, высота растёт по мере надобности """
+    __slots__ = ('blocks', 'heights', 'shared')
+
+    def __init__(self, height: int = CHUNK_HEIGHT, blocks: np.ndarray | None = None) -> None:
+        # значение клетки - номер типа блока (blocks.py), 0 - пусто
+        if blocks is None:
+            blocks = np.zeros((CHUNK_SIZE, CHUNK_SIZE, height), dtype=np.uint8)
+        self.blocks = blocks
+        # карта высот: первая пустая клетка каждого столбца, считая от z=1
+        self.heights = np.ones((CHUNK_SIZE, CHUNK_SIZE), dtype=np.int16)
+        self.update_heights()
+        self.shared = False  # blocks попали в снимок карты, перед записью их нужно скопировать
+
+    def unshare(self) -> None:
+        """ копирует клетки перед изменением, если их ещё читает фоновое сохранение """
+        if self.shared:
+            self.blocks = self.blocks.copy()
+            self.shared = False
+
+    @property
+    def height(self) -> int: return self.blocks.shape[2]
+
+    def grow(self, z: int) -> None:
+        """ увеличивает высоту чанка так, чтобы в него поместилась клетка с высотой z """
+        height = (z // CHUNK_HEIGHT + 1) * CHUNK_HEIGHT
+        blocks = np.zeros((CHUNK_SIZE, CHUNK_SIZE, height), dtype=np.uint8)
+        blocks[:, :, :self.height] = self.blocks
+        self.blocks = blocks
+        self.shared = False
+
+    def update_heights(self) -> None:
+        """ пересчитывает карту высот после массового изменения blocks """
+        empty = np.ones((CHUNK_SIZE, CHUNK_SIZE, self.height), dtype=bool)
+        empty[:, :, :-1] = self.blocks[:, :, 1:] == AIR
+        self.heights[:] = empty.argmax(axis=2) + 1
+
+
+class ChunkSource(Protocol):
+    """ хранилище чанков на диске, например файл карты """
+    def __contains__(self, key: ChunkKey) -> bool: ...
+
+    def __iter__(self) -> Iterator[ChunkKey]: ...
+
+    def read_chunk(self, key: ChunkKey) -> np.ndarray: ...
+
+
+class VoxelGrid:
+    """ Индекс занятости клеток карты: словарь чанков с плотными массивами внутри.
+    Любой запрос к клетке - обращение к словарю и к массиву, сцена не используется.
+
+    Чанки, которых нет в памяти, подгружаются по запросу из source. Выгруженные чанки
+    какое-то время лежат в кэше, изменённые после чтения чанки не выгружаются """
+
+    def __init__(self, cache_size: int = CHUNK_CACHE_SIZE) -> None:
+        self.chunks: dict[ChunkKey, Chunk] = {}  # чанки в памяти
+        self.source: ChunkSource | None = None  # откуда подгружать остальные чанки
+        self.modified: ChunkKeys = set()  # чанки, которые отличаются от source
+        self._saving: ChunkKeys = set()  # изменённые чанки, которые сейчас сохраняются
+        self._cache: OrderedDict[ChunkKey, Chunk] = OrderedDict()  # недавно выгруженные чанки
+        self._cache_size = cache_size
+
+    def __len__(self) -> int:
+        """ число блоков в загруженных чанках """
+        return sum(int(np.count_nonzero(chunk.blocks)) for chunk in self.chunks.values())
+
+    def clear(self) -> None:
+        self.chunks.clear()
+        self._cache.clear()
+        self.modified.clear()
+        self._saving.clear()
+        self.source = None
+
+    def attach(self, source: ChunkSource) -> None:
+        """ начинает новую карту, чанки которой подгружаются из source """
+        self.clear()
+        self.source = source
+
+    def snapshot(self) -> dict[ChunkKey, np.ndarray]:
+        """ снимок изменённых чанков для записи в фоне, остальные уже лежат в source.
+        Клетки не копируются, а помечаются общими и копируются при следующем изменении """
+        arrays = {}
+        for key in sorted(self.modified):
+            chunk = self.chunks[key]
+            chunk.shared = True
+            arrays[key] = chunk.blocks
+        self._saving |= self.modified
+        self.modified = set()
+        return arrays
+
+    def saved(self, source: ChunkSource) -> None:
+        """ снимок записан в source, теперь его чанки можно выгружать и подгружать оттуда """
+        self.source = source
+        self._saving.clear()
+        for chunk in chain(self._cache.values(), self.chunks.values()):
+            chunk.shared = False
+
+    def save_failed(self) -> None:
+        """ снимок не записан, его изменённые чанки по-прежнему отличаются от source """
+        self.modified |= self._saving
+        self._saving.clear()
+
+    def keys(self) -> ChunkKeys:
+        """ все чанки карты, в памяти и на диске """
+        keys = set(self.chunks) | set(self._cache)
+        if self.source is not None:
+            keys.update(self.source)
+        return keys
+
+    def has_chunk(self, key: ChunkKey) -> bool:
+        return (key in self.chunks or key in self._cache
+                or self.source is not None and key in self.source)
+
+    def chunk(self, key: ChunkKey) -> Chunk | None:
+        """ чанк в памяти, при необходимости подгруженный из кэша или с диска """
+        chunk = self.chunks.get(key)
+        if chunk is None:
+            chunk = self._cache.pop(key, None)
+            if chunk is None and self.source is not None and key in self.source:
+                chunk = Chunk(blocks=self.source.read_chunk(key))
+            if chunk is not None:
+                self.chunks[key] = chunk
+        return chunk
+
+    def unload(self, key: ChunkKey) -> None:
+        """ выгружает чанк из памяти в кэш, если его можно потом снова прочитать с диска """
+        if key in self.modified or key in self._saving or key not in self.chunks:
+            return
+        self._cache[key] = self.chunks.pop(key)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    def padded(self, key: ChunkKey) -> np.ndarray:
+        """ клетки чанка в рамке толщиной в одну клетку из соседних чанков (для построения сетки) """
+        cx, cy = key
+        chunk = self.chunk(key)
+        height = chunk.height
+        blocks = np.zeros((CHUNK_SIZE + 2, CHUNK_SIZE + 2, height + 2), dtype=np.uint8)
+        blocks[1:-1, 1:-1, 1:-1] = chunk.blocks
+        # куда в рамке кладётся полоса соседа и какая это полоса
+        borders = (
+            ((-1, 0), (0, slice(1, -1)), (-1, slice(None))),
+            ((1, 0), (-1, slice(1, -1)), (0, slice(None))),
+            ((0, -1), (slice(1, -1), 0), (slice(None), -1)),
+            ((0, 1), (slice(1, -1), -1), (slice(None), 0)),
+        )
+        for (dx, dy), target, source in borders:
+            neighbour = self.chunk((cx + dx, cy + dy))
+            if neighbour is not None:
+                top = min(height, neighbour.height)
+                blocks[target + (slice(1, top + 1),)] = neighbour.blocks[source + (slice(0, top),)]
+        return blocks
+
+    def get(self, x: int, y: int, z: int) -> int:
+        key = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+        chunk = self.chunks.get(key) or self.chunk(key)
+        if chunk is None or not 0 <= z < chunk.height:
+            return AIR
+        return chunk.blocks.item(x % CHUNK_SIZE, y % CHUNK_SIZE, z)
+
+    def column_height(self, x: int, y: int) -> int:
+        """ высота первой пустой клетки столбца (x, y), считая от z=1 """
+        key = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+        chunk = self.chunks.get(key) or self.chunk(key)
+        return 1 if chunk is None else chunk.heights.item(x % CHUNK_SIZE, y % CHUNK_SIZE)
+
+    def raycast(self, origin: tuple[float, float, float], direction: tuple[float, float, float],
+                reach: float) -> RayHit | None:
+        """ первый блок на луче не дальше reach, клетки перебираются по порядку вдоль луча (3D DDA).
+        Клетка, в которой начинается луч, не проверяется """
+        length = math.sqrt(sum(d * d for d in direction))
+        if not length:
+            return None
+        # блок (x, y, z) занимает [x - 0.5, x + 0.5), сдвигаем, чтобы клетка была [x, x + 1)
+        start = [c + 0.5 for c in origin]
+        cell = [math.floor(c) for c in start]
+        steps, next_t, delta_t = [0, 0, 0], [math.inf] * 3, [math.inf] * 3
+        for axis in range(3):
+            d = direction[axis] / length
+            if d > 0:
+                steps[axis], next_t[axis], delta_t[axis] = 1, (cell[axis] + 1 - start[axis]) / d, 1 / d
+            elif d < 0:
+                steps[axis], next_t[axis], delta_t[axis] = -1, (cell[axis] - start[axis]) / d, -1 / d
+        x, y, z = cell
+        (step_x, step_y, step_z), (next_x, next_y, next_z), (delta_x, delta_y, delta_z) = steps, next_t, delta_t
+        key, blocks = None, None  # чанк, в котором сейчас луч
+        while True:
+            # шаг в соседнюю клетку через ближайшую по лучу грань
+            if next_x <= next_y and next_x <= next_z:
+                t, axis = next_x, 0
+                next_x += delta_x
+                x += step_x
+            elif next_y <= next_z:
+                t, axis = next_y, 1
+                next_y += delta_y
+                y += step_y
+            else:
+                t, axis = next_z, 2
+                next_z += delta_z
+                z += step_z
+                if z < 0 and step_z < 0:
+                    return None
+            if t > reach:
+                return None
+            if key != (x // CHUNK_SIZE, y // CHUNK_SIZE):
+                key = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+                chunk = self.chunks.get(key) or self.chunk(key)
+                blocks = None if chunk is None else chunk.blocks
+            if blocks is not None and 0 <= z < blocks.shape[2] and blocks.item(x % CHUNK_SIZE, y % CHUNK_SIZE, z):
+                normal = [0, 0, 0]
+                normal[axis] = -steps[axis]
+                return RayHit(Position(x, y, z), Position(*normal), t)
+
+    def set(self, x: int, y: int, z: int, value: int) -> None:
+        if z < 0:
+            raise ValueError(f"Block position is below the world: {Position(x, y, z)}")
+        key = (x // CHUNK_SIZE, y // CHUNK_SIZE)
+        chunk = self.chunks.get(key) or self.chunk(key)
+        if chunk is None:
+            if value == AIR:
+                return
+            chunk = self.chunks[key] = Chunk()
+        if z >= chunk.height:
+            if value == AIR:
+                return
+            chunk.grow(z)
+        self.modified.add(key)
+        chunk.unshare()
+        x, y = x % CHUNK_SIZE, y % CHUNK_SIZE
+        chunk.blocks[x, y, z] = value
+
+        # поддерживаем карту высот: столбец растёт, только если блок лёг на его вершину
+        height = chunk.heights[x, y]
+        if value != AIR:
+            if z == height:
+                column = chunk.blocks[x, y, z:]
+                free = np.flatnonzero(column == AIR)
+                chunk.heights[x, y] = z + (free[0] if free.size else column.size)
+        elif 1 <= z < height:
+            chunk.heights[x, y] = z
+
+    def set_many(self, positions: np.ndarray, values) -> ChunkKeys:
+        """ записывает сразу много клеток: positions - массив (N, 3), values - массив (N,) или одно значение.
+        Возвращает чанки, сетку которых нужно перестроить """
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        values = np.broadcast_to(np.asarray(values, dtype=np.uint8), len(positions))
+        if len(positions) and positions[:, 2].min() < 0:
+            raise ValueError("Block positions are below the world")
+        keys = positions[:, :2] // CHUNK_SIZE
+        order = np.lexsort((keys[:, 1], keys[:, 0]))
+        positions, keys, values = positions[order], keys[order], values[order]
+        bounds = np.flatnonzero((keys[1:] != keys[:-1]).any(axis=1)) + 1
+
+        touched = set()
+        for cells, cell_values in zip(np.split(positions, bounds), np.split(values, bounds)):
+            key = chunk_key(int(cells[0, 0]), int(cells[0, 1]))
+            chunk = self.chunk(key)
+            # воздух выше чанка или в несуществующем чанке записывать не нужно
+            height = 0 if chunk is None else chunk.height
+            keep = (cell_values != AIR) | (cells[:, 2] < height)
+            cells, cell_values = cells[keep], cell_values[keep]
+            if not len(cells):
+                continue
+            if chunk is None:
+                chunk = self.chunks[key] = Chunk()
+            top = int(cells[:, 2].max())
+            if top >= chunk.height:
+                chunk.grow(top)
+            x, y = cells[:, 0] % CHUNK_SIZE, cells[:, 1] % CHUNK_SIZE
+            chunk.unshare()
+            chunk.blocks[x, y, cells[:, 2]] = cell_values
+            chunk.update_heights()
+            self.modified.add(key)
+
+            cx, cy = key
+            touched.add(key)
+            for border, neighbour in ((x == 0, (cx - 1, cy)), (x == CHUNK_SIZE - 1, (cx + 1, cy)),
+                                      (y == 0, (cx, cy - 1)), (y == CHUNK_SIZE - 1, (cx, cy + 1))):
+                if border.any():
+                    touched.add(neighbour)
+        return touched
+
+    @staticmethod
+    def _box_parts(x: int, y: int, width: int, depth: int) -> Iterator[tuple[ChunkKey, BoxSlices, BoxSlices]]:
+        """ части области по чанкам: чанк, срезы по X и Y в области и те же клетки в чанке """
+        for cx in range(x // CHUNK_SIZE, (x + width - 1) // CHUNK_SIZE + 1):
+            x0, x1 = max(x, cx * CHUNK_SIZE), min(x + width, (cx + 1) * CHUNK_SIZE)
+            left = cx * CHUNK_SIZE
+            for cy in range(y // CHUNK_SIZE, (y + depth - 1) // CHUNK_SIZE + 1):
+                y0, y1 = max(y, cy * CHUNK_SIZE), min(y + depth, (cy + 1) * CHUNK_SIZE)
+                bottom = cy * CHUNK_SIZE
+                yield ((cx, cy), (slice(x0 - x, x1 - x), slice(y0 - y, y1 - y)),
+                       (slice(x0 - left, x1 - left), slice(y0 - bottom, y1 - bottom)))
+
+    def read_box(self, origin: Position, shape: tuple[int, int, int]) -> np.ndarray:
+        """ значения клеток прямоугольной области размером shape, начиная с клетки origin """
+        x, y, z = origin
+        result = np.zeros(shape, dtype=np.uint8)
+        for key, box, cells in self._box_parts(x, y, shape[0], shape[1]):
+            chunk = self.chunk(key)
+            if chunk is None:
+                continue
+            z0, z1 = max(z, 0), min(z + shape[2], chunk.height)
+            if z0 < z1:
+                result[box + (slice(z0 - z, z1 - z),)] = chunk.blocks[cells + (slice(z0, z1),)]
+        return result
+
+    def write_box(self, origin: Position, values: np.ndarray, mask: np.ndarray | None = None) -> ChunkKeys:
+        """ записывает прямоугольную область values, начиная с клетки origin, каждый чанк - одним срезом.
+        mask - какие клетки области записывать, по умолчанию все. Клетки ниже z=0 отбрасываются.
+        Возвращает чанки, сетку которых нужно перестроить """
+        x, y, z = origin
+        values = np.asarray(values, dtype=np.uint8)
+        if z < 0:
+            values = values[:, :, -z:]
+            mask = None if mask is None else mask[:, :, -z:]
+            z = 0
+        touched = set()
+        for key, box, cells in self._box_parts(x, y, values.shape[0], values.shape[1]):
+            part = values[box]
+            part_mask = None if mask is None else mask[box]
+            solid = part != AIR if part_mask is None else (part != AIR) & part_mask
+            levels = np.flatnonzero(solid.any(axis=(0, 1)))
+            chunk = self.chunk(key)
+            if chunk is None:
+                if not len(levels):
+                    continue
+                chunk = self.chunks[key] = Chunk()
+            if len(levels) and z + levels[-1] >= chunk.height:
+                chunk.grow(z + int(levels[-1]))
+            # выше чанка и так воздух
+            top = min(part.shape[2], chunk.height - z)
+            if top <= 0:
+                continue
+            chunk.unshare()
+            target = chunk.blocks[cells + (slice(z, z + top),)]
+            if part_mask is None:
+                target[...] = part[:, :, :top]
+            else:
+                np.copyto(target, part[:, :, :top], where=part_mask[:, :, :top])
+            chunk.update_heights()
+            self.modified.add(key)
+
+            cx, cy = key
+            touched.add(key)
+            for border, neighbour in ((cells[0].start == 0, (cx - 1, cy)), (cells[0].stop == CHUNK_SIZE, (cx + 1, cy)),
+                                      (cells[1].start == 0, (cx, cy - 1)), (cells[1].stop == CHUNK_SIZE, (cx, cy + 1))):
+                if border:
+                    touched.add(neighbour)
+        return touched